@@ -1,116 +1,41 @@
+import io
 import json
+import hashlib
 import os
+import time
+import threading
 import boto3
 import base64
+import random
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+# Process start, for separating cold-start (init) time from per-request time
+INIT_START = time.perf_counter()
 
-def lambda_handler(event, context):
-
-    # this can be run either as cmd line py program or a Lambda based on the execution environment
-    execEnv = str(os.getenv('AWS_EXECUTION_ENV'))
-    if execEnv.startswith("AWS_Lambda"):
-        model_image_id = os.getenv('model_image_id')
-    else:
-        parser = argparse.ArgumentParser()
-        parser.add_argument("-m", "--model_image_id", help="The model_id to use for Image real time inference")
-        args = parser.parse_args()
-        model_image_id = args.model_image_id
-
-    if model_image_id is None:
-        print("Invalid model_image_id")
-        return -1
-    else:
-        print(" Image model id: ", model_image_id)
-
-    # Check if this is a Bedrock Agent request
-    is_bedrock_agent = 'messageVersion' in event and 'actionGroup' in event
-    
-    if is_bedrock_agent:
-        # Extract from OpenAPI schema request body properties
-        request_body = event['requestBody']['content']['application/json']['properties']
+# Resources reused across warm invocations of the same execution environment
+_lock = threading.Lock()
+_clients = {}
+_fewshot_cache = None
+_analysis_cache = None
+_preprocessor = None
+_settings = {}
+_invocations = 0
 
-        print(request_body)
+CLIENT_CONFIG = Config(max_pool_connections=16, retries={'max_attempts': 5, 'mode': 'adaptive'})
+# batch model calls are retried by ThrottledRuntime, which adapts the concurrency, so botocore makes one attempt
+BATCH_RUNTIME_CONFIG = Config(max_pool_connections=16, retries={'total_max_attempts': 1, 'mode': 'standard'})
 
-        params = {}
-        for param in request_body:
-            name = param.get('name')
-            value = param.get('value')
-            params[name] = value
+# Few-shot examples: image key (relative to the few-shot prefix) and the analysis the
+# model is shown for it. Set `fewshot_manifest` to the S3 key of a JSON list of
+# {"key": ..., "answer": ...} objects to use a different example set.
+FEWSHOT_PREFIX = 'iq-constellation-fewshot-data/'
+FEWSHOT_REFRESH_SECONDS = 300
 
-        bucket_name = params['bucket_name']
-        image_key = params['image_key']
-
-        print(f"Bucket Name: {bucket_name}, Image Key: {image_key}")
-
-    else:
-        # Extract from direct Lambda event
-        bucket_name = event['bucket_name']
-        image_key = event['image_key']
-    
-    s3 = boto3.client('s3')
-    bedrock = boto3.client('bedrock-runtime')
-    
-    # Get the target image from S3
-    response = s3.get_object(Bucket=bucket_name, Key=image_key)
-    image_data = response['Body'].read()
-
-    # Load few-shot example images from S3
-    fewshot_prefix = 'iq-constellation-fewshot-data/'
-    
-    # Get interference example
-    interference_response = s3.get_object(
-        Bucket=bucket_name, 
-        Key=f'{fewshot_prefix}interference-13.jpeg'
-    )
-    interference_image = interference_response['Body'].read()
-    
-    # Get phase noise example
-    phase_noise_response = s3.get_object(
-        Bucket=bucket_name, 
-        Key=f'{fewshot_prefix}phase_noise-0.jpeg'
-    )
-    phase_noise_image = phase_noise_response['Body'].read()
-
-    # System prompt
-    system_prompt = (
-        "You are an expert RF Analyst specializing in IQ constellation modulation diagrams. "
-        "Your task is to analyze constellation diagrams and identify:\n"
-        "1. The modulation type (e.g., QPSK, 16-QAM, 64-QAM, etc.)\n"
-        "2. Any noise or impairments present\n"
-        "3. Classification of noise/imbalance as phase noise or interference\n"
-        "4. Typical causes of the identified issues\n\n"
-        "5. Imparement severity if present (Mild/moderate/severe)\n"
-        "6. Quick recommendation (acceptable/needs attendtion/critical)\n"
-        "Do not respond in markup, respond in plain text"
-        "I will show you some examples first, then ask you to analyze a new image."
-    )
-
-    # Use converse API with few-shot examples
-    response = bedrock.converse(
-        modelId=model_image_id,
-        system=[{'text': system_prompt}],
-        messages=[
-            # Few-shot Example 1: Interference
-            {
-                'role': 'user',
-                'content': [
-                    {
-                        'image': {
-                            'format': 'jpeg',
-                            'source': {'bytes': interference_image}
-                        }
-                    },
-                    {
-                        'text': 'Analyze this IQ constellation diagram.'
-                    }
-                ]
-            },
-            {
-                'role': 'assistant',
-                'content': [{
-                    'text': (
-                        """
+INTERFERENCE_ANSWER = """
                         1. Modulation type: 8PSK (8 constellation points arranged in a circle at 45-degree intervals)
 
                         2. Noise/impairments present: Yes, severe impairment with significant signal degradation detected
@@ -133,29 +58,8 @@ def lambda_handler(event, context):
                         6. Quick recommendation: Critical - immediate investigation required to identify and eliminate interference source. Check for nearby transmitters, verify filtering, examine power supply noise, and consider
                         frequency coordination. Monitor spectrum around operating frequency to identify specific interference signatures.
                         """
-                    )
-                }]
-            },
-            # Few-shot Example 2: Phase Noise
-            {
-                'role': 'user',
-                'content': [
-                    {
-                        'image': {
-                            'format': 'jpeg',
-                            'source': {'bytes': phase_noise_image}
-                        }
-                    },
-                    {
-                        'text': 'Analyze this IQ constellation diagram.'
-                    }
-                ]
-            },
-            {
-                'role': 'assistant',
-                'content': [{
-                    'text': (
-            """
+
+PHASE_NOISE_ANSWER = """
                 1. Modulation type: 8PSK (8 constellation points arranged in a circle at 45-degree intervals)
 
                 2. Noise/impairments present: Yes, significant phase-related impairment detected affecting all constellation points uniformly
@@ -176,30 +80,826 @@ def lambda_handler(event, context):
                 6. Quick recommendation: Needs attention - phase noise at this level suggests oscillator subsystem requires calibration or component replacement. Monitor temperature stability and check PLL loop parameters.
                 Consider frequency reference upgrade if persistent across multiple units.
                 """
-                    )
-                }]
+
+DEFAULT_FEWSHOT_EXAMPLES = [
+    {'key': 'interference-13.jpeg', 'answer': INTERFERENCE_ANSWER},
+    {'key': 'phase_noise-0.jpeg', 'answer': PHASE_NOISE_ANSWER},
+]
+
+# System prompt for the analysis. Bump PROMPT_VERSION whenever the wording or the
+# expected analysis changes so that cached analyses of the old prompt are not reused.
+PROMPT_VERSION = '1'
+SYSTEM_PROMPT = (
+    "You are an expert RF Analyst specializing in IQ constellation modulation diagrams. "
+    "Your task is to analyze constellation diagrams and identify:\n"
+    "1. The modulation type (e.g., QPSK, 16-QAM, 64-QAM, etc.)\n"
+    "2. Any noise or impairments present\n"
+    "3. Classification of noise/imbalance as phase noise or interference\n"
+    "4. Typical causes of the identified issues\n\n"
+    "5. Imparement severity if present (Mild/moderate/severe)\n"
+    "6. Quick recommendation (acceptable/needs attendtion/critical)\n"
+    "Do not respond in markup, respond in plain text"
+    "I will show you some examples first, then ask you to analyze a new image."
+)
+
+# Analysis result cache: JSON entries under an S3 prefix, keyed by image/model/prompt hash
+RESULT_CACHE_PREFIX = 'analysis-cache/'
+RESULT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESULT_CACHE_MEMORY_ENTRIES = 256
+
+# Image preprocessing before converse (needs Pillow; images are sent unchanged without it)
+IMAGE_MAX_EDGE = 1024          # longest edge in pixels sent to the model; 0 disables preprocessing
+IMAGE_JPEG_QUALITY = 85
+IMAGE_MAX_BYTES = 300 * 1024   # quality is lowered until an image fits
+IMAGE_MIN_JPEG_QUALITY = 45
+
+# Batch analysis: concurrent model calls over a key list or prefix
+BATCH_MAX_CONCURRENCY = 8
+BATCH_MAX_KEYS = 500
+BATCH_IMAGE_SUFFIXES = ('.jpeg', '.jpg', '.png')
+BATCH_DEADLINE_MARGIN_SECONDS = 15   # stop starting images this long before the Lambda timeout
+THROTTLING_ERRORS = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException',
+                     'ModelNotReadyException')
+
+
+def get_client(service, config=CLIENT_CONFIG, name=None):
+    """boto3 client for `service`, created once per execution environment (per `name`, default the service)"""
+    name = name or service
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = boto3.client(service, config=config)
+    return client
+
+
+def get_batch_runtime():
+    """bedrock-runtime client for batch analysis, without botocore retries (see ThrottledRuntime)"""
+    return get_client('bedrock-runtime', BATCH_RUNTIME_CONFIG, name='bedrock-runtime-batch')
+
+
+def get_model_image_id():
+    """Model id from the Lambda environment, or from the command line when run locally; parsed once"""
+    if 'model_image_id' not in _settings:
+        # this can be run either as cmd line py program or a Lambda based on the execution environment
+        execEnv = str(os.getenv('AWS_EXECUTION_ENV'))
+        if execEnv.startswith("AWS_Lambda"):
+            _settings['model_image_id'] = os.getenv('model_image_id')
+        else:
+            parser = argparse.ArgumentParser()
+            parser.add_argument("-m", "--model_image_id", help="The model_id to use for Image real time inference")
+            args, _ = parser.parse_known_args()
+            _settings['model_image_id'] = args.model_image_id
+    return _settings['model_image_id']
+
+
+def get_fewshot_settings():
+    """Few-shot prefix, optional manifest key and revalidation interval from the environment; parsed once"""
+    if 'fewshot' not in _settings:
+        _settings['fewshot'] = {
+            'prefix': os.getenv('fewshot_prefix', FEWSHOT_PREFIX),
+            'manifest': os.getenv('fewshot_manifest'),
+            'refresh_seconds': float(os.getenv('fewshot_refresh_seconds', FEWSHOT_REFRESH_SECONDS))
+        }
+    return _settings['fewshot']
+
+
+def _not_modified(error):
+    """True if a conditional get_object failed only because the object is unchanged (HTTP 304)"""
+    response = getattr(error, 'response', None) or {}
+    return (response.get('Error', {}).get('Code') in ('304', 'NotModified')
+            or response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304)
+
+
+class S3ObjectCache(object):
+    """
+    Process-level cache of small S3 objects (few-shot images and their manifest).
+    Objects are served from memory; once an entry is older than refresh_seconds it
+    is revalidated with a conditional GET (If-None-Match / If-Modified-Since), so an
+    unchanged object costs one 304 round trip per interval and a changed one is
+    replaced. If revalidation fails, the cached copy is served.
+
+    :param refresh_seconds: age before revalidation (0 = on every use, negative = never)
+    """
+
+    def __init__(self, refresh_seconds=FEWSHOT_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._entries = {}
+        self._stats_lock = threading.Lock()
+        self.stats = {'hits': 0, 'fetches': 0, 'revalidated': 0, 'stale': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def is_fresh(self, bucket, key):
+        entry = self._entries.get((bucket, key))
+        return entry is not None and (self.refresh_seconds < 0
+                                      or time.monotonic() - entry['checked'] < self.refresh_seconds)
+
+    def get(self, s3, bucket, key, transform=None):
+        """
+        Object bytes, from memory when fresh, otherwise fetched or revalidated.
+        `transform` is applied once to newly fetched bytes and its result is cached.
+        """
+        entry = self._entries.get((bucket, key))
+        if self.is_fresh(bucket, key):
+            self._count('hits')
+            return entry['body']
+
+        conditions = {}
+        if entry is not None:
+            # If-None-Match takes precedence; Last-Modified only has one-second resolution
+            if entry['etag']:
+                conditions['IfNoneMatch'] = entry['etag']
+            elif entry['last_modified']:
+                conditions['IfModifiedSince'] = entry['last_modified']
+        checked = time.monotonic()
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key, **conditions)
+        except Exception as e:
+            if entry is None:
+                raise
+            entry['checked'] = checked
+            if _not_modified(e):
+                self._count('revalidated')
+            else:
+                print(f"Revalidating s3://{bucket}/{key} failed, using cached copy: {e}")
+                self._count('stale')
+            return entry['body']
+
+        body = response['Body'].read()
+        if transform is not None:
+            body = transform(body)
+        self._entries[(bucket, key)] = {
+            'body': body,
+            'etag': response.get('ETag'),
+            'last_modified': response.get('LastModified'),
+            'checked': checked
+        }
+        self._count('fetches')
+        return body
+
+    def get_many(self, s3, bucket, keys, transform=None):
+        """Bytes for each key in order; when several need S3 they are fetched concurrently"""
+        if sum(1 for key in keys if not self.is_fresh(bucket, key)) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(keys))) as pool:
+                return list(pool.map(lambda key: self.get(s3, bucket, key, transform), keys))
+        return [self.get(s3, bucket, key, transform) for key in keys]
+
+
+def get_fewshot_cache():
+    """The process-level few-shot object cache, created on first use"""
+    global _fewshot_cache
+    if _fewshot_cache is None:
+        with _lock:
+            if _fewshot_cache is None:
+                _fewshot_cache = S3ObjectCache(get_fewshot_settings()['refresh_seconds'])
+    return _fewshot_cache
+
+
+def _image_format(data, key=''):
+    """Converse image format from the magic bytes, else from the key's extension (default jpeg)"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    extension = os.path.splitext(key)[1].lstrip('.').lower()
+    return 'jpeg' if extension in ('', 'jpg') else extension
+
+
+def get_image_settings():
+    """Image preprocessing limits from the environment; parsed once"""
+    if 'image' not in _settings:
+        _settings['image'] = {
+            'max_edge': int(os.getenv('image_max_edge', IMAGE_MAX_EDGE)),
+            'quality': int(os.getenv('image_jpeg_quality', IMAGE_JPEG_QUALITY)),
+            'max_bytes': int(os.getenv('image_max_bytes', IMAGE_MAX_BYTES)),
+            'crop': os.getenv('image_crop', 'true').lower() in ('1', 'true', 'yes')
+        }
+    return _settings['image']
+
+
+def _load_pillow():
+    """PIL.Image, or None when Pillow is not packaged with the function"""
+    if 'pillow' not in _settings:
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Pillow is not available, images are sent to the model without preprocessing")
+            Image = None
+        _settings['pillow'] = Image
+    return _settings['pillow']
+
+
+def _crop_to_content(image, threshold=24, pad=8):
+    """Trim the margin whose colour matches the top-left (background) pixel, keeping `pad` pixels around the plot"""
+    gray = image.convert('L')
+    background = gray.getpixel((0, 0))
+    # threshold absorbs JPEG noise in the background
+    box = gray.point(lambda value: 255 if abs(value - background) > threshold else 0).getbbox()
+    if box is None:
+        return image
+    width, height = image.size
+    box = (max(0, box[0] - pad), max(0, box[1] - pad), min(width, box[2] + pad), min(height, box[3] + pad))
+    return image if box == (0, 0, width, height) else image.crop(box)
+
+
+class ImagePreprocessor(object):
+    """
+    Shrinks images before they are sent to the model: trims the background margin
+    around the plot, downsizes so the longer edge is at most max_edge and re-encodes
+    as JPEG, lowering the quality step by step until the image fits max_bytes. The
+    original bytes are sent when Pillow is missing, the image cannot be decoded, or
+    re-encoding an image that needed no crop or resize would not make it smaller.
+
+    :param max_edge: longest edge in pixels; 0 disables preprocessing
+    :param quality: starting JPEG quality
+    :param max_bytes: size budget for an encoded image
+    :param crop: trim the background margin
+    """
+
+    def __init__(self, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY, max_bytes=IMAGE_MAX_BYTES, crop=True):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.crop = crop
+        self._lock = threading.Lock()
+        self.stats = {'images': 0, 'bytes_in': 0, 'bytes_out': 0, 'pixels_in': 0, 'pixels_out': 0, 'ms': 0.0}
+
+    @property
+    def enabled(self):
+        return self.max_edge > 0 and _load_pillow() is not None
+
+    def fingerprint(self):
+        """Settings that change what the model sees, for the result cache key"""
+        return f'{self.max_edge}/{self.quality}/{self.max_bytes}/{self.crop}' if self.enabled else 'original'
+
+    def process(self, data):
+        """Preprocessed image bytes (or `data` unchanged), with sizes added to the stats"""
+        if not self.enabled:
+            return data
+        start = time.perf_counter()
+        try:
+            output, size_in, size_out = self._shrink(data)
+        except Exception as e:
+            print(f"Image preprocessing failed, sending the original: {e}")
+            return data
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.stats['images'] += 1
+            self.stats['bytes_in'] += len(data)
+            self.stats['bytes_out'] += len(output)
+            self.stats['pixels_in'] += size_in[0] * size_in[1]
+            self.stats['pixels_out'] += size_out[0] * size_out[1]
+            self.stats['ms'] += elapsed_ms
+        print(f"Image preprocessed: {len(data)} -> {len(output)} bytes, "
+              f"{size_in[0]}x{size_in[1]} -> {size_out[0]}x{size_out[1]} px in {elapsed_ms:.0f} ms")
+        return output
+
+    def _shrink(self, data):
+        Image = _load_pillow()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        size_in = image.size
+        if image.mode not in ('RGB', 'L'):
+            # flatten transparency onto white, as the plots are drawn
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, 'white')
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        if self.crop:
+            image = _crop_to_content(image)
+        image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+
+        quality = self.quality
+        while True:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+            output = buffer.getvalue()
+            if len(output) <= self.max_bytes or quality <= IMAGE_MIN_JPEG_QUALITY:
+                break
+            quality -= 10
+
+        if image.size == size_in and len(output) >= len(data):
+            return data, size_in, size_in
+        return output, size_in, image.size
+
+    def report(self):
+        """Cumulative sizes, for the invocation log line"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['ms'] = round(stats['ms'], 1)
+        return stats
+
+
+def get_preprocessor():
+    """The process-level image preprocessor, created on first use"""
+    global _preprocessor
+    if _preprocessor is None:
+        with _lock:
+            if _preprocessor is None:
+                settings = get_image_settings()
+                _preprocessor = ImagePreprocessor(settings['max_edge'], settings['quality'], settings['max_bytes'],
+                                                  settings['crop'])
+    return _preprocessor
+
+
+def get_fewshot_examples(s3, bucket_name):
+    """(image format, image bytes, answer) for each few-shot example, served from the process-level cache"""
+    settings = get_fewshot_settings()
+    cache = get_fewshot_cache()
+    if settings['manifest']:
+        examples = json.loads(cache.get(s3, bucket_name, settings['manifest']))
+    else:
+        examples = DEFAULT_FEWSHOT_EXAMPLES
+
+    keys = [settings['prefix'] + example['key'] for example in examples]
+    # Few-shot images are preprocessed once, when they enter the cache
+    images = cache.get_many(s3, bucket_name, keys, transform=get_preprocessor().process)
+    return [(_image_format(image, example['key']), image, example['answer'])
+            for example, image in zip(examples, images)]
+
+
+def get_result_cache_settings():
+    """Result cache bucket, prefix and TTL from the environment; parsed once"""
+    if 'result_cache' not in _settings:
+        _settings['result_cache'] = {
+            'bucket': os.getenv('result_cache_bucket'),
+            'prefix': os.getenv('result_cache_prefix', RESULT_CACHE_PREFIX),
+            'ttl_seconds': float(os.getenv('result_cache_ttl_seconds', RESULT_CACHE_TTL_SECONDS))
+        }
+    return _settings['result_cache']
+
+
+def prompt_fingerprint(examples):
+    """
+    Hash of everything besides the target image that shapes an analysis: prompt
+    version, system prompt, image preprocessing settings and few-shot examples
+    """
+    digest = hashlib.sha256(f'{PROMPT_VERSION}\0{SYSTEM_PROMPT}\0{get_preprocessor().fingerprint()}'.encode())
+    for image_format, image, answer in examples:
+        digest.update(image_format.encode())
+        digest.update(hashlib.sha256(image).digest())
+        digest.update(answer.encode())
+    return digest.hexdigest()
+
+
+def _missing_object(error):
+    """True if get_object failed because the key does not exist (403 without s3:ListBucket)"""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in ('NoSuchKey', '404', 'AccessDenied', '403')
+
+
+class AnalysisCache(object):
+    """
+    Cache of model analyses keyed by a hash of the image bytes, the model id and the
+    prompt fingerprint. Entries are JSON objects under an S3 prefix, shared by every
+    execution environment and by re-uploads of the same image under other keys, with
+    a small in-memory LRU in front. Entries older than ttl_seconds count as misses.
+    Cache errors are logged and never fail an analysis.
+
+    :param bucket: bucket for the entries (None = the bucket of the analyzed image)
+    :param prefix: key prefix for the entries
+    :param ttl_seconds: entry lifetime in seconds; 0 or negative disables the cache
+    :param memory_entries: entries kept in memory per execution environment
+    """
+
+    def __init__(self, bucket=None, prefix=RESULT_CACHE_PREFIX, ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+                 memory_entries=RESULT_CACHE_MEMORY_ENTRIES):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0, 'errors': 0}
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def key(self, image_data, model_id, prompt_hash):
+        """S3 key for an analysis; entries of one model and prompt share a sub-prefix"""
+        group = hashlib.sha256(f'{model_id}\0{prompt_hash}'.encode()).hexdigest()[:16]
+        return f'{self.prefix}{group}/{hashlib.sha256(image_data).hexdigest()}.json'
+
+    def get(self, s3, bucket, key):
+        """Cached analysis text, or None on a miss"""
+        self._count('lookups')
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is None:
+            try:
+                entry = json.loads(s3.get_object(Bucket=self.bucket or bucket, Key=key)['Body'].read())
+            except Exception as e:
+                if not _missing_object(e):
+                    print(f"Analysis cache read failed for {key}: {e}")
+                    self._count('errors')
+                entry = None
+
+        if entry is not None and time.time() - entry['created'] > self.ttl_seconds:
+            with self._lock:
+                self._memory.pop(key, None)
+            self._count('expired')
+            entry = None
+        if entry is None:
+            self._count('misses')
+            return None
+
+        self._remember(key, entry)
+        self._count('hits')
+        return entry['result']
+
+    def put(self, s3, bucket, key, result, **metadata):
+        """Store an analysis (with metadata such as the model id) in memory and in S3"""
+        entry = dict(metadata, result=result, created=time.time())
+        self._remember(key, entry)
+        try:
+            s3.put_object(Bucket=self.bucket or bucket, Key=key, Body=json.dumps(entry).encode(),
+                          ContentType='application/json')
+            self._count('stores')
+        except Exception as e:
+            print(f"Analysis cache write failed for {key}: {e}")
+            self._count('errors')
+
+    def report(self):
+        """Counters plus hit rate, for the invocation log line"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['hit_rate'] = round(stats['hits'] / stats['lookups'], 3) if stats['lookups'] else None
+        return stats
+
+
+def get_analysis_cache():
+    """The process-level analysis result cache, created on first use"""
+    global _analysis_cache
+    if _analysis_cache is None:
+        with _lock:
+            if _analysis_cache is None:
+                settings = get_result_cache_settings()
+                _analysis_cache = AnalysisCache(settings['bucket'], settings['prefix'], settings['ttl_seconds'])
+    return _analysis_cache
+
+
+def analyze_image(s3, bedrock, bucket_name, image_data, model_image_id):
+    """Analysis text for one constellation image, from the result cache or a few-shot converse call"""
+    examples = get_fewshot_examples(s3, bucket_name)
+
+    cache = get_analysis_cache()
+    if cache.enabled:
+        cache_key = cache.key(image_data, model_image_id, prompt_fingerprint(examples))
+        result = cache.get(s3, bucket_name, cache_key)
+        if result is not None:
+            print(f"Analysis cache hit: {cache_key}")
+            return result
+
+    image_data = get_preprocessor().process(image_data)
+    print(f"Converse request: {len(examples) + 1} images, "
+          f"{sum(len(image) for _, image, _ in examples) + len(image_data)} image bytes")
+
+    # Few-shot examples (user image + expected assistant analysis), then the target image
+    messages = []
+    for image_format, image, answer in examples:
+        messages.append({
+            'role': 'user',
+            'content': [
+                {
+                    'image': {
+                        'format': image_format,
+                        'source': {'bytes': image}
+                    }
+                },
+                {
+                    'text': 'Analyze this IQ constellation diagram.'
+                }
+            ]
+        })
+        messages.append({
+            'role': 'assistant',
+            'content': [{'text': answer}]
+        })
+
+    # Actual query with the target image
+    messages.append({
+        'role': 'user',
+        'content': [
+            {
+                'image': {
+                    'format': _image_format(image_data),
+                    'source': {'bytes': image_data}
+                }
             },
-            # Actual query with the target image
             {
-                'role': 'user',
-                'content': [
-                    {
-                        'image': {
-                            'format': 'jpeg',
-                            'source': {'bytes': image_data}
-                        }
-                    },
-                    {
-                        'text': (
-                            'Now analyze this IQ constellation diagram. '
-                        )
-                    }
-                ]
+                'text': (
+                    'Now analyze this IQ constellation diagram. '
+                )
             }
         ]
+    })
+
+    # Use converse API with few-shot examples
+    response = bedrock.converse(
+        modelId=model_image_id,
+        system=[{'text': SYSTEM_PROMPT}],
+        messages=messages
     )
     
     result = response['output']['message']['content'][0]['text']
+
+    if cache.enabled:
+        cache.put(s3, bucket_name, cache_key, result, model_id=model_image_id, prompt_version=PROMPT_VERSION)
+    return result
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limit on concurrent model calls that adapts to throttling (additive increase,
+    multiplicative decrease): the limit is halved on every throttling error and
+    raised by one after `increase_after` consecutive successes, up to `limit`.
+
+    :param limit: maximum (and starting) number of concurrent calls
+    :param increase_after: successes before the limit is raised again
+    """
+
+    def __init__(self, limit=BATCH_MAX_CONCURRENCY, increase_after=4):
+        self.max_limit = max(1, limit)
+        self.limit = self.max_limit
+        self.increase_after = increase_after
+        self.active = 0
+        self.throttles = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            self.throttles += 1
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+
+class ThrottledRuntime(object):
+    """
+    bedrock-runtime wrapper for batch analysis: converse calls share an
+    AdaptiveConcurrency limit, and throttling errors are retried with exponential
+    backoff and full jitter. Wrap a client without botocore retries
+    (get_batch_runtime), so every throttled attempt reaches the limiter and
+    retries do not multiply.
+
+    :param runtime: bedrock-runtime client, or any object with a compatible converse method
+    :param limiter: AdaptiveConcurrency shared by all calls of the batch
+    :param max_attempts: attempts per call before a throttling error is raised
+    :param backoff_base: first backoff ceiling in seconds, doubled per attempt
+    :param backoff_max: cap on the backoff ceiling in seconds
+    """
+
+    def __init__(self, runtime, limiter, max_attempts=4, backoff_base=1.0, backoff_max=20.0):
+        self.runtime = runtime
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def converse(self, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            with self.limiter:
+                try:
+                    response = self.runtime.converse(**kwargs)
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS or attempt == self.max_attempts:
+                        raise
+                    self.limiter.throttled()
+                else:
+                    self.limiter.succeeded()
+                    return response
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))))
+
+
+class StubBedrockRuntime(object):
+    """
+    Local stand-in for the bedrock-runtime client, for exercising batch analysis
+    without Bedrock: converse waits `latency` seconds and returns a canned
+    analysis, or raises ThrottlingException for a `throttle_rate` share of calls.
+
+    :param latency: seconds per converse call
+    :param throttle_rate: fraction of calls (0-1) that are throttled
+    :param seed: random seed for the throttled calls
+    """
+
+    def __init__(self, latency=0.5, throttle_rate=0.0, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def converse(self, modelId, system, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+            throttle = self._random.random() < self.throttle_rate
+        time.sleep(self.latency)
+        if throttle:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded (stub)'}}, 'Converse')
+        image = messages[-1]['content'][0]['image']['source']['bytes']
+        return {'output': {'message': {'role': 'assistant', 'content': [
+            {'text': f'Stub analysis of a {len(image)} byte image by {modelId}'}]}}}
+
+
+def list_image_keys(s3, bucket_name, prefix, max_keys=BATCH_MAX_KEYS):
+    """Image keys (by suffix) under `prefix`, in listing order, at most max_keys"""
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].lower().endswith(BATCH_IMAGE_SUFFIXES):
+                keys.append(item['Key'])
+                if len(keys) >= max_keys:
+                    return keys
+    return keys
+
+
+def iter_batch_analyses(s3, bedrock, bucket_name, image_keys, model_image_id, max_concurrency=BATCH_MAX_CONCURRENCY,
+                        deadline=None, limiter=None):
+    """
+    Analyze image_keys concurrently and yield one result dict per image as soon as it
+    finishes (completion order): {'image_key', 'status': 'ok' | 'error' | 'skipped',
+    'result' or 'error', 'elapsed_ms'}. Model calls go through a ThrottledRuntime;
+    images not started before `deadline` (time.monotonic()) are skipped.
+    """
+    limiter = limiter or AdaptiveConcurrency(max_concurrency)
+    runtime = ThrottledRuntime(bedrock, limiter)
+
+    def analyze(image_key):
+        if deadline is not None and time.monotonic() > deadline:
+            return {'image_key': image_key, 'status': 'skipped'}
+        start = time.perf_counter()
+        try:
+            image_data = s3.get_object(Bucket=bucket_name, Key=image_key)['Body'].read()
+            outcome = {'image_key': image_key, 'status': 'ok',
+                       'result': analyze_image(s3, runtime, bucket_name, image_data, model_image_id)}
+        except Exception as e:
+            outcome = {'image_key': image_key, 'status': 'error', 'error': str(e)}
+        outcome['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return outcome
+
+    # Load the few-shot examples once before the workers start
+    get_fewshot_examples(s3, bucket_name)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        futures = [pool.submit(analyze, image_key) for image_key in image_keys]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def analyze_batch(event, context, model_image_id):
+    """
+    Batch event: {'bucket_name', 'image_keys': [...] or 'image_prefix': ..., optional
+    'max_concurrency' and 'output_prefix'}. Each result is logged, and written to
+    <output_prefix><image name>.json when output_prefix is set, as soon as it finishes.
+    A result that cannot be written is reported as an error, with the analysis kept.
+    """
+    s3 = get_client('s3')
+    bedrock = get_batch_runtime()
+    bucket_name = event['bucket_name']
+
+    image_keys = event.get('image_keys') or list_image_keys(s3, bucket_name, event['image_prefix'])
+    max_concurrency = int(event.get('max_concurrency', BATCH_MAX_CONCURRENCY))
+    output_prefix = event.get('output_prefix')
+
+    deadline = None
+    remaining_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining_ms is not None:
+        deadline = time.monotonic() + remaining_ms() / 1000 - BATCH_DEADLINE_MARGIN_SECONDS
+
+    print(f"Batch analysis of {len(image_keys)} images in {bucket_name} (max concurrency {max_concurrency})")
+    limiter = AdaptiveConcurrency(max_concurrency)
+    results = []
+    for outcome in iter_batch_analyses(s3, bedrock, bucket_name, image_keys, model_image_id, max_concurrency,
+                                       deadline, limiter):
+        if output_prefix and outcome['status'] == 'ok':
+            name = os.path.splitext(os.path.basename(outcome['image_key']))[0]
+            output_key = f'{output_prefix}{name}.json'
+            try:
+                s3.put_object(Bucket=bucket_name, Key=output_key, Body=json.dumps(outcome).encode(),
+                              ContentType='application/json')
+            except Exception as e:
+                print(f"Batch result write failed for {output_key}: {e}")
+                outcome = dict(outcome, status='error', error=f"result write to {output_key} failed: {e}")
+        print(json.dumps({k: v for k, v in outcome.items() if k != 'result'}))
+        results.append(outcome)
+
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in ('ok', 'error', 'skipped')}
+    return {
+        'bucket_name': bucket_name,
+        'analyzed': counts['ok'],
+        'failed': counts['error'],
+        'skipped': counts['skipped'],
+        'throttled': limiter.throttles,
+        'results': results
+    }
+
+
+def lambda_handler(event, context):
+    global _invocations
+    _invocations += 1
+    cold_start = _invocations == 1
+    start = time.perf_counter()
+    try:
+        return analyze_event(event, context)
+    finally:
+        print(json.dumps({
+            'timer': 'constellation_analysis',
+            'cold_start': cold_start,
+            'init_ms': round((start - INIT_START) * 1000, 1) if cold_start else 0.0,
+            'request_ms': round((time.perf_counter() - start) * 1000, 1),
+            'invocation': _invocations,
+            'fewshot_cache': dict(_fewshot_cache.stats) if _fewshot_cache else None,
+            'result_cache': _analysis_cache.report() if _analysis_cache else None,
+            'image_preprocessing': _preprocessor.report() if _preprocessor else None
+        }))
+
+
+def analyze_event(event, context=None):
+
+    model_image_id = get_model_image_id()
+
+    if model_image_id is None:
+        print("Invalid model_image_id")
+        return -1
+    else:
+        print(" Image model id: ", model_image_id)
+
+    # Batch of images: a key list or a prefix, analyzed concurrently
+    if 'image_keys' in event or 'image_prefix' in event:
+        return analyze_batch(event, context, model_image_id)
+
+    # Check if this is a Bedrock Agent request
+    is_bedrock_agent = 'messageVersion' in event and 'actionGroup' in event
+    
+    if is_bedrock_agent:
+        # Extract from OpenAPI schema request body properties
+        request_body = event['requestBody']['content']['application/json']['properties']
+
+        print(request_body)
+
+        params = {}
+        for param in request_body:
+            name = param.get('name')
+            value = param.get('value')
+            params[name] = value
+
+        bucket_name = params['bucket_name']
+        image_key = params['image_key']
+
+        print(f"Bucket Name: {bucket_name}, Image Key: {image_key}")
+
+    else:
+        # Extract from direct Lambda event
+        bucket_name = event['bucket_name']
+        image_key = event['image_key']
+    
+    s3 = get_client('s3')
+    bedrock = get_client('bedrock-runtime')
+    
+    # Get the target image from S3
+    response = s3.get_object(Bucket=bucket_name, Key=image_key)
+    image_data = response['Body'].read()
+
+    result = analyze_image(s3, bedrock, bucket_name, image_data, model_image_id)
     
     # Return appropriate response format
     if is_bedrock_agent:
@@ -221,7 +921,43 @@ def lambda_handler(event, context):
         return result
 
 
+def run_batch(args):
+    """Command line batch analysis, printing each result as soon as it finishes"""
+    model_image_id = get_model_image_id()
+    if args.stub:
+        _clients['bedrock-runtime-batch'] = StubBedrockRuntime(args.stub_latency, args.stub_throttle_rate)
+        model_image_id = model_image_id or 'stub-model'
+        # stub answers must never be cached, or later runs of the real model would be served them
+        _settings['result_cache'] = dict(get_result_cache_settings(), ttl_seconds=0)
+        print("Stub runtime: analysis result cache disabled")
+
+    s3 = get_client('s3')
+    image_keys = args.keys or list_image_keys(s3, args.bucket, args.prefix or '')
+    limiter = AdaptiveConcurrency(args.max_concurrency)
+    start = time.perf_counter()
+    for outcome in iter_batch_analyses(s3, get_batch_runtime(), args.bucket, image_keys, model_image_id,
+                                       args.max_concurrency, limiter=limiter):
+        print(json.dumps(outcome))
+    print(f"Analyzed {len(image_keys)} images in {time.perf_counter() - start:.1f} s "
+          f"({limiter.throttles} throttled calls, final concurrency {limiter.limit})")
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Analyze IQ constellation images with Amazon Bedrock')
+    parser.add_argument("-m", "--model_image_id", help="The model_id to use for Image real time inference")
+    parser.add_argument("--bucket", help="Analyze a batch of images from this bucket instead of the test events")
+    parser.add_argument("--prefix", help="Batch: analyze the images under this prefix")
+    parser.add_argument("--keys", nargs='+', help="Batch: analyze these image keys")
+    parser.add_argument("--max-concurrency", type=int, default=BATCH_MAX_CONCURRENCY, help="Batch: concurrent model calls")
+    parser.add_argument("--stub", action='store_true', help="Use a local stub instead of the Bedrock runtime")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="Stub: seconds per model call")
+    parser.add_argument("--stub-throttle-rate", type=float, default=0.0, help="Stub: fraction of throttled calls")
+    args = parser.parse_args()
+
+    if args.bucket:
+        run_batch(args)
+        return
+
     # Test direct Lambda path
     lambda_event = {
         'bucket_name': 'iq-constellation-images',
@@ -0,0 +1,313 @@
+import struct
+from decimal import Decimal, InvalidOperation
+
+##################
+# streaming capture parser - incremental parser for classic pcap (microsecond and
+# nanosecond) and pcapng enhanced packet blocks. Bytes are fed in chunks of any
+# size and records are yielded as soon as they are complete; timestamps are kept
+# as integer nanoseconds internally
+##################
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+PCAPNG_SHB = 0x0a0d0d0a             # section header block
+PCAPNG_IDB = 0x00000001             # interface description block
+PCAPNG_EPB = 0x00000006             # enhanced packet block
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_BYTE_ORDER_MAGIC_SWAPPED = 0x4d3c2b1a
+PCAPNG_MIN_BLOCK_LEN = 12
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+PCAPNG_OPT_IF_TSOFFSET = 14
+PCAPNG_DEFAULT_TSRESOL = 6          # microseconds
+MAX_CAPLEN = 262144                 # libpcap's largest snaplen, longer records are corrupt headers
+MAX_PCAPNG_BLOCK_LEN = 16 * 2**20   # larger pcapng blocks are corrupt headers
+
+NANOSECONDS_PER_SECOND = 10**9
+FILE_READ_SIZE = 2**20
+
+FORMAT_PCAP = "pcap"
+FORMAT_PCAPNG = "pcapng"
+
+
+class CaptureFormatError(ValueError):
+    pass
+
+
+def ns_to_seconds(ts_ns: int):
+    """Float seconds of an integer nanosecond timestamp"""
+    sec, nsec = divmod(ts_ns, NANOSECONDS_PER_SECOND)
+    return sec + nsec / 1e9
+
+
+def seconds_to_ns(seconds):
+    """
+    Integer nanoseconds of a timestamp in seconds, given as a number or a decimal
+    string. Floats are converted through their shortest decimal form, so
+    1700000000.0045 becomes 1700000000004500000 rather than the nearest binary value.
+    """
+    try:
+        return int(Decimal(str(seconds)) * NANOSECONDS_PER_SECOND)
+    except InvalidOperation:
+        raise ValueError(f"invalid timestamp {seconds!r}")
+
+
+def _ticks_to_ns(tsresol: int):
+    """Function converting pcapng timestamp units of an if_tsresol value to nanoseconds"""
+    if tsresol & 0x80:
+        # negative power of two
+        denominator = 1 << (tsresol & 0x7f)
+        return lambda ticks: ticks * NANOSECONDS_PER_SECOND // denominator
+    if tsresol <= 9:
+        factor = 10**(9 - tsresol)
+        return lambda ticks: ticks * factor
+    divisor = 10**(tsresol - 9)
+    return lambda ticks: ticks // divisor
+
+
+class PcapngInterface(object):
+    """Timestamp settings of one pcapng interface description block"""
+
+    def __init__(self, linktype: int, snaplen: int, tsresol: int=PCAPNG_DEFAULT_TSRESOL, tsoffset: int=0):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.tsresol = tsresol
+        self.tsoffset_ns = tsoffset * NANOSECONDS_PER_SECOND
+        self.ticks_to_ns = _ticks_to_ns(tsresol)
+
+
+class CaptureStreamParser(object):
+    """
+    Push parser for pcap/pcapng byte streams. feed() takes the next chunk of the
+    capture and yields the (ts, buf) records completed by it; records may straddle
+    any number of chunk boundaries. The format is detected from the first bytes.
+
+    After each record, data_offset is the capture offset of its frame bytes.
+
+    A capture cut short (stopped tcpdump, timed out upload) or a corrupt record
+    header ends the records with a warning, like dpkt; strict=True raises
+    CaptureFormatError instead.
+
+    :param ns_timestamps: yield integer nanosecond timestamps instead of float seconds
+    :param strict: raise on truncated or corrupt records instead of stopping there
+    """
+
+    def __init__(self, ns_timestamps: bool=False, strict: bool=False):
+        self.ns_timestamps = ns_timestamps
+        self.strict = strict
+        self.stopped = False
+        self.format = None
+        self.linktype = None
+        self.records = 0
+        self._pending = bytearray()
+        self._endian = "<"
+        self._record_header = None
+        self._frac_to_ns = 1
+        self._interfaces = []
+        self._pos = 0
+        self._base = 0       # capture offset of the first pending byte
+        self._data_pos = 0   # pending offset of the last record's frame bytes
+        self.data_offset = None
+
+    def _timestamp(self, ts_ns: int):
+        if self.ns_timestamps:
+            return ts_ns
+        return ns_to_seconds(ts_ns)
+
+    def feed(self, chunk):
+        """Append the next chunk and return an iterator over the records it completes"""
+        self._pending += chunk
+        return self._drain()
+
+    def _drain(self):
+        pending = self._pending
+        self._pos = 0
+        try:
+            if self.stopped:
+                self._pos = len(pending)
+                return
+            if self.format is None:
+                if len(pending) < PCAP_GLOBAL_HEADER_LEN:
+                    return
+                self._pos = self._read_file_header(pending)
+            records = self._pcap_records(pending) if self.format == FORMAT_PCAP else self._pcapng_records(pending)
+            try:
+                for ts_ns, buf in records:
+                    self.records += 1
+                    self.data_offset = self._base + self._data_pos
+                    yield self._timestamp(ts_ns), buf
+            except CaptureFormatError as e:
+                if self.strict:
+                    raise
+                print(f"Warning: {e}, ignoring the rest of the capture after {self.records} records")
+                self.stopped = True
+                self._pos = len(pending)
+        finally:
+            # drop everything parsed so far, also when the consumer stops early
+            del pending[:self._pos]
+            self._base += self._pos
+
+    def seek(self, offset: int):
+        """
+        Continue at the record-aligned capture `offset`, dropping any buffered bytes.
+        Classic pcap only, once its file header has been fed: pcapng records also
+        depend on the interface blocks before them.
+        """
+        if self.format != FORMAT_PCAP:
+            raise CaptureFormatError("only classic pcap captures can be parsed from an offset")
+        self._pending.clear()
+        self._base = offset
+
+    def close(self):
+        """Report a capture that ends in the middle of a record (raise if strict)"""
+        if self._pending:
+            message = f"capture ends with a truncated record ({len(self._pending)} bytes)"
+            if self.strict:
+                raise CaptureFormatError(message)
+            print(f"Warning: {message}, ignored after {self.records} records")
+            self._pending.clear()
+
+    def _read_file_header(self, pending):
+        (magic,) = struct.unpack_from("<I", pending, 0)
+        if magic == PCAPNG_SHB:
+            self.format = FORMAT_PCAPNG
+            return 0  # the section header block is parsed as a regular block
+        for endian in ("<", ">"):
+            (magic,) = struct.unpack_from(endian + "I", pending, 0)
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                self.format = FORMAT_PCAP
+                self._endian = endian
+                self._record_header = struct.Struct(endian + "IIII")
+                self._frac_to_ns = 1 if magic == PCAP_MAGIC_NSEC else 1000
+                (self.linktype,) = struct.unpack_from(endian + "I", pending, 20)
+                return PCAP_GLOBAL_HEADER_LEN
+        raise CaptureFormatError("not a pcap or pcapng capture (magic 0x%08x)" % magic)
+
+    def _pcap_records(self, pending):
+        record_header = self._record_header
+        frac_to_ns = self._frac_to_ns
+        end_of_data = len(pending)
+        pos = self._pos
+        while end_of_data - pos >= PCAP_RECORD_HEADER_LEN:
+            (ts_sec, ts_frac, caplen, orig_len) = record_header.unpack_from(pending, pos)
+            if caplen > MAX_CAPLEN:
+                raise CaptureFormatError(f"corrupt record header at offset {self._base + pos} (caplen {caplen})")
+            end = pos + PCAP_RECORD_HEADER_LEN + caplen
+            if end > end_of_data:
+                return
+            buf = bytes(pending[pos + PCAP_RECORD_HEADER_LEN:end])
+            self._data_pos = pos + PCAP_RECORD_HEADER_LEN
+            pos = self._pos = end
+            yield ts_sec * NANOSECONDS_PER_SECOND + ts_frac * frac_to_ns, buf
+
+    def _pcapng_records(self, pending):
+        end_of_data = len(pending)
+        pos = self._pos
+        while end_of_data - pos >= PCAPNG_MIN_BLOCK_LEN:
+            (block_type,) = struct.unpack_from("<I", pending, pos)  # the SHB type reads the same in both byte orders
+            if block_type == PCAPNG_SHB:
+                (byte_order,) = struct.unpack_from("<I", pending, pos + 8)
+                if byte_order == PCAPNG_BYTE_ORDER_MAGIC:
+                    self._endian = "<"
+                elif byte_order == PCAPNG_BYTE_ORDER_MAGIC_SWAPPED:
+                    self._endian = ">"
+                else:
+                    raise CaptureFormatError("invalid pcapng byte-order magic")
+            endian = self._endian
+            (block_type, block_len) = struct.unpack_from(endian + "II", pending, pos)
+            if block_len < PCAPNG_MIN_BLOCK_LEN or block_len % 4 or block_len > MAX_PCAPNG_BLOCK_LEN:
+                raise CaptureFormatError(f"invalid pcapng block length {block_len} at offset {self._base + pos}")
+            end = pos + block_len
+            if end > end_of_data:
+                return
+            body = pos + 8
+            record = None
+            if block_type == PCAPNG_EPB:
+                (interface_id, ts_high, ts_low, caplen, orig_len) = struct.unpack_from(endian + "IIIII", pending, body)
+                if interface_id >= len(self._interfaces):
+                    raise CaptureFormatError(f"enhanced packet block for undeclared interface {interface_id}")
+                interface = self._interfaces[interface_id]
+                ts_ns = interface.ticks_to_ns((ts_high << 32) | ts_low) + interface.tsoffset_ns
+                record = (ts_ns, bytes(pending[body + 20:body + 20 + caplen]))
+                self._data_pos = body + 20
+            elif block_type == PCAPNG_IDB:
+                self._interfaces.append(self._read_interface(pending, body, end - 4))
+            elif block_type == PCAPNG_SHB:
+                self._interfaces = []  # interface IDs are numbered per section
+            # other blocks (statistics, name resolution, simple packets, ...) are skipped
+            pos = self._pos = end
+            if record is not None:
+                yield record
+
+    def _read_interface(self, pending, body, end):
+        endian = self._endian
+        (linktype, _, snaplen) = struct.unpack_from(endian + "HHI", pending, body)
+        if self.linktype is None:
+            self.linktype = linktype
+        tsresol = PCAPNG_DEFAULT_TSRESOL
+        tsoffset = 0
+        pos = body + 8
+        while pos + 4 <= end:
+            (code, length) = struct.unpack_from(endian + "HH", pending, pos)
+            if code == PCAPNG_OPT_ENDOFOPT:
+                break
+            if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+                tsresol = pending[pos + 4]
+            elif code == PCAPNG_OPT_IF_TSOFFSET and length >= 8:
+                (tsoffset,) = struct.unpack_from(endian + "q", pending, pos + 4)
+            pos += 4 + (length + 3) // 4 * 4
+        return PcapngInterface(linktype, snaplen, tsresol, tsoffset)
+
+
+class CaptureRecordStream(object):
+    """
+    Iterator of the (ts, buf) records of a capture given as an iterable of byte
+    chunks. `linktype` is known once the first record has been yielded.
+    """
+
+    def __init__(self, chunks, ns_timestamps: bool=False, strict: bool=False):
+        self.parser = CaptureStreamParser(ns_timestamps=ns_timestamps, strict=strict)
+        self._records = self._iter_records(chunks)
+
+    @property
+    def linktype(self):
+        return self.parser.linktype
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._records)
+
+    def _iter_records(self, chunks):
+        for chunk in chunks:
+            yield from self.parser.feed(chunk)
+        self.parser.close()
+
+
+def iter_capture_chunks(chunks, ns_timestamps: bool=False, strict: bool=False):
+    """(ts, buf) records of a pcap/pcapng capture given as an iterable of byte chunks"""
+    return CaptureRecordStream(chunks, ns_timestamps=ns_timestamps, strict=strict)
+
+
+def _iter_file_chunks(filename: str, read_size: int):
+    with open(filename, 'rb') as f:
+        yield from iter(lambda: f.read(read_size), b"")
+
+
+def iter_capture_file(filename: str, ns_timestamps: bool=False, read_size: int=FILE_READ_SIZE, strict: bool=False):
+    """(ts, buf) records of a local pcap/pcapng file"""
+    return CaptureRecordStream(_iter_file_chunks(filename, read_size), ns_timestamps=ns_timestamps, strict=strict)
+
+
+def capture_file_linktype(filename: str, read_size: int=2**16):
+    """Link type of a local pcap/pcapng file (of its first interface for pcapng), None if it has no records"""
+    parser = CaptureStreamParser()
+    for chunk in _iter_file_chunks(filename, read_size):
+        next(parser.feed(chunk), None)
+        if parser.linktype is not None:
+            break
+    return parser.linktype
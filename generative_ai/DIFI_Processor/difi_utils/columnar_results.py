@@ -0,0 +1,163 @@
+import numpy as np
+
+##################
+# columnar result builder - appends decoded packet fields into growable typed
+# column arrays instead of keeping a dict (and copies of it) per packet
+##################
+
+COMPLIANCE_LOG_KEYS = ["pcap_timestamp", "pcap_index", "pkt_type"]
+COMMON_FIELD_LOG_KEYS = ["pcap_timestamp", "pcap_index", "pkt_type", "class_id", "tsm", "tsi", "tsf", "seq_num", "pkt_size"]
+DEFAULT_EXCLUDE_FIELDS = ("samples",)  # IQ payloads are large, use ring buffers / spectra for those
+INITIAL_CAPACITY = 1024
+
+_KIND_INT = "int"
+_KIND_FLOAT = "float"
+_KIND_BOOL = "bool"
+_KIND_OBJECT = "object"
+
+_KIND_DTYPES = {_KIND_INT: np.int64, _KIND_FLOAT: np.float64, _KIND_BOOL: np.bool_, _KIND_OBJECT: object}
+
+
+def _value_kind(value):
+    if isinstance(value, (bool, np.bool_)):
+        return _KIND_BOOL
+    if isinstance(value, (int, np.integer)) and -2**63 <= value < 2**63:
+        return _KIND_INT
+    if isinstance(value, (float, np.floating)):
+        return _KIND_FLOAT
+    return _KIND_OBJECT
+
+
+def _fits(kind, value):
+    value_kind = _value_kind(value)
+    return value_kind == kind or (kind == _KIND_FLOAT and value_kind == _KIND_INT) or kind == _KIND_OBJECT
+
+
+class ColumnTable(object):
+    """
+    Table of named, growable NumPy columns. A column's dtype comes from its first
+    value (int64, float64, bool or object) and is widened to float64/object if a
+    later value or a missing field does not fit.
+    """
+
+    def __init__(self, initial_capacity: int=INITIAL_CAPACITY):
+        self.columns = {}
+        self.kinds = {}
+        self.size = 0
+        self.capacity = initial_capacity
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.empty(self.capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def _set_kind(self, name, kind):
+        column = self.columns[name]
+        widened = np.empty(self.capacity, dtype=_KIND_DTYPES[kind])
+        widened[:self.size] = column[:self.size]
+        self.columns[name] = widened
+        self.kinds[name] = kind
+
+    def _add_column(self, name, value):
+        kind = _value_kind(value)
+        if self.size > 0 and kind in (_KIND_INT, _KIND_BOOL):
+            # earlier rows had no value for this field
+            kind = _KIND_OBJECT
+        column = np.empty(self.capacity, dtype=_KIND_DTYPES[kind])
+        if kind == _KIND_FLOAT:
+            column[:self.size] = np.nan
+        elif kind == _KIND_OBJECT:
+            column[:self.size] = None
+        self.columns[name] = column
+        self.kinds[name] = kind
+
+    def _fill_missing(self, present):
+        for name, kind in list(self.kinds.items()):
+            if name in present:
+                continue
+            if kind in (_KIND_INT, _KIND_BOOL):
+                self._set_kind(name, _KIND_OBJECT)
+                kind = _KIND_OBJECT
+            self.columns[name][self.size] = np.nan if kind == _KIND_FLOAT else None
+
+    def append_items(self, items):
+        """Append one row from (name, value) pairs"""
+        if self.size == self.capacity:
+            self._grow()
+        row = self.size
+        names = []
+        for name, value in items:
+            kind = self.kinds.get(name)
+            if kind is None:
+                self._add_column(name, value)
+            elif not _fits(kind, value):
+                widened = _KIND_FLOAT if {kind, _value_kind(value)} == {_KIND_INT, _KIND_FLOAT} else _KIND_OBJECT
+                self._set_kind(name, widened)
+            self.columns[name][row] = value
+            names.append(name)
+        if len(names) < len(self.kinds):
+            self._fill_missing(set(names))
+        self.size += 1
+
+    def append_values(self, names, values):
+        """Append one row given parallel name and value sequences"""
+        self.append_items(zip(names, values))
+
+    def to_arrays(self):
+        """dict of column name -> array of length len(self)"""
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.to_arrays())
+
+
+class ColumnarResultBuilder(object):
+    """
+    Columnar replacement for the compliance_logs / common_field_logs / packet_logs
+    lists of dicts built by process_pcap.
+
+    :param exclude_fields: packet attributes not kept in the per-type tables
+    """
+
+    def __init__(self, exclude_fields=DEFAULT_EXCLUDE_FIELDS):
+        self.exclude_fields = frozenset(exclude_fields)
+        self.compliance = ColumnTable()
+        self.common_fields = ColumnTable()
+        self.packets = {}
+
+    def add_packet(self, difi_pkt, pcap_timestamp, pcap_index):
+        fields = vars(difi_pkt)
+        pkt_type = fields["pkt_type"]
+        self.compliance.append_values(COMPLIANCE_LOG_KEYS, (pcap_timestamp, pcap_index, pkt_type))
+        self.common_fields.append_values(COMMON_FIELD_LOG_KEYS,
+                                         (pcap_timestamp, pcap_index, pkt_type,
+                                          fields["class_id"], fields["tsm"], fields["tsi"], fields["tsf"],
+                                          fields["seq_num"], fields["pkt_size"]))
+        table = self.packets.get(pkt_type)
+        if table is None:
+            table = self.packets[pkt_type] = ColumnTable()
+        items = [(k, v) for k, v in fields.items() if k not in self.exclude_fields]
+        items.append(("pcap_timestamp", pcap_timestamp))
+        items.append(("pcap_index", pcap_index))
+        table.append_items(items)
+
+    def add_noncompliant(self, pcap_timestamp, pcap_index):
+        self.compliance.append_values(COMPLIANCE_LOG_KEYS, (pcap_timestamp, pcap_index, -1))
+
+    def results(self):
+        """(compliance_logs, common_field_logs, packet_logs) as dicts of arrays"""
+        return (self.compliance.to_arrays(),
+                self.common_fields.to_arrays(),
+                {pkt_type: table.to_arrays() for pkt_type, table in self.packets.items()})
+
+    def dataframes(self):
+        """(compliance_logs, common_field_logs, packet_logs) as pandas DataFrames"""
+        return (self.compliance.to_dataframe(),
+                self.common_fields.to_dataframe(),
+                {pkt_type: table.to_dataframe() for pkt_type, table in self.packets.items()})
@@ -0,0 +1,82 @@
+import numpy as np
+
+##################
+# rasterized constellation renderer - bins IQ samples into a fixed-size 2-D density
+# grid with NumPy and writes it straight to an image file, so the cost is linear in
+# samples with no per-point matplotlib artists and every image has the same size,
+# axis limits and intensity scale. supervised_learning (notebooks/utility/utility.py,
+# data_generation/generator/process.py) imports this module from the same checkout
+##################
+
+DEFAULT_IMAGE_SIZE = 900        # pixels, same as the 6 in x 150 dpi scatter plots
+DEFAULT_LIMIT = 128.0           # full scale of 8-bit DIFI samples; pass a larger limit for 16-bit captures
+DEFAULT_LIMIT_MARGIN = 1.1      # auto limit is 10% beyond the largest |I| or |Q|
+DEFAULT_CMAP = "Blues"
+INTENSITY_SCALES = ("log", "linear")
+AXIS_LINE_LEVEL = 0.75          # grey level of the I=0 / Q=0 axis lines
+
+
+def constellation_limit(i_data, q_data, margin: float=DEFAULT_LIMIT_MARGIN):
+    """Symmetric axis limit covering all samples"""
+    if len(i_data) == 0:
+        return 1.0
+    limit = max(np.abs(i_data).max(), np.abs(q_data).max()) * margin
+    return float(limit) if limit > 0 else 1.0
+
+
+def constellation_density(i_data, q_data, size: int=DEFAULT_IMAGE_SIZE, limit: float=DEFAULT_LIMIT):
+    """
+    (size, size) sample counts over [-limit, limit] in I (columns) and Q (rows, Q
+    increasing upwards). Samples outside the limits are dropped; limit=None fits
+    the limits to the samples (constellation_limit).
+    """
+    # float32/int32 arithmetic halves the memory traffic, at worst moving a sample on a bin edge by one pixel
+    i_data = np.asarray(i_data, dtype=np.float32).ravel()
+    q_data = np.asarray(q_data, dtype=np.float32).ravel()
+    if limit is None:
+        limit = constellation_limit(i_data, q_data)
+    scale = np.float32(size / (2.0 * limit))
+    cols = (i_data + np.float32(limit)) * scale
+    rows = (np.float32(limit) - q_data) * scale
+    inside = (cols >= 0) & (cols < size) & (rows >= 0) & (rows < size)
+    flat = rows[inside].astype(np.int32) * np.int32(size) + cols[inside].astype(np.int32)
+    return np.bincount(flat, minlength=size * size).reshape(size, size)
+
+
+def density_intensity(counts, scale: str="log"):
+    """Counts normalized to [0, 1], log1p or linear"""
+    if scale not in INTENSITY_SCALES:
+        raise ValueError(f"intensity scale must be one of {INTENSITY_SCALES}, not {scale!r}")
+    peak = counts.max()
+    if peak == 0:
+        return np.zeros(counts.shape, dtype=np.float32)
+    if scale == "log":
+        return (np.log1p(counts) / np.log1p(peak)).astype(np.float32)
+    return (counts / peak).astype(np.float32)
+
+
+def render_constellation(i_data, q_data, output_file: str, size: int=DEFAULT_IMAGE_SIZE, limit: float=DEFAULT_LIMIT,
+                         scale: str="log", cmap: str=DEFAULT_CMAP, axis_lines=True):
+    """
+    Write a size x size constellation density image of the samples (any format
+    matplotlib's imsave supports, e.g. .png or .jpeg) on fixed [-limit, limit]
+    axes, so images of different captures compare directly. limit=None fits
+    the axes to these samples instead. Returns the axis limit used.
+    """
+    import matplotlib
+    from matplotlib import image as mpimg
+
+    i_data = np.asarray(i_data)
+    q_data = np.asarray(q_data)
+    if limit is None:
+        limit = constellation_limit(i_data, q_data)
+    intensity = density_intensity(constellation_density(i_data, q_data, size, limit), scale)
+    rgba = matplotlib.colormaps[cmap](intensity)
+    if axis_lines:
+        center = size // 2
+        rgba[center, :, :3] = np.minimum(rgba[center, :, :3], AXIS_LINE_LEVEL)
+        rgba[:, center, :3] = np.minimum(rgba[:, center, :3], AXIS_LINE_LEVEL)
+    if output_file.lower().endswith((".jpg", ".jpeg")):
+        rgba = rgba[:, :, :3]  # JPEG has no alpha channel
+    mpimg.imsave(output_file, rgba)
+    return limit
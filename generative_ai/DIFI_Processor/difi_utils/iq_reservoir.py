@@ -0,0 +1,48 @@
+import numpy as np
+
+##################
+# streaming IQ reservoir - uniform random sample of fixed size over any number of
+# sample batches (e.g. the packets of an aggregated group), fed one batch at a time
+# so memory stays bounded by the reservoir size plus one batch
+##################
+
+
+class IqReservoir(object):
+    """
+    Reservoir sampling (algorithm R, vectorized per batch) of complex IQ samples.
+    Until `capacity` samples have been seen the reservoir holds all of them in
+    arrival order; after that every sample seen so far is kept with equal probability.
+
+    :param capacity: number of samples to keep
+    :param rng: numpy RandomState/Generator (or the np.random module) to draw from
+    """
+
+    def __init__(self, capacity: int, rng=np.random):
+        self.capacity = capacity
+        self.rng = rng
+        self.samples = np.empty(capacity, dtype=np.complex128)
+        self.seen = 0
+
+    def __len__(self):
+        return min(self.seen, self.capacity)
+
+    def add(self, i_data, q_data):
+        """Offer one batch of samples"""
+        batch = np.asarray(i_data, dtype=np.float64) + 1j * np.asarray(q_data, dtype=np.float64)
+        fill = min(max(self.capacity - self.seen, 0), len(batch))
+        if fill:
+            self.samples[self.seen:self.seen + fill] = batch[:fill]
+        rest = batch[fill:]
+        if len(rest):
+            # the sample at stream position t replaces slot j ~ U[0, t] when j < capacity;
+            # repeated slots take the last assignment, as in the sequential algorithm
+            positions = np.arange(self.seen + fill, self.seen + len(batch), dtype=np.float64)
+            slots = (self.rng.random(len(rest)) * (positions + 1)).astype(np.int64)
+            keep = slots < self.capacity
+            self.samples[slots[keep]] = rest[keep]
+        self.seen += len(batch)
+
+    def result(self):
+        """(i, q) arrays of the sampled points"""
+        kept = self.samples[:len(self)]
+        return kept.real.copy(), kept.imag.copy()
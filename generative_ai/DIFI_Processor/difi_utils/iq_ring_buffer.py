@@ -0,0 +1,263 @@
+import numpy as np
+
+##################
+# IQ ring buffer - per-stream preallocated sample store that reassembles
+# contiguous sample blocks across data packets
+##################
+
+SEQ_NUM_MODULUS = 16  # DIFI seq_num is mod16 of the packet count
+PICOSECONDS_PER_SECOND = 10**12
+
+
+def iq_to_complex(window):
+    """Convert an (N, 2) I/Q window into a complex64 array"""
+    out = np.empty(len(window), dtype=np.complex64)
+    out.real = window[:, 0]
+    out.imag = window[:, 1]
+    return out
+
+
+class IqRingBuffer(object):
+    """
+    Preallocated ring of IQ samples for a single DIFI stream.
+
+    Samples are stored as (I, Q) rows of the packet's data item type; each sample
+    is copied once, from the packet into the ring. Windows are returned as NumPy
+    views. A window that spans the wrap point cannot be one view: read_parts()
+    returns it as two views, read() joins them into a new array. Views stay valid
+    until the rows they cover are overwritten by later writes.
+
+    :param capacity: number of IQ samples held
+    :param dtype: data item type (matches DifiDataPacket.samples)
+    :param sample_rate: samples per second, enables timestamp gap detection
+    :param reset_on_gap: drop unread samples on a gap so windows never span one
+    """
+
+    def __init__(self, capacity: int, dtype=np.int8, sample_rate: float=None, reset_on_gap=True):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.reset_on_gap = reset_on_gap
+        self._buf = np.zeros((capacity, 2), dtype=dtype)
+
+        self.write_total = 0  # samples ever written
+        self.read_total = 0   # samples ever consumed by read()
+        self.overrun_samples = 0  # unread samples overwritten before being read
+        self.gaps = []
+
+        self._last_seq_num = None
+        self._last_timestamp_ps = None
+        self._last_num_samples = 0
+        # timestamp (ps) of sample index _anchor_index, used to time windows
+        self._anchor_timestamp_ps = None
+        self._anchor_index = 0
+
+    @property
+    def available(self):
+        """Number of unread samples"""
+        return self.write_total - self.read_total
+
+    def _check_gap(self, num_samples, seq_num, timestamp_ps):
+        gap = None
+        if seq_num is not None and self._last_seq_num is not None:
+            expected_seq_num = (self._last_seq_num + 1) % SEQ_NUM_MODULUS
+            if seq_num != expected_seq_num:
+                gap = {"sample_index": self.write_total,
+                       "reason": "seq_num",
+                       "expected_seq_num": expected_seq_num,
+                       "seq_num": seq_num}
+
+        if timestamp_ps is not None and self._last_timestamp_ps is not None and self.sample_rate:
+            sample_period_ps = PICOSECONDS_PER_SECOND / self.sample_rate
+            expected_ps = self._last_timestamp_ps + self._last_num_samples * sample_period_ps
+            missing_samples = int(round((timestamp_ps - expected_ps) / sample_period_ps))
+            if missing_samples != 0:
+                if gap is None:
+                    gap = {"sample_index": self.write_total, "reason": "timestamp"}
+                gap["missing_samples"] = missing_samples
+
+        return gap
+
+    def write(self, samples, seq_num: int=None, integer_seconds_timestamp: int=None, fractional_seconds_timestamp: int=None):
+        """
+        Copy one packet's samples into the ring.
+
+        :param samples: interleaved I/Q items (as DifiDataPacket.samples) or an (N, 2) array
+        :return: gap info dict if a discontinuity was detected before this packet, else None
+        """
+        rows = np.asarray(samples)
+        if rows.ndim == 1:
+            rows = rows[:len(rows) - (len(rows) % 2)].reshape(-1, 2)
+        num_samples = len(rows)
+
+        timestamp_ps = None
+        if integer_seconds_timestamp is not None and fractional_seconds_timestamp is not None:
+            timestamp_ps = integer_seconds_timestamp * PICOSECONDS_PER_SECOND + fractional_seconds_timestamp
+
+        gap = self._check_gap(num_samples, seq_num, timestamp_ps)
+        if gap is not None:
+            self.gaps.append(gap)
+            if self.reset_on_gap:
+                self.read_total = self.write_total
+        if gap is not None or self._anchor_timestamp_ps is None:
+            self._anchor_timestamp_ps = timestamp_ps
+            self._anchor_index = self.write_total
+
+        self._last_seq_num = seq_num
+        self._last_timestamp_ps = timestamp_ps
+        self._last_num_samples = num_samples
+
+        # only the newest `capacity` rows can be kept
+        if num_samples > self.capacity:
+            skip = num_samples - self.capacity
+            rows = rows[skip:]
+            self.write_total += skip
+            num_samples = self.capacity
+
+        pos = self.write_total % self.capacity
+        first = min(num_samples, self.capacity - pos)
+        self._buf[pos:pos + first] = rows[:first]
+        if first < num_samples:
+            self._buf[0:num_samples - first] = rows[first:]
+        self.write_total += num_samples
+
+        if self.available > self.capacity:
+            self.overrun_samples += self.available - self.capacity
+            self.read_total = self.write_total - self.capacity
+
+        return gap
+
+    def write_packet(self, pkt):
+        """Write the samples of a DifiDataPacket decoded with return_iq=True"""
+        return self.write(pkt.samples,
+                          seq_num=pkt.seq_num,
+                          integer_seconds_timestamp=getattr(pkt, "integer_seconds_timestamp", None),
+                          fractional_seconds_timestamp=getattr(pkt, "fractional_seconds_timestamp", None))
+
+    def _parts(self, start_index, num_samples):
+        """(head, tail) views of a window; tail is empty unless the window wraps"""
+        pos = start_index % self.capacity
+        first = min(num_samples, self.capacity - pos)
+        return self._buf[pos:pos + first], self._buf[0:num_samples - first]
+
+    def _view(self, start_index, num_samples):
+        head, tail = self._parts(start_index, num_samples)
+        return head if len(tail) == 0 else np.concatenate((head, tail))
+
+    def read_parts(self, num_samples: int, hop: int=None):
+        """
+        Return the next `num_samples` unread samples as a (head, tail) pair of (N, 2)
+        views, never copying (tail is empty unless the window wraps), or None if
+        not enough samples are buffered. Advances the read position by `hop`
+        (defaults to `num_samples`, i.e. non-overlapping windows); `hop` must be
+        positive and no more than the number of buffered samples.
+        """
+        if num_samples > self.capacity:
+            raise ValueError("window of %d samples exceeds ring capacity %d" % (num_samples, self.capacity))
+        if hop is not None and hop <= 0:
+            raise ValueError("hop must be positive, got %d" % hop)
+        if self.available < num_samples:
+            return None
+        if hop is not None and hop > self.available:
+            raise ValueError("hop of %d samples exceeds the %d buffered samples" % (hop, self.available))
+        parts = self._parts(self.read_total, num_samples)
+        self.read_total += num_samples if hop is None else hop
+        return parts
+
+    def read(self, num_samples: int, hop: int=None):
+        """
+        Like read_parts(), but as one (N, 2) array: a view into the ring, or,
+        when the window spans the wrap point, a copy that is not backed by the
+        ring (later writes do not change it and writing to it does not change
+        the ring).
+        """
+        parts = self.read_parts(num_samples, hop)
+        if parts is None:
+            return None
+        head, tail = parts
+        return head if len(tail) == 0 else np.concatenate(parts)
+
+    def windows(self, num_samples: int, hop: int=None):
+        """Yield every complete unread window as an (N, 2) array (see read())"""
+        while True:
+            window = self.read(num_samples, hop)
+            if window is None:
+                return
+            yield window
+
+    def read_batch(self, num_samples: int, max_windows: int=None):
+        """Copy all complete unread non-overlapping windows into one (M, N, 2) array"""
+        count = self.available // num_samples
+        if max_windows is not None:
+            count = min(count, max_windows)
+        batch = np.empty((count, num_samples, 2), dtype=self._buf.dtype)
+        for i in range(count):
+            head, tail = self.read_parts(num_samples)
+            batch[i, :len(head)] = head
+            batch[i, len(head):] = tail
+        return batch
+
+    def latest(self, num_samples: int):
+        """
+        Most recent `num_samples` samples as an (N, 2) array, without consuming them.
+        Like read(), a view into the ring unless the window wraps, then a copy.
+        """
+        num_samples = min(num_samples, self.capacity, self.write_total)
+        return self._view(self.write_total - num_samples, num_samples)
+
+    def timestamp_ps(self, sample_index: int):
+        """Timestamp in picoseconds of an absolute sample index, if known"""
+        if self._anchor_timestamp_ps is None or not self.sample_rate or sample_index < self._anchor_index:
+            return None
+        offset = (sample_index - self._anchor_index) * PICOSECONDS_PER_SECOND / self.sample_rate
+        return self._anchor_timestamp_ps + int(round(offset))
+
+
+class StreamRingBuffers(object):
+    """
+    IqRingBuffer per DIFI stream ID, created on the first data packet of each stream.
+    Sample rates are picked up from standard context packets.
+
+    :param capacity: number of IQ samples held per stream
+    :param dtype: data item type (matches DifiDataPacket.samples)
+    :param reset_on_gap: see IqRingBuffer
+    """
+
+    def __init__(self, capacity: int, dtype=np.int8, reset_on_gap=True):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.reset_on_gap = reset_on_gap
+        self.buffers = {}
+        self.sample_rates = {}
+
+    def __getitem__(self, stream_id):
+        return self.buffers[stream_id]
+
+    def __contains__(self, stream_id):
+        return stream_id in self.buffers
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def items(self):
+        return self.buffers.items()
+
+    def update_context(self, pkt):
+        """Record the sample rate from a standard context packet"""
+        sample_rate = getattr(pkt, "sample_rate", None)
+        if sample_rate:
+            self.sample_rates[pkt.stream_id] = sample_rate
+            if pkt.stream_id in self.buffers:
+                self.buffers[pkt.stream_id].sample_rate = sample_rate
+
+    def write_packet(self, pkt):
+        """Write a data packet's samples into its stream's ring"""
+        ring = self.buffers.get(pkt.stream_id)
+        if ring is None:
+            ring = IqRingBuffer(self.capacity,
+                                dtype=self.dtype,
+                                sample_rate=self.sample_rates.get(pkt.stream_id),
+                                reset_on_gap=self.reset_on_gap)
+            self.buffers[pkt.stream_id] = ring
+        return ring.write_packet(pkt)
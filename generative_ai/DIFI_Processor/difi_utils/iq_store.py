@@ -0,0 +1,121 @@
+import glob
+import os
+import numpy as np
+
+##################
+# consolidated IQ store - all samples of one stream appended to a single raw
+# complex64 file, plus a small .npy index of per-packet sample offsets and
+# timestamps, so individual packets can be sliced out of a memory map
+##################
+
+IQ_EXTENSION = ".iq"
+INDEX_EXTENSION = ".index.npy"
+IQ_DTYPE = np.dtype("<c8")  # complex64, little endian
+
+IQ_INDEX_DTYPE = np.dtype([
+    ("packet", "<i8"),           # data packet number across all streams, as in packet_NNN.csv
+    ("offset", "<i8"),           # first sample of the packet in the .iq file
+    ("count", "<i8"),            # number of samples
+    ("pcap_timestamp", "<f8"),   # capture timestamp, seconds
+    ("tsi", "<u4"),              # DIFI integer seconds timestamp
+    ("tsf", "<u8"),              # DIFI fractional seconds timestamp (picoseconds)
+])
+
+
+def iq_stream_path(output_prefix: str, stream_id: int):
+    return f"{output_prefix}_{stream_id:08x}{IQ_EXTENSION}"
+
+
+def iq_index_path(iq_path: str):
+    return iq_path[:-len(IQ_EXTENSION)] + INDEX_EXTENSION
+
+
+class IqStoreWriter(object):
+    """
+    Appends complex64 samples of DIFI data packets to one .iq file per stream
+    and writes each stream's packet index on close().
+
+    :param output_prefix: path prefix of the output files (<prefix>_<stream id>.iq)
+    """
+
+    def __init__(self, output_prefix: str):
+        self.output_prefix = output_prefix
+        self.files = {}
+        self.indexes = {}
+        self.offsets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, stream_id: int, packet: int, samples, pcap_timestamp: float=0.0, tsi: int=0, tsf: int=0):
+        f = self.files.get(stream_id)
+        if f is None:
+            f = self.files[stream_id] = open(iq_stream_path(self.output_prefix, stream_id), 'wb')
+            self.indexes[stream_id] = []
+            self.offsets[stream_id] = 0
+        samples = np.asarray(samples).astype(IQ_DTYPE, copy=False)
+        f.write(samples.tobytes())
+        self.indexes[stream_id].append((packet, self.offsets[stream_id], len(samples), pcap_timestamp, tsi, tsf))
+        self.offsets[stream_id] += len(samples)
+
+    def close(self):
+        """Flush all streams, return the .iq paths written"""
+        paths = []
+        for stream_id, f in self.files.items():
+            f.close()
+            np.save(iq_index_path(f.name), np.array(self.indexes[stream_id], dtype=IQ_INDEX_DTYPE))
+            paths.append(f.name)
+        self.files = {}
+        return paths
+
+
+class IqStream(object):
+    """
+    Memory-mapped view of one stream written by IqStoreWriter.
+
+    :param iq_path: path of the .iq file; its index is read from the matching .index.npy
+    """
+
+    def __init__(self, iq_path: str):
+        self.path = iq_path
+        self.index = np.load(iq_index_path(iq_path))
+        if os.path.getsize(iq_path) > 0:
+            self.samples = np.memmap(iq_path, dtype=IQ_DTYPE, mode='r')
+        else:
+            self.samples = np.empty(0, dtype=IQ_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def packet_samples(self, position: int):
+        """Samples of the packet at `position` in this stream's index"""
+        entry = self.index[position]
+        return self.samples[entry["offset"]:entry["offset"] + entry["count"]]
+
+    def find_packet(self, packet: int):
+        """Index position of data packet number `packet`, or None"""
+        position = int(np.searchsorted(self.index["packet"], packet))
+        if position < len(self.index) and self.index["packet"][position] == packet:
+            return position
+        return None
+
+
+def find_iq_streams(directory: str=".", prefix: str="packet"):
+    """IqStream for every <prefix>_*.iq file in `directory` that has an index"""
+    paths = sorted(glob.glob(os.path.join(directory, f"{prefix}_*{IQ_EXTENSION}")))
+    return [IqStream(path) for path in paths if os.path.exists(iq_index_path(path))]
+
+
+def iq_packet_table(streams):
+    """(packet numbers, stream list positions, index positions) of all packets, sorted by packet number"""
+    if not streams:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    packets = np.concatenate([stream.index["packet"] for stream in streams])
+    stream_positions = np.concatenate([np.full(len(stream), i, dtype=np.int64) for i, stream in enumerate(streams)])
+    index_positions = np.concatenate([np.arange(len(stream), dtype=np.int64) for stream in streams])
+    order = np.argsort(packets, kind="stable")
+    return packets[order], stream_positions[order], index_positions[order]
@@ -0,0 +1,227 @@
+import struct
+import dpkt
+import numpy as np
+
+from difi_utils.difi_constants import *
+from difi_utils.capture_stream import CaptureFormatError, ns_to_seconds, seconds_to_ns
+
+##################
+# pushdown packet filter - selects pcap records by timestamp, UDP destination port,
+# DIFI packet type and stream ID straight from the raw frame bytes, before any
+# dpkt/scapy layering or DIFI packet class is constructed
+##################
+
+ETH_HEADER_LEN = 14
+ETHERTYPE_IPV4 = 0x0800
+IP_PROTO_UDP = 17
+UDP_HEADER_LEN = 8
+MIN_IPV4_UDP_FRAME_LEN = ETH_HEADER_LEN + 20 + UDP_HEADER_LEN
+
+# pcap link types (https://www.tcpdump.org/linktypes.html) of the frames handed to udp_view
+LINKTYPE_ETHERNET = 1
+LINKTYPE_DLT_RAW = 12         # raw IP as written by some BSD libpcaps
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113      # tcpdump -i any
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+# link type: (IP header offset, ethertype offset, None for raw IP)
+LINK_LAYERS = {
+    LINKTYPE_ETHERNET: (ETH_HEADER_LEN, 12),
+    LINKTYPE_DLT_RAW: (0, None),
+    LINKTYPE_RAW: (0, None),
+    LINKTYPE_LINUX_SLL: (16, 14),
+    LINKTYPE_IPV4: (0, None),
+    LINKTYPE_LINUX_SLL2: (20, 0),
+}
+
+
+def check_linktype(linktype):
+    """The link type to decode frames with, Ethernet when not known; CaptureFormatError if unsupported"""
+    if linktype is None:
+        return LINKTYPE_ETHERNET
+    if linktype not in LINK_LAYERS:
+        raise CaptureFormatError(f"unsupported pcap link type {linktype} (supported: Ethernet, Linux cooked SLL/SLL2, raw IP)")
+    return linktype
+
+
+def capture_linktype(records):
+    """
+    Link type of a (ts, buf) record source: the `linktype` of capture_stream record
+    streams, PcapChunkPacketStreamers, shard readers and scapy readers, or
+    datalink() of a dpkt reader. Ethernet for plain iterables.
+    """
+    linktype = getattr(records, 'linktype', None)
+    if linktype is None and callable(getattr(records, 'datalink', None)):
+        linktype = records.datalink()
+    return check_linktype(linktype)
+
+
+def locate_udp(buf, linktype=LINKTYPE_ETHERNET):
+    """
+    (UDP header offset, end of IP payload) of an untagged IPv4/UDP frame, read at
+    fixed offsets. None for anything else (VLAN tags, IPv6, fragments, truncated
+    frames); callers fall back to dpkt for those.
+    """
+    ip, ethertype = LINK_LAYERS[linktype]
+    if len(buf) < ip + 20 + UDP_HEADER_LEN:
+        return None
+    if ethertype is not None and (buf[ethertype] != ETHERTYPE_IPV4 >> 8 or buf[ethertype + 1] != ETHERTYPE_IPV4 & 0xff):
+        return None
+    version_ihl = buf[ip]
+    ihl = (version_ihl & 0x0f) * 4
+    if version_ihl >> 4 != 4 or ihl < 20 or buf[ip + 9] != IP_PROTO_UDP:
+        return None
+    if buf[ip + 6] & 0x3f or buf[ip + 7]:
+        return None  # MF flag or fragment offset set, dpkt does not decode these as UDP
+    ip_end = ip + ((buf[ip + 2] << 8) | buf[ip + 3])
+    udp_offset = ip + ihl
+    if ip_end > len(buf) or udp_offset + UDP_HEADER_LEN > ip_end:
+        return None
+    return udp_offset, ip_end
+
+
+def decode_ip(buf, linktype=LINKTYPE_ETHERNET):
+    """dpkt decode of a frame down to its network layer (an IP/IP6 packet for IP frames)"""
+    if linktype == LINKTYPE_ETHERNET:
+        return dpkt.ethernet.Ethernet(buf).data
+    if linktype == LINKTYPE_LINUX_SLL:
+        return dpkt.sll.SLL(buf).data
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return dpkt.sll2.SLL2(buf).data
+    if buf[:1] and buf[0] >> 4 == 6:
+        return dpkt.ip6.IP6(buf)
+    return dpkt.ip.IP(buf)
+
+
+def udp_view(buf, linktype=LINKTYPE_ETHERNET):
+    """
+    (dst port, data, payload start, payload end) of a UDP frame, where
+    data[start:end] is the UDP payload. Uses locate_udp and only decodes the
+    frame with dpkt when that fails. None for non-UDP frames.
+    """
+    located = locate_udp(buf, linktype)
+    if located is not None:
+        udp_offset, ip_end = located
+        (dport,) = struct.unpack_from(">H", buf, udp_offset + 2)
+        return dport, buf, udp_offset + UDP_HEADER_LEN, ip_end
+    try:
+        ip_payload = decode_ip(buf, linktype).data
+    except (dpkt.UnpackError, AttributeError):
+        return None
+    if type(ip_payload) is not dpkt.udp.UDP:
+        return None
+    return ip_payload.dport, ip_payload.data, 0, len(ip_payload.data)
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return frozenset((value,))
+    return frozenset(value)
+
+
+class PacketFilter(object):
+    """
+    Accepts or rejects (ts, buf) pcap records. Every criterion is optional and
+    each may be a single value or a collection of allowed values.
+
+    The time window is kept in integer nanoseconds. Records with integer
+    timestamps (streams opened with ns_timestamps) are compared in nanoseconds,
+    records with float seconds against the window converted back to seconds.
+
+    :param t0: earliest pcap timestamp in seconds (inclusive), a number or decimal string
+    :param t1: latest pcap timestamp in seconds (exclusive)
+    :param udp_port: UDP destination port(s)
+    :param pkt_type: DIFI packet type nibble(s), e.g. DIFI_STANDARD_FLOW_SIGNAL_DATA_WITH_STREAMID
+    :param stream_id: DIFI stream ID(s)
+    :param packet_offset_bytes: bytes before the DIFI header in the UDP payload
+    :param keep_context: also accept standard context packets outside the time
+        window / packet types, so decoders keep the sample format of the selected streams
+    :param t0_ns: earliest pcap timestamp in nanoseconds, instead of t0
+    :param t1_ns: latest pcap timestamp in nanoseconds, instead of t1
+
+    match() takes the link type of the frames (see capture_linktype); filter()
+    reads it from the records it is given.
+    """
+
+    def __init__(self, t0: float=None, t1: float=None, udp_port=None, pkt_type=None, stream_id=None,
+                 packet_offset_bytes=0, keep_context=False, t0_ns: int=None, t1_ns: int=None):
+        self.t0_ns = t0_ns if t0 is None else seconds_to_ns(t0)
+        self.t1_ns = t1_ns if t1 is None else seconds_to_ns(t1)
+        self.t0 = None if self.t0_ns is None else ns_to_seconds(self.t0_ns)
+        self.t1 = None if self.t1_ns is None else ns_to_seconds(self.t1_ns)
+        self.udp_ports = _as_set(udp_port)
+        self.pkt_types = _as_set(pkt_type)
+        self.stream_ids = _as_set(stream_id)
+        self.packet_offset_bytes = packet_offset_bytes
+        self.keep_context = keep_context
+        self.needs_udp = (self.udp_ports is not None or self.pkt_types is not None
+                          or self.stream_ids is not None or keep_context)
+        self.accepted = 0
+        self.rejected = 0
+
+    def criteria(self):
+        """JSON-serializable description of what the filter accepts, e.g. to tell result sets apart"""
+        return {
+            "t0_ns": self.t0_ns,
+            "t1_ns": self.t1_ns,
+            "udp_ports": None if self.udp_ports is None else sorted(self.udp_ports),
+            "pkt_types": None if self.pkt_types is None else sorted(self.pkt_types),
+            "stream_ids": None if self.stream_ids is None else sorted(self.stream_ids),
+            "packet_offset_bytes": self.packet_offset_bytes,
+            "keep_context": self.keep_context,
+        }
+
+    def match(self, ts, buf, linktype=LINKTYPE_ETHERNET):
+        if self._match(ts, buf, linktype):
+            self.accepted += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def _match(self, ts, buf, linktype):
+        if isinstance(ts, (int, np.integer)):
+            t0, t1 = self.t0_ns, self.t1_ns
+        else:
+            t0, t1 = self.t0, self.t1
+        in_window = (t0 is None or ts >= t0) and (t1 is None or ts < t1)
+        if not in_window and not self.keep_context:
+            return False
+        if not self.needs_udp:
+            return True
+
+        view = udp_view(buf, linktype)
+        if view is None:
+            return False
+        dport, data, start, end = view
+        if self.udp_ports is not None and dport not in self.udp_ports:
+            return False
+        start += self.packet_offset_bytes
+        if self.pkt_types is None and self.stream_ids is None and not self.keep_context:
+            return True
+        if end - start < 4:
+            return False
+
+        pkt_type = data[start] >> 4
+        is_context = self.keep_context and pkt_type == DIFI_STANDARD_FLOW_SIGNAL_CONTEXT
+        if not in_window and not is_context:
+            return False
+        if self.pkt_types is not None and pkt_type not in self.pkt_types and not is_context:
+            return False
+        if self.stream_ids is not None:
+            if end - start < 8:
+                return False
+            (stream_id,) = struct.unpack_from(">I", data, start + 4)
+            if stream_id not in self.stream_ids:
+                return False
+        return True
+
+    def filter(self, records):
+        """Iterate the (ts, buf) records that match"""
+        linktype = None
+        for ts, buf in records:
+            if linktype is None:
+                linktype = capture_linktype(records)
+            if self.match(ts, buf, linktype):
+                yield ts, buf
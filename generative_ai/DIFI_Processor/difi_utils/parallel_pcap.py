@@ -0,0 +1,394 @@
+import glob
+import io
+import multiprocessing
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+from difi_utils.difi_constants import *
+from difi_utils.spectrum import DEFAULT_FFT_SIZE
+
+##################
+# sharded pcap processing - splits a classic pcap file into byte ranges, resyncs
+# each range to the next valid record header and decodes the shards in parallel
+##################
+
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+MAX_PLAUSIBLE_CAPLEN = 262144      # tcpdump's default max snaplen
+MAX_PLAUSIBLE_CAPTURE_SPAN = 30 * 24 * 3600  # seconds after the first record a capture may run
+RESYNC_CONFIRM_RECORDS = 4         # consecutive plausible headers needed to accept a resync point
+RESYNC_WINDOW_BYTES = 2**20
+CONTEXT_LOOKBACK_BYTES = 8 * 2**20  # how far before a shard to look for the DIFI context in effect
+SHARDS_PER_WORKER = 4              # with max_packets, smaller shards let extraction stop early
+STOP_CHECK_RECORDS = 256           # records between checks of the shared stop flag
+
+# shard index after which shard workers stop reading (set through _init_shard_worker)
+_stop_after = None
+
+
+class PcapGlobalHeader(object):
+    """Fields of a classic pcap global header needed to walk records without dpkt.pcap.Reader"""
+
+    def __init__(self, buf: bytes):
+        (magic,) = struct.unpack("<I", buf[:4])
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            self.endian = "<"
+        else:
+            (magic,) = struct.unpack(">I", buf[:4])
+            if magic not in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                raise ValueError("invalid tcpdump header")
+            self.endian = ">"
+        self.divisor = 1e9 if magic == PCAP_MAGIC_NSEC else 1e6
+        (self.snaplen, self.linktype) = struct.unpack(self.endian + "II", buf[16:24])
+        if self.snaplen == 0 or self.snaplen > MAX_PLAUSIBLE_CAPLEN:
+            self.snaplen = MAX_PLAUSIBLE_CAPLEN
+        self.record_header = struct.Struct(self.endian + "IIII")  # ts_sec, ts_frac, caplen, orig_len
+        self.first_ts_sec = None
+
+    def is_plausible(self, ts_sec, ts_frac, caplen, orig_len):
+        if caplen == 0 or caplen > self.snaplen or caplen > orig_len or orig_len > MAX_PLAUSIBLE_CAPLEN * 256:
+            return False
+        if ts_frac >= self.divisor:
+            return False
+        if self.first_ts_sec is not None:
+            if ts_sec < self.first_ts_sec or ts_sec > self.first_ts_sec + MAX_PLAUSIBLE_CAPTURE_SPAN:
+                return False
+        return True
+
+
+def read_global_header(f):
+    f.seek(0)
+    gh = PcapGlobalHeader(f.read(PCAP_GLOBAL_HEADER_LEN))
+    buf = f.read(PCAP_RECORD_HEADER_LEN)
+    if len(buf) == PCAP_RECORD_HEADER_LEN:
+        gh.first_ts_sec = gh.record_header.unpack(buf)[0]
+    return gh
+
+
+def find_record_start(f, gh: PcapGlobalHeader, offset: int, file_size: int):
+    """
+    Return the offset of the first valid record header at or after `offset`.
+    A candidate is accepted when it and the following RESYNC_CONFIRM_RECORDS
+    headers are plausible (or the chain ends exactly at end of file).
+    """
+    if offset <= PCAP_GLOBAL_HEADER_LEN:
+        return PCAP_GLOBAL_HEADER_LEN
+    window_len = RESYNC_WINDOW_BYTES + (RESYNC_CONFIRM_RECORDS + 1) * (PCAP_RECORD_HEADER_LEN + gh.snaplen)
+    while offset < file_size:
+        f.seek(offset)
+        window = f.read(window_len)
+        for pos in range(min(RESYNC_WINDOW_BYTES, len(window))):
+            chain_pos = pos
+            confirmed = 0
+            while confirmed <= RESYNC_CONFIRM_RECORDS:
+                if offset + chain_pos == file_size:
+                    break
+                if chain_pos + PCAP_RECORD_HEADER_LEN > len(window):
+                    confirmed = -1
+                    break
+                hdr = gh.record_header.unpack_from(window, chain_pos)
+                if not gh.is_plausible(*hdr):
+                    confirmed = -1
+                    break
+                chain_pos += PCAP_RECORD_HEADER_LEN + hdr[2]
+                confirmed += 1
+            if confirmed > 0:
+                return offset + pos
+        offset += RESYNC_WINDOW_BYTES
+    return file_size
+
+
+def shard_boundaries(filename: str, num_shards: int):
+    """Split a pcap file into `num_shards` record-aligned (start, end) byte ranges"""
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        gh = read_global_header(f)
+        starts = [PCAP_GLOBAL_HEADER_LEN]
+        for i in range(1, num_shards):
+            target = max(starts[-1], file_size * i // num_shards)
+            starts.append(find_record_start(f, gh, target, file_size))
+    starts.append(file_size)
+    return [(start, end) for start, end in zip(starts[:-1], starts[1:]) if end > start]
+
+
+def _init_shard_worker(stop_after):
+    global _stop_after
+    _stop_after = stop_after
+
+
+class ShardRecordReader(object):
+    """
+    Iterates (ts, buf) records of a pcap file whose headers start in [start, end).
+    `count` holds the number of records yielded so far. With a shard_index, reading
+    stops early once the parent has flagged that shard as no longer needed.
+    """
+
+    def __init__(self, filename: str, start: int, end: int, shard_index: int=None):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.shard_index = shard_index
+        self.count = 0
+        self.linktype = None
+
+    def __iter__(self):
+        with open(self.filename, 'rb', buffering=2**20) as f:
+            gh = read_global_header(f)
+            self.linktype = gh.linktype
+            f.seek(self.start)
+            offset = self.start
+            while offset < self.end:
+                hdr_buf = f.read(PCAP_RECORD_HEADER_LEN)
+                if len(hdr_buf) < PCAP_RECORD_HEADER_LEN:
+                    break
+                (ts_sec, ts_frac, caplen, orig_len) = gh.record_header.unpack(hdr_buf)
+                buf = f.read(caplen)
+                offset += PCAP_RECORD_HEADER_LEN + caplen
+                self.count += 1
+                yield ts_sec + ts_frac / gh.divisor, buf
+                if (self.shard_index is not None and _stop_after is not None and self.count % STOP_CHECK_RECORDS == 0
+                        and _stop_after.value < self.shard_index):
+                    break
+
+
+def _process_shard(filename, start, end, packet_offset_bytes, fft_size, fft_window):
+    from difi_utils.stream_from_cloud import process_pcap
+    reader = ShardRecordReader(filename, start, end)
+    compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=reader,
+                                                                   packet_offset_bytes=packet_offset_bytes,
+                                                                   fft_size=fft_size,
+                                                                   fft_window=fft_window)
+    return compliance_logs, common_field_logs, packet_logs, ffts, reader.count
+
+
+def process_pcap_parallel(filename: str, packet_offset_bytes=0, num_workers: int=None, num_shards: int=None,
+                          fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular"):
+    """
+    process_pcap over a local pcap file using one process per shard.
+    Results are merged in original packet order with global pcap_index values.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    shards = shard_boundaries(filename, num_shards or num_workers)
+
+    compliance_logs = []
+    common_field_logs = []
+    packet_logs = {}
+    ffts = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(_process_shard, filename, start, end, packet_offset_bytes, fft_size, fft_window) for start, end in shards]
+        index_offset = 0
+        for future in futures:
+            shard_compliance, shard_common, shard_packets, shard_ffts, shard_count = future.result()
+            for entry in shard_compliance:
+                entry["pcap_index"] += index_offset
+            for entry in shard_common:
+                entry["pcap_index"] += index_offset
+            for pkt_type, entries in shard_packets.items():
+                for entry in entries:
+                    entry["pcap_index"] += index_offset
+                packet_logs.setdefault(pkt_type, []).extend(entries)
+            compliance_logs.extend(shard_compliance)
+            common_field_logs.extend(shard_common)
+            ffts.append(shard_ffts)
+            index_offset += shard_count
+
+    ffts = np.concatenate(ffts) if ffts else np.empty((0, fft_size), dtype=np.float32)
+    return compliance_logs, common_field_logs, packet_logs, ffts
+
+
+def _last_context(filename, start, end):
+    """
+    (found, context packet) for the records starting in [start, end): found is True if
+    any context packet header was seen, whatever its layout, and the packet is the last
+    one that decodes as a DIFI standard context (None if none does, e.g. legacy layouts)
+    """
+    from difi_utils.difi_context_packet_class import DifiStandardContextPacket
+    from difi_utils.packet_filter import udp_view, capture_linktype
+    found = False
+    context_packet = None
+    reader = ShardRecordReader(filename, start, end)
+    for ts, buf in reader:
+        view = udp_view(buf, capture_linktype(reader))
+        if view is None:
+            continue
+        dport, data, payload_start, payload_end = view
+        if payload_end - payload_start >= 8 and (data[payload_start] >> 4) == DIFI_STANDARD_FLOW_SIGNAL_CONTEXT:
+            found = True
+            try:
+                context_packet = DifiStandardContextPacket(io.BytesIO(bytes(data[payload_start:payload_end])))
+            except Exception:
+                continue
+    return found, context_packet
+
+
+def _context_before(filename, start):
+    """
+    Last DIFI standard context packet before `start`. The CONTEXT_LOOKBACK_BYTES
+    before the shard are searched first; if they hold none (sparse context), the
+    search continues backwards in 4x larger regions down to the start of the file.
+    The search stops at the first region holding any context packet header, so
+    captures with legacy (72/84 byte) contexts, which extract_payload does not
+    decode either, do not rescan the file back to its start.
+    """
+    if start <= PCAP_GLOBAL_HEADER_LEN:
+        return None
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        gh = read_global_header(f)
+        lookback = CONTEXT_LOOKBACK_BYTES
+        region_end = start
+        while region_end > PCAP_GLOBAL_HEADER_LEN:
+            region_start = find_record_start(f, gh, max(PCAP_GLOBAL_HEADER_LEN, start - lookback), file_size)
+            region_start = min(region_start, region_end)
+            found, context_packet = _last_context(filename, region_start, region_end)
+            if found:
+                return context_packet
+            region_end = region_start
+            lookback *= 4
+    return None
+
+
+def _extract_shard(filename, start, end, shard_prefix, max_packets, shard_index, output_format):
+    from extract_payload import extract_payload_from_pcap
+    reader = ShardRecordReader(filename, start, end, shard_index)
+    return extract_payload_from_pcap(reader, shard_prefix, max_packets, context_packet=_context_before(filename, start),
+                                     output_format=output_format)
+
+
+def _shard_iq_paths(shard_prefix):
+    from difi_utils.iq_store import IQ_EXTENSION
+    return sorted(glob.glob(f"{glob.escape(shard_prefix)}_*{IQ_EXTENSION}"))
+
+
+def _remove_shard_outputs(shard_prefix, count, output_format):
+    if output_format == "binary":
+        from difi_utils.iq_store import iq_index_path
+        for path in _shard_iq_paths(shard_prefix):
+            os.remove(path)
+            if os.path.exists(iq_index_path(path)):
+                os.remove(iq_index_path(path))
+    else:
+        for i in range(count):
+            os.remove(f"{shard_prefix}_{i:03d}.csv")
+
+
+def _merge_csv_shard(shard_prefix, count, take, output_prefix, packet_offset):
+    """Rename the first `take` CSVs of a shard into the global numbering, drop the rest"""
+    for i in range(count):
+        shard_file = f"{shard_prefix}_{i:03d}.csv"
+        if i < take:
+            os.replace(shard_file, f"{output_prefix}_{packet_offset + i:03d}.csv")
+        else:
+            os.remove(shard_file)
+
+
+def _merge_iq_shard(shard_prefix, take, output_prefix, packet_offset, outputs):
+    """
+    Append the first `take` data packets of a shard's binary IQ store to the
+    per-stream outputs ({stream id: [file, index arrays, samples written]}),
+    renumbering packets and sample offsets, and remove the shard files.
+    """
+    from difi_utils.iq_store import IQ_DTYPE, IQ_EXTENSION, iq_index_path, iq_stream_path
+    for path in _shard_iq_paths(shard_prefix):
+        stream_id = int(path[len(shard_prefix) + 1:-len(IQ_EXTENSION)], 16)
+        index = np.load(iq_index_path(path))
+        index = index[index["packet"] < take]
+        if len(index):
+            output = outputs.get(stream_id)
+            if output is None:
+                output = outputs[stream_id] = [open(iq_stream_path(output_prefix, stream_id), 'wb'), [], 0]
+            num_samples = int(index["offset"][-1] + index["count"][-1])
+            with open(path, 'rb') as f:
+                remaining = num_samples * IQ_DTYPE.itemsize
+                while remaining:
+                    chunk = f.read(min(remaining, 2**22))
+                    output[0].write(chunk)
+                    remaining -= len(chunk)
+            index["packet"] += packet_offset
+            index["offset"] += output[2]
+            output[1].append(index)
+            output[2] += num_samples
+        os.remove(path)
+        os.remove(iq_index_path(path))
+
+
+def extract_payload_from_pcap_parallel(pcap_file: str, output_prefix="packet", max_packets=None, num_workers: int=None, num_shards: int=None,
+                                       output_format="csv"):
+    """
+    extract_payload_from_pcap over a local pcap file using one process per shard.
+    Output files (CSV, or the binary IQ store) are renumbered in original packet
+    order, so the result matches the single-process output.
+
+    With max_packets the capture is cut into SHARDS_PER_WORKER shards per worker,
+    started in file order. Each shard may decode at most max_packets minus the
+    packets of the earlier shards already finished, and once the finished leading
+    shards reach max_packets the remaining shards are cancelled or stop reading.
+    """
+    if output_format not in ("csv", "binary"):
+        raise ValueError(f"Unsupported output_format '{output_format}'. Must be 'csv' or 'binary'")
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_shards is None:
+        num_shards = num_workers * SHARDS_PER_WORKER if max_packets else num_workers
+    shards = shard_boundaries(pcap_file, num_shards)
+    shard_prefixes = ["%s.shard%04d" % (output_prefix, i) for i in range(len(shards))]
+
+    stop_after = multiprocessing.Value('i', len(shards), lock=False)
+    counts = {}          # finished shard -> data packets it wrote
+    futures = {}
+    next_shard = 0
+    merged = 0           # leading shards merged into the output
+    data_packet_count = 0
+    iq_outputs = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_shard_worker, initargs=(stop_after,)) as pool:
+        while merged < len(shards):
+            # keep every worker busy, in shard order; finished shards are all earlier than next_shard
+            while next_shard < len(shards) and len(futures) < num_workers:
+                budget = max_packets - sum(counts.values()) if max_packets else None
+                if budget is not None and budget <= 0:
+                    break
+                start, end = shards[next_shard]
+                futures[next_shard] = pool.submit(_extract_shard, pcap_file, start, end, shard_prefixes[next_shard],
+                                                  budget, next_shard, output_format)
+                next_shard += 1
+            if not futures:
+                break
+
+            done, _ = wait(futures.values(), return_when=FIRST_COMPLETED)
+            for shard in [shard for shard, future in futures.items() if future in done]:
+                counts[shard] = futures.pop(shard).result()
+
+            while merged in counts:
+                take = counts[merged]
+                if max_packets:
+                    take = min(take, max_packets - data_packet_count)
+                if output_format == "binary":
+                    _merge_iq_shard(shard_prefixes[merged], take, output_prefix, data_packet_count, iq_outputs)
+                else:
+                    _merge_csv_shard(shard_prefixes[merged], counts[merged], take, output_prefix, data_packet_count)
+                data_packet_count += take
+                merged += 1
+                if max_packets and data_packet_count >= max_packets:
+                    break
+            if max_packets and data_packet_count >= max_packets:
+                # later shards are not needed: stop the running ones and drop their output
+                stop_after.value = merged - 1
+                break
+
+        for shard, future in futures.items():
+            counts[shard] = future.result()
+    for shard in range(merged, len(shards)):
+        if shard in counts:
+            _remove_shard_outputs(shard_prefixes[shard], counts[shard], output_format)
+
+    if output_format == "binary":
+        from difi_utils.iq_store import IQ_INDEX_DTYPE, iq_index_path
+        for stream_id, (f, indexes, num_samples) in iq_outputs.items():
+            f.close()
+            np.save(iq_index_path(f.name), np.concatenate(indexes) if indexes else np.empty(0, dtype=IQ_INDEX_DTYPE))
+            print(f"Saved stream samples to {f.name}")
+    print(f"Processed {data_packet_count} data packets")
+    return data_packet_count
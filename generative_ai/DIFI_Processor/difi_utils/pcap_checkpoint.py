@@ -0,0 +1,385 @@
+import io
+import json
+import os
+import struct
+import time
+from itertools import islice
+import numpy as np
+
+from difi_utils.capture_stream import CaptureStreamParser, CaptureFormatError, FORMAT_PCAP, PCAPNG_SHB, PCAP_GLOBAL_HEADER_LEN
+from difi_utils.pcap_chunk_stream import RangePrefetcher, file_range_reader, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_BUFFER_BYTES
+from difi_utils.spectrum import StreamSpectralAccumulators, DEFAULT_FFT_SIZE
+
+##################
+# resumable pcap processing - processes a capture in segments. Each segment's
+# columnar results are written once as their own .npz object; after each segment
+# a small JSON checkpoint (byte offset, packet index, list of segment objects) and
+# the spectral accumulators are saved, so a capture too large for one bounded-time
+# run (e.g. a Lambda invocation) is finished over several runs without redoing any
+# packets. Segment results are read back once, when the capture is complete.
+# Nothing is pickled, stored objects are loaded with allow_pickle=False
+##################
+
+CHECKPOINT_VERSION = 3
+CHECKPOINT_NAME = "checkpoint.json"
+DEFAULT_CHECKPOINT_PACKETS = 5000
+JSON_COLUMN_SUFFIX = ".json"  # object columns (dicts, strings, None) are stored as JSON text
+
+
+class PcapRecordCursor(object):
+    """
+    Iterates (ts, buf) records of a classic pcap object from ranged reads,
+    starting at any record-aligned byte offset, with capture_stream's parser.
+    After each record is yielded, `offset` is the byte offset of the next record
+    and `index` its packet index. pcapng captures are rejected: resuming one
+    mid-file would also need the interface blocks seen before the offset
+    (convert with `editcap -F pcap`).
+
+    :param read_range: callable (offset, length) -> bytes
+    :param size: total object size in bytes
+    :param offset: record-aligned byte offset to start at (default: first record)
+    :param index: packet index of the record at `offset`
+    :param ns_timestamps: yield integer nanosecond timestamps instead of float seconds
+    """
+
+    def __init__(self, read_range, size: int, offset: int=None, index: int=0, ns_timestamps: bool=False,
+                 chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES):
+        self.read_range = read_range
+        self.size = size
+        self.file_header = read_range(0, PCAP_GLOBAL_HEADER_LEN)
+        if struct.unpack_from("<I", self.file_header)[0] == PCAPNG_SHB:
+            raise CaptureFormatError("resumable processing needs a classic pcap capture, not pcapng")
+        self.ns_timestamps = ns_timestamps
+        self.linktype = self._new_parser().linktype
+        self.offset = PCAP_GLOBAL_HEADER_LEN if offset is None else offset
+        self.index = index
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self.max_buffer_bytes = max_buffer_bytes
+
+    def _new_parser(self):
+        """Parser that has read the file header"""
+        parser = CaptureStreamParser(ns_timestamps=self.ns_timestamps)
+        for _ in parser.feed(self.file_header):
+            pass
+        if parser.format != FORMAT_PCAP:
+            raise CaptureFormatError("truncated pcap file header")
+        return parser
+
+    def __iter__(self):
+        parser = self._new_parser()
+        parser.seek(self.offset)
+        prefetcher = RangePrefetcher(self.read_range, self.size,
+                                     chunk_size=self.chunk_size,
+                                     max_concurrency=self.max_concurrency,
+                                     max_buffer_bytes=self.max_buffer_bytes,
+                                     start_offset=self.offset)
+        for chunk in prefetcher:
+            for ts, buf in parser.feed(chunk):
+                self.offset = parser.data_offset + len(buf)
+                self.index += 1
+                yield ts, buf
+        parser.close()
+
+
+class LocalCheckpointStore(object):
+    """Checkpoint objects kept as files in a local directory, each replaced atomically on save"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _path(self, name: str):
+        return os.path.join(self.path, name)
+
+    def load(self, name: str):
+        if not os.path.exists(self._path(name)):
+            return None
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def save(self, name: str, data: bytes):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._path(name) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(name))
+
+    def delete(self, name: str):
+        if os.path.exists(self._path(name)):
+            os.remove(self._path(name))
+
+
+class S3CheckpointStore(object):
+    """
+    Checkpoint objects kept under an S3 prefix, so a later Lambda invocation can pick them up.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: bucket name
+    :param prefix: key prefix of the checkpoint objects
+    """
+
+    def __init__(self, s3_client, bucket: str, prefix: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith("/") else prefix + "/"
+
+    def load(self, name: str):
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + name)['Body'].read()
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+    def save(self, name: str, data: bytes):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+    def delete(self, name: str):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+
+def _save_npz(arrays: dict, compressed=False):
+    buf = io.BytesIO()
+    (np.savez_compressed if compressed else np.savez)(buf, **arrays)
+    return buf.getvalue()
+
+
+def _load_npz(data: bytes):
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _segment_arrays(compliance_logs, common_field_logs, packet_logs, ffts):
+    """Flat dict of arrays of one segment's columnar results"""
+    arrays = {"ffts": ffts}
+    tables = {"compliance": compliance_logs, "common_fields": common_field_logs}
+    tables.update({f"packets/{pkt_type}": columns for pkt_type, columns in packet_logs.items()})
+    for table, columns in tables.items():
+        for name, column in columns.items():
+            if column.dtype == object:
+                arrays[f"{table}/{name}{JSON_COLUMN_SUFFIX}"] = np.array(json.dumps(column.tolist(), default=_json_default))
+            else:
+                arrays[f"{table}/{name}"] = column
+    return arrays
+
+
+def _segment_tables(arrays):
+    """(tables, ffts) of a segment saved with _segment_arrays"""
+    tables = {}
+    for key, value in arrays.items():
+        if key == "ffts":
+            continue
+        table, name = key.rsplit("/", 1)
+        if name.endswith(JSON_COLUMN_SUFFIX):
+            name = name[:-len(JSON_COLUMN_SUFFIX)]
+            column = np.empty(len(json.loads(str(value))), dtype=object)
+            column[:] = json.loads(str(value))
+            value = column
+        tables.setdefault(table, {})[name] = value
+    return tables, arrays["ffts"]
+
+
+def _concat_columns(tables):
+    """
+    Concatenate per-segment dicts of columns. Columns missing from a segment are
+    filled with NaN (float columns) or None (anything else, as object columns).
+    """
+    names = []
+    for columns in tables:
+        names.extend(name for name in columns if name not in names)
+    result = {}
+    for name in names:
+        fill_float = all(columns[name].dtype.kind == "f" for columns in tables if name in columns)
+        parts = []
+        for columns in tables:
+            if name in columns:
+                parts.append(columns[name])
+            elif columns:
+                size = len(next(iter(columns.values())))
+                parts.append(np.full(size, np.nan) if fill_float else np.full(size, None, dtype=object))
+        if any(part.dtype == object for part in parts):
+            parts = [part.astype(object) for part in parts]
+        result[name] = np.concatenate(parts)
+    return result
+
+
+class PcapCheckpoint(object):
+    """
+    Progress of one capture: the cursor position, the names of the stored segment
+    result objects and the spectral accumulators. Saved as JSON plus an .npz of
+    the accumulator arrays; segment results are only read back by results().
+
+    :param source: identifies the capture and settings the results belong to
+    :param spectral_accumulators: StreamSpectralAccumulators carried across runs, if any
+    """
+
+    def __init__(self, source: dict, spectral_accumulators: StreamSpectralAccumulators=None):
+        self.version = CHECKPOINT_VERSION
+        self.source = source
+        self.offset = None          # byte offset of the next unprocessed record
+        self.index = 0              # packet index of the next unprocessed record
+        self.complete = False
+        self.segments = []          # names of the segment result objects, in packet order
+        self.spectra = None         # name of the spectral accumulator object
+        self.spectral_accumulators = spectral_accumulators
+
+    def save_segment(self, store, first_index: int, compliance_logs, common_field_logs, packet_logs, ffts):
+        """Write one segment's process_pcap results as their own object"""
+        name = f"segment-{first_index:012d}.npz"
+        store.save(name, _save_npz(_segment_arrays(compliance_logs, common_field_logs, packet_logs, ffts)))
+        if name not in self.segments:
+            self.segments.append(name)
+
+    def save(self, store):
+        """Save the accumulators under a new name, then the checkpoint that points at them"""
+        previous_spectra = self.spectra
+        if self.spectral_accumulators is not None:
+            self.spectra = f"spectra-{self.index:012d}.npz"
+            store.save(self.spectra, _save_npz(self.spectral_accumulators.state(), compressed=True))
+        store.save(CHECKPOINT_NAME, json.dumps({
+            "version": self.version,
+            "source": self.source,
+            "offset": self.offset,
+            "index": self.index,
+            "complete": self.complete,
+            "segments": self.segments,
+            "spectra": self.spectra,
+            "spectrum_kwargs": self.spectral_accumulators.spectrum_kwargs if self.spectral_accumulators is not None else None,
+        }).encode())
+        if previous_spectra is not None and previous_spectra != self.spectra:
+            store.delete(previous_spectra)
+
+    @classmethod
+    def load(cls, store):
+        """The stored checkpoint, or None if there is none"""
+        data = store.load(CHECKPOINT_NAME)
+        if data is None:
+            return None
+        fields = json.loads(data)
+        checkpoint = cls(fields["source"])
+        checkpoint.version = fields["version"]
+        if checkpoint.version != CHECKPOINT_VERSION:
+            return checkpoint
+        checkpoint.offset = fields["offset"]
+        checkpoint.index = fields["index"]
+        checkpoint.complete = fields["complete"]
+        checkpoint.segments = fields["segments"]
+        checkpoint.spectra = fields["spectra"]
+        if checkpoint.spectra is not None:
+            state = _load_npz(store.load(checkpoint.spectra))
+            checkpoint.spectral_accumulators = StreamSpectralAccumulators.from_state(state, **fields["spectrum_kwargs"])
+        return checkpoint
+
+    def clear(self, store):
+        """Delete every stored object of this checkpoint"""
+        for name in self.segments + ([self.spectra] if self.spectra else []) + [CHECKPOINT_NAME]:
+            store.delete(name)
+
+    def results(self, store, fft_size: int):
+        """(compliance_logs, common_field_logs, packet_logs, ffts) over all stored segments"""
+        segments = [_segment_tables(_load_npz(store.load(name))) for name in self.segments]
+        tables = [tables for tables, _ in segments]
+        ffts = [segment_ffts for _, segment_ffts in segments if len(segment_ffts)]
+        ffts = np.concatenate(ffts) if ffts else np.empty((0, fft_size), dtype=np.float32)
+        compliance_logs = _concat_columns([t.get("compliance", {}) for t in tables])
+        common_field_logs = _concat_columns([t.get("common_fields", {}) for t in tables])
+        packet_logs = {}
+        for pkt_type in sorted({int(name.split("/")[1]) for t in tables for name in t if name.startswith("packets/")}):
+            packet_logs[pkt_type] = _concat_columns([t[f"packets/{pkt_type}"] for t in tables if f"packets/{pkt_type}" in t])
+        return compliance_logs, common_field_logs, packet_logs, ffts
+
+
+def process_pcap_resumable(read_range, size: int, checkpoint_store, source_id: str, packet_offset_bytes=0,
+                           max_time_spent=None, checkpoint_packets: int=DEFAULT_CHECKPOINT_PACKETS,
+                           fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular", keep_ffts=True,
+                           spectral_accumulators: StreamSpectralAccumulators=None, packet_filter=None, ns_timestamps: bool=False,
+                           chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY):
+    """
+    process_pcap in segments of `checkpoint_packets` packets, writing each segment's
+    columnar results to `checkpoint_store` and saving a checkpoint after each one,
+    and resuming from the stored checkpoint if there is one. A run stops before
+    starting a segment that is not expected to finish within `max_time_spent` seconds,
+    which also covers loading the checkpoint and reading the results back.
+    keep_ffts=False skips the per-packet spectra, by far the largest stored results.
+
+    Returns (compliance_logs, common_field_logs, packet_logs, ffts, spectral_accumulators, complete).
+    Segment results are only read back once every packet has been processed:
+    complete is True when the results (dicts of column arrays over all runs) are
+    returned, otherwise they are None and another run is needed. A run that
+    finishes the capture without time left to read the results leaves that to the next run.
+    """
+    from difi_utils.stream_from_cloud import process_pcap
+
+    start_t = time.monotonic()
+    source = {"source_id": source_id, "size": size, "packet_offset_bytes": packet_offset_bytes,
+              "fft_size": fft_size, "fft_window": fft_window, "keep_ffts": keep_ffts, "ns_timestamps": ns_timestamps,
+              "packet_filter": packet_filter.criteria() if packet_filter is not None else None}
+    checkpoint = PcapCheckpoint.load(checkpoint_store)
+    if checkpoint is not None:
+        if checkpoint.version != CHECKPOINT_VERSION or checkpoint.source != source:
+            raise ValueError(f"checkpoint does not match this capture/settings: {checkpoint.source}")
+        print(f"resuming at packet {checkpoint.index}, byte offset {checkpoint.offset}")
+    else:
+        checkpoint = PcapCheckpoint(source, spectral_accumulators)
+
+    save_seconds = 0.0
+    saved_segments = 0
+
+    if not checkpoint.complete:
+        cursor = PcapRecordCursor(read_range, size, offset=checkpoint.offset, index=checkpoint.index,
+                                  ns_timestamps=ns_timestamps, chunk_size=chunk_size, max_concurrency=max_concurrency)
+        records = iter(cursor)
+        slowest_segment = 0.0
+        while True:
+            elapsed = time.monotonic() - start_t
+            if max_time_spent and elapsed + slowest_segment > max_time_spent:
+                print(f"stopping at packet {checkpoint.index} to stay within {max_time_spent}s")
+                break
+            segment_start_t = time.monotonic()
+            segment_index = cursor.index
+            segment = process_pcap(pcap_stream=islice(records, checkpoint_packets),
+                                   packet_offset_bytes=packet_offset_bytes,
+                                   fft_size=fft_size,
+                                   fft_window=fft_window,
+                                   keep_ffts=keep_ffts,
+                                   spectral_accumulators=checkpoint.spectral_accumulators,
+                                   columnar=True,
+                                   packet_filter=packet_filter,
+                                   first_index=segment_index,
+                                   linktype=cursor.linktype)
+            checkpoint.offset = cursor.offset
+            checkpoint.index = cursor.index
+            checkpoint.complete = cursor.index - segment_index < checkpoint_packets
+            if cursor.index > segment_index:
+                save_start_t = time.monotonic()
+                checkpoint.save_segment(checkpoint_store, segment_index, *segment)
+                save_seconds += time.monotonic() - save_start_t
+                saved_segments += 1
+            checkpoint.save(checkpoint_store)
+            slowest_segment = max(slowest_segment, time.monotonic() - segment_start_t)
+            if checkpoint.complete:
+                break
+
+    if not checkpoint.complete:
+        return None, None, None, None, checkpoint.spectral_accumulators, False
+    # reading a segment back is assumed to take about as long as writing it did
+    load_estimate = save_seconds / saved_segments * len(checkpoint.segments) if saved_segments else 0.0
+    if max_time_spent and saved_segments and time.monotonic() - start_t + load_estimate > max_time_spent:
+        print(f"all packets processed, the results of {len(checkpoint.segments)} segments are read by the next run")
+        return None, None, None, None, checkpoint.spectral_accumulators, False
+    compliance_logs, common_field_logs, packet_logs, ffts = checkpoint.results(checkpoint_store, fft_size)
+    return compliance_logs, common_field_logs, packet_logs, ffts, checkpoint.spectral_accumulators, True
+
+
+def process_pcap_resumable_from_file(filename: str, checkpoint_path: str=None, **kwargs):
+    """process_pcap_resumable over a local pcap, checkpointing into the directory <filename>.ckpt by default"""
+    stat = os.stat(filename)
+    store = LocalCheckpointStore(checkpoint_path or filename + ".ckpt")
+    return process_pcap_resumable(file_range_reader(filename), stat.st_size, store,
+                                  source_id=f"{os.path.abspath(filename)}#{stat.st_mtime_ns}", **kwargs)
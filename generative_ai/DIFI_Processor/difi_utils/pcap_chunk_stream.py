@@ -0,0 +1,134 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from difi_utils.capture_stream import iter_capture_chunks
+
+##################
+# chunked pcap streaming - parses pcap/pcapng records out of a sequence of byte
+# chunks, stitching records that straddle chunk boundaries
+##################
+
+DEFAULT_CHUNK_SIZE = 4 * 2**20        # 4 MiB, same as the azure blob default max_chunk_get_size
+MIN_CHUNK_SIZE = 2**16                # keeps the number of ranged reads per frame small
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_BUFFER_BYTES = 64 * 2**20  # cap on bytes held by in-flight + not yet parsed chunks
+
+
+class PcapChunkPacketStreamer(object):
+    """
+    Iterates (ts, buf) records of a pcap/pcapng capture from the byte chunks
+    returned by iter_chunks(). Subclasses supply iter_chunks(); chunks must be
+    consecutive and in file order.
+
+    :param ns_timestamps: yield integer nanosecond timestamps instead of float seconds
+    :param strict: raise on a truncated or corrupt final record instead of warning
+    """
+
+    def __init__(self, ns_timestamps: bool=False, strict: bool=False):
+        self.ns_timestamps = ns_timestamps
+        self.strict = strict
+        self.__iter = iter(self)
+
+    def __next__(self):
+        return next(self.__iter)
+
+    def iter_chunks(self):
+        raise NotImplementedError
+
+    @property
+    def linktype(self):
+        """pcap link type of the frames, known once the first record has been read"""
+        return self.__records.linktype
+
+    def __iter__(self):
+        self.__records = iter_capture_chunks(self.iter_chunks(), ns_timestamps=self.ns_timestamps, strict=self.strict)
+        return self.__records
+
+
+class RangePrefetcher(object):
+    """
+    Yields consecutive chunks of an object in order while up to `max_concurrency`
+    ranged reads run ahead of the consumer on a thread pool. The number of chunks
+    requested but not yet consumed is capped so that at most `max_buffer_bytes`
+    are held in memory.
+
+    :param read_range: callable (offset, length) -> bytes
+    :param size: total object size in bytes
+    :param chunk_size: bytes per ranged read
+    :param max_concurrency: number of ranged reads in flight
+    :param max_buffer_bytes: memory budget for prefetched chunks
+    :param start_offset: first byte to read
+    """
+
+    def __init__(self, read_range, size: int, chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES, start_offset: int=0):
+        if chunk_size < MIN_CHUNK_SIZE:
+            raise ValueError("chunk_size must be at least %d bytes" % MIN_CHUNK_SIZE)
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.read_range = read_range
+        self.size = size
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        # one chunk is always held by the parser, the rest of the budget is prefetch
+        self.max_prefetch_chunks = max(1, max_buffer_bytes // chunk_size - 1)
+        self.start_offset = start_offset
+
+    def __iter__(self):
+        offsets = iter(range(self.start_offset, self.size, self.chunk_size))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            try:
+                for offset in offsets:
+                    pending.append(pool.submit(self.read_range, offset, min(self.chunk_size, self.size - offset)))
+                    if len(pending) >= self.max_prefetch_chunks:
+                        break
+                while pending:
+                    chunk = pending.popleft().result()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pending.append(pool.submit(self.read_range, offset, min(self.chunk_size, self.size - offset)))
+                    yield chunk
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class RangePcapPacketStreamer(PcapChunkPacketStreamer):
+    """
+    Streams pcap records from any object that supports ranged reads, prefetching
+    chunks concurrently so network transfer overlaps with parsing.
+
+    :param read_range: callable (offset, length) -> bytes
+    :param size: total object size in bytes
+    """
+
+    def __init__(self, read_range, size: int, chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES,
+                 ns_timestamps: bool=False):
+        self.prefetcher = RangePrefetcher(read_range, size,
+                                          chunk_size=chunk_size,
+                                          max_concurrency=max_concurrency,
+                                          max_buffer_bytes=max_buffer_bytes)
+        super().__init__(ns_timestamps=ns_timestamps)
+
+    def iter_chunks(self):
+        return iter(self.prefetcher)
+
+
+def file_range_reader(filename: str):
+    """Ranged-read callable over a local file, a stand-in for blob/object storage"""
+    def read_range(offset, length):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    return read_range
+
+
+def file_pcap_packet_streamer(filename: str, chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES,
+                              ns_timestamps: bool=False):
+    """RangePcapPacketStreamer over a local pcap/pcapng file"""
+    return RangePcapPacketStreamer(file_range_reader(filename), os.path.getsize(filename),
+                                   chunk_size=chunk_size,
+                                   max_concurrency=max_concurrency,
+                                   max_buffer_bytes=max_buffer_bytes,
+                                   ns_timestamps=ns_timestamps)
@@ -0,0 +1,290 @@
+import os
+import struct
+import dpkt
+import numpy as np
+
+from difi_utils.capture_stream import CaptureStreamParser, FILE_READ_SIZE, capture_file_linktype, ns_to_seconds, seconds_to_ns
+from difi_utils.packet_filter import LINKTYPE_ETHERNET, check_linktype, decode_ip
+
+##################
+# pcap packet offset index - one compact fixed-size record per captured packet
+# (file offset of the frame bytes, timestamp, UDP length, DIFI packet type, stream
+# ID) of a pcap or pcapng file, stored in a binary sidecar next to the capture (or
+# at any given path), so repeat queries can seek straight to the packets they need
+# instead of re-scanning the whole file
+##################
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"DIFIPIDX"
+INDEX_VERSION = 2
+# magic, version, packet_offset_bytes, pcap file size, pcap mtime (ns), record count
+INDEX_HEADER = struct.Struct("<8sHHQqQ")
+
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),        # file offset of the frame bytes (after the pcap record header / pcapng EPB fields)
+    ("timestamp_ns", "<i8"),  # capture timestamp, integer nanoseconds
+    ("caplen", "<u4"),        # captured frame length
+    ("stream_id", "<u4"),     # DIFI stream ID, 0 when the payload is too short
+    ("udp_len", "<u2"),       # UDP payload length, 0 for non-UDP frames
+    ("pkt_type", "i1"),       # DIFI packet type nibble, -1 for non-UDP frames
+    ("reserved", "u1"),
+])
+
+NOT_UDP = -1
+
+
+def index_path(pcap_file: str):
+    return pcap_file + INDEX_SUFFIX
+
+
+def _classify_frame(buf, packet_offset_bytes, linktype=LINKTYPE_ETHERNET):
+    """(udp_len, pkt_type, stream_id) of one frame"""
+    try:
+        ip_payload = decode_ip(buf, linktype).data
+    except (dpkt.UnpackError, AttributeError):
+        return 0, NOT_UDP, 0
+    if type(ip_payload) is not dpkt.udp.UDP:
+        return 0, NOT_UDP, 0
+    data = ip_payload.data
+    payload = data[packet_offset_bytes:]
+    pkt_type = (payload[0] >> 4) if len(payload) >= 1 else NOT_UDP
+    stream_id = struct.unpack(">I", payload[4:8])[0] if len(payload) >= 8 else 0
+    return min(len(data), 0xffff), pkt_type, stream_id
+
+
+def build_pcap_index(pcap_file: str, packet_offset_bytes=0, write_sidecar=True, index_file: str=None):
+    """
+    Scan a pcap or pcapng file once and return its PcapIndex. By default the index
+    is saved to `index_file` (<pcap>.idx when not given); a sidecar that cannot be
+    written, e.g. next to a read-only capture, is reported and the index is only
+    kept in memory.
+    """
+    stat = os.stat(pcap_file)
+    records = np.empty(1024, dtype=INDEX_DTYPE)
+    count = 0
+    parser = CaptureStreamParser(ns_timestamps=True)
+    linktype = None
+    with open(pcap_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(FILE_READ_SIZE), b""):
+            # a truncated final record is left unparsed
+            for ts_ns, buf in parser.feed(chunk):
+                if count == len(records):
+                    records = np.resize(records, 2 * len(records))
+                if linktype is None:
+                    linktype = check_linktype(parser.linktype)
+                udp_len, pkt_type, stream_id = _classify_frame(buf, packet_offset_bytes, linktype)
+                records[count] = (parser.data_offset, ts_ns, len(buf), stream_id, udp_len, pkt_type, 0)
+                count += 1
+
+    index = PcapIndex(records[:count].copy(), packet_offset_bytes, stat.st_size, stat.st_mtime_ns)
+    if write_sidecar:
+        path = index_file or index_path(pcap_file)
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"Could not write pcap index {path} ({e}), keeping it in memory only")
+    return index
+
+
+def load_pcap_index(pcap_file: str, packet_offset_bytes=0, rebuild=True, index_file: str=None):
+    """
+    Load the index of `pcap_file` from `index_file` (<pcap>.idx when not given). A
+    missing or stale index (pcap size or mtime changed, different
+    packet_offset_bytes, older index version) is rebuilt when `rebuild` is set.
+    """
+    path = index_file or index_path(pcap_file)
+    if os.path.exists(path):
+        try:
+            index = PcapIndex.load(path)
+        except ValueError:
+            index = None
+        stat = os.stat(pcap_file)
+        if (index is not None and index.pcap_size == stat.st_size and index.pcap_mtime_ns == stat.st_mtime_ns
+                and index.packet_offset_bytes == packet_offset_bytes):
+            return index
+    if not rebuild:
+        raise FileNotFoundError(f"no up to date pcap index at {path}")
+    return build_pcap_index(pcap_file, packet_offset_bytes, index_file=index_file)
+
+
+class PcapIndex(object):
+    """
+    Per-packet records of one pcap file (see INDEX_DTYPE). Row i describes pcap
+    packet i, so positions returned by the select methods are original pcap_index values.
+    Time bounds are given in seconds (t0/t1, floats or exact decimal strings) or
+    integer nanoseconds (t0_ns/t1_ns) and compared in nanoseconds.
+
+    :param records: structured array of INDEX_DTYPE
+    :param packet_offset_bytes: bytes skipped before the DIFI header when classifying
+    :param pcap_size: size of the indexed pcap file
+    :param pcap_mtime_ns: modification time of the indexed pcap file
+    """
+
+    def __init__(self, records, packet_offset_bytes=0, pcap_size=0, pcap_mtime_ns=0):
+        self.records = records
+        self.packet_offset_bytes = packet_offset_bytes
+        self.pcap_size = pcap_size
+        self.pcap_mtime_ns = pcap_mtime_ns
+        self._time_sorted = bool(np.all(np.diff(records["timestamp_ns"]) >= 0))
+
+    def __len__(self):
+        return len(self.records)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.packet_offset_bytes,
+                                      self.pcap_size, self.pcap_mtime_ns, len(self.records)))
+            f.write(self.records.tobytes())
+
+    @classmethod
+    def load(cls, path: str):
+        """Load a sidecar; the records are memory-mapped, not read into memory"""
+        with open(path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            raise ValueError(f"truncated pcap index {path}")
+        magic, version, packet_offset_bytes, pcap_size, pcap_mtime_ns, count = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path} is not a version {INDEX_VERSION} pcap index")
+        if count:
+            records = np.memmap(path, dtype=INDEX_DTYPE, mode='r', offset=INDEX_HEADER.size, shape=(count,))
+        else:
+            records = np.empty(0, dtype=INDEX_DTYPE)
+        return cls(records, packet_offset_bytes, pcap_size, pcap_mtime_ns)
+
+    def time_range(self, t0=None, t1=None, t0_ns: int=None, t1_ns: int=None):
+        """Positions of packets with t0 <= timestamp < t1"""
+        t0 = t0_ns if t0 is None else seconds_to_ns(t0)
+        t1 = t1_ns if t1 is None else seconds_to_ns(t1)
+        timestamps = self.records["timestamp_ns"]
+        if self._time_sorted:
+            start = 0 if t0 is None else int(np.searchsorted(timestamps, t0, side="left"))
+            stop = len(timestamps) if t1 is None else int(np.searchsorted(timestamps, t1, side="left"))
+            return np.arange(start, max(start, stop))
+        mask = np.ones(len(timestamps), dtype=bool)
+        if t0 is not None:
+            mask &= timestamps >= t0
+        if t1 is not None:
+            mask &= timestamps < t1
+        return np.flatnonzero(mask)
+
+    def select(self, start=None, stop=None, t0=None, t1=None, stream_id=None, pkt_type=None, t0_ns: int=None, t1_ns: int=None):
+        """
+        Positions of packets matching every given criterion: packet index in
+        [start, stop), timestamp in [t0, t1), DIFI stream ID and packet type.
+        """
+        positions = self.time_range(t0, t1, t0_ns, t1_ns)
+        if start is not None or stop is not None:
+            lo = 0 if start is None else start
+            hi = len(self.records) if stop is None else stop
+            positions = positions[(positions >= lo) & (positions < hi)]
+        if stream_id is not None or pkt_type is not None:
+            rows = self.records[positions]
+            mask = rows["pkt_type"] != NOT_UDP
+            if stream_id is not None:
+                mask &= rows["stream_id"] == stream_id
+            if pkt_type is not None:
+                mask &= rows["pkt_type"] == pkt_type
+            positions = positions[mask]
+        return positions
+
+    def stream_ids(self):
+        """Distinct DIFI stream IDs in the capture"""
+        rows = self.records[self.records["pkt_type"] != NOT_UDP]
+        return np.unique(rows["stream_id"])
+
+
+class IndexedPcapReader(object):
+    """
+    Random access to the packets of a pcap file through its PcapIndex.
+    Selections iterate (ts, buf) like dpkt.pcap.Reader, so they can be passed
+    straight to process_pcap; `positions` holds the original packet indices of
+    the last selection.
+
+    :param pcap_file: pcap or pcapng file
+    :param index: PcapIndex of the file, loaded (or built) from the sidecar if not given
+    :param packet_offset_bytes: used when loading/building the index
+    :param index_file: index path, <pcap_file>.idx by default
+    :param ns_timestamps: yield integer nanosecond timestamps instead of float seconds
+
+    `linktype` is the pcap link type of the frames, for udp_view.
+    """
+
+    def __init__(self, pcap_file: str, index: PcapIndex=None, packet_offset_bytes=0, index_file: str=None,
+                 ns_timestamps: bool=False):
+        self.pcap_file = pcap_file
+        self.index = index if index is not None else load_pcap_index(pcap_file, packet_offset_bytes, index_file=index_file)
+        self.ns_timestamps = ns_timestamps
+        self.linktype = capture_file_linktype(pcap_file)
+        self.positions = np.arange(len(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _timestamp(self, record):
+        ts_ns = int(record["timestamp_ns"])
+        return ts_ns if self.ns_timestamps else ns_to_seconds(ts_ns)
+
+    def read_packet(self, position: int):
+        """(ts, buf) of one packet by pcap index"""
+        record = self.index.records[position]
+        with open(self.pcap_file, 'rb') as f:
+            f.seek(int(record["offset"]))
+            return self._timestamp(record), f.read(int(record["caplen"]))
+
+    def packets(self, positions):
+        """Iterate (ts, buf) for the given packet indices, in the given order"""
+        self.positions = np.asarray(positions, dtype=np.int64)
+        return self._iter_positions(self.positions)
+
+    def _iter_positions(self, positions):
+        records = self.index.records
+        # seeks within the read buffer are cheap, so runs of consecutive packets stay sequential reads
+        with open(self.pcap_file, 'rb', buffering=2**20) as f:
+            for position in positions:
+                record = records[position]
+                f.seek(int(record["offset"]))
+                yield self._timestamp(record), f.read(int(record["caplen"]))
+
+    def by_index(self, start=None, stop=None):
+        return self.packets(self.index.select(start=start, stop=stop))
+
+    def by_time(self, t0=None, t1=None, t0_ns: int=None, t1_ns: int=None):
+        return self.packets(self.index.time_range(t0, t1, t0_ns, t1_ns))
+
+    def by_stream(self, stream_id: int, pkt_type: int=None):
+        return self.packets(self.index.select(stream_id=stream_id, pkt_type=pkt_type))
+
+    def select(self, **criteria):
+        """Iterate (ts, buf) for PcapIndex.select(**criteria)"""
+        return self.packets(self.index.select(**criteria))
+
+
+def _remap_pcap_index(logs, positions):
+    """Replace selection-relative pcap_index values with original packet indices"""
+    if isinstance(logs, dict):
+        logs["pcap_index"] = positions[logs["pcap_index"]]
+        return
+    for entry in logs:
+        entry["pcap_index"] = int(positions[entry["pcap_index"]])
+
+
+def process_pcap_indexed(pcap_file: str, packet_offset_bytes=0, index: PcapIndex=None, process_kwargs: dict=None,
+                         index_file: str=None, **criteria):
+    """
+    process_pcap over the packets of `pcap_file` matching `criteria` (see
+    PcapIndex.select), read by seeking through the sidecar index. pcap_index
+    values in the results refer to the original packet positions.
+    """
+    from difi_utils.stream_from_cloud import process_pcap
+    reader = IndexedPcapReader(pcap_file, index=index, packet_offset_bytes=packet_offset_bytes, index_file=index_file)
+    positions = reader.index.select(**criteria)
+    compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=reader.packets(positions),
+                                                                   packet_offset_bytes=packet_offset_bytes,
+                                                                   linktype=reader.linktype,
+                                                                   **(process_kwargs or {}))
+    _remap_pcap_index(compliance_logs, positions)
+    _remap_pcap_index(common_field_logs, positions)
+    for logs in packet_logs.values():
+        _remap_pcap_index(logs, positions)
+    return compliance_logs, common_field_logs, packet_logs, ffts
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+##################
+# warm-start resources - process-wide objects that are expensive to create (boto3
+# clients and their connection pools, parsed configuration, the matplotlib backend)
+# are created on first use and reused by every later call, so warm Lambda
+# invocations only pay per-request cost. InvocationTimer reports the two apart.
+##################
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32   # covers ranged-GET prefetch plus upload threads per record
+DEFAULT_MAX_ATTEMPTS = 5
+
+PROCESS_START = time.perf_counter()
+
+_lock = threading.RLock()
+_clients = {}
+_config = None
+_matplotlib_ready = False
+
+
+def get_client(service: str, max_pool_connections: int=DEFAULT_MAX_POOL_CONNECTIONS, **kwargs):
+    """Shared boto3 client for `service` (clients are thread safe), created on first use"""
+    cache_key = (service, max_pool_connections, tuple(sorted(kwargs.items())))
+    client = _clients.get(cache_key)
+    if client is None:
+        with _lock:
+            client = _clients.get(cache_key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(max_pool_connections=max_pool_connections,
+                                retries={'max_attempts': DEFAULT_MAX_ATTEMPTS, 'mode': 'adaptive'})
+                client = _clients[cache_key] = boto3.client(service, config=config, **kwargs)
+    return client
+
+
+def get_s3_client():
+    return get_client('s3')
+
+
+class PipelineConfig(object):
+    """Lambda pipeline settings parsed once from the environment"""
+
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        self.results_bucket = environ.get('RESULTS_BUCKET')
+        # 'subprocess' runs extract_payload.py + s3_plot_csv.py, 'fused' opts in to pcap_to_constellations
+        self.pipeline_mode = environ.get('PIPELINE_MODE', 'subprocess')
+        self.max_packets = int(environ.get('MAX_PACKETS', '100'))
+        self.output_prefix = environ.get('OUTPUT_PREFIX', 'packet')
+        self.num_plots = int(environ.get('NUM_PLOTS', '20'))
+        self.every_nth = int(environ.get('EVERY_NTH', '1'))
+        self.aggregate = int(environ.get('AGGREGATE', '1'))
+        self.plot_renderer = environ.get('PLOT_RENDERER', 'scatter')
+        # fixed I/Q axis limit shared by every plot, unset = 128 for raster images, autoscale for scatter
+        self.plot_limit = float(environ['PLOT_LIMIT']) if environ.get('PLOT_LIMIT') else None
+        self.record_concurrency = int(environ.get('RECORD_CONCURRENCY', '4'))
+        # render processes would be forked from the record threads, which can deadlock
+        # and oversubscribes the cores the records already share: render in-thread by
+        # default when records run concurrently, else one process per core (0)
+        self.plot_workers = int(environ.get('PLOT_WORKERS', '1' if self.record_concurrency > 1 else '0'))
+
+
+def get_config():
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = PipelineConfig()
+    return _config
+
+
+def ensure_matplotlib():
+    """Select the Agg backend and import the figure/Agg modules once"""
+    global _matplotlib_ready
+    if not _matplotlib_ready:
+        with _lock:
+            if not _matplotlib_ready:
+                import matplotlib
+                matplotlib.use("Agg")
+                import matplotlib.figure
+                import matplotlib.backends.backend_agg
+                _matplotlib_ready = True
+
+
+def reset():
+    """Drop the cached clients and config (tests, or after changing the environment)"""
+    global _config
+    with _lock:
+        _clients.clear()
+        _config = None
+
+
+class InvocationTimer(object):
+    """
+    Times handler invocations and logs one JSON line per invocation. The first
+    invocation of a process is the cold start: its init_ms covers module import
+    and resource setup up to the first request.
+
+    :param name: label in the log line
+    """
+
+    def __init__(self, name: str="handler"):
+        self.name = name
+        self.invocations = 0
+        self.init_ms = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.init_ms is None:
+            self.init_ms = (self.start - PROCESS_START) * 1000
+        self.invocations += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        import json
+        request_ms = (time.perf_counter() - self.start) * 1000
+        cold = self.invocations == 1
+        print(json.dumps({"timer": self.name,
+                          "cold_start": cold,
+                          "init_ms": round(self.init_ms, 1) if cold else 0.0,
+                          "request_ms": round(request_ms, 1),
+                          "invocation": self.invocations}))
@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+##################
+# concurrent S3 uploader - files are submitted as soon as they exist and uploaded
+# by a bounded thread pool. Throttling, 5xx and connection errors are retried with
+# exponential backoff and jitter; anything else (AccessDenied, NoSuchBucket, a
+# missing local file) fails the upload straight away
+##################
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF_BASE = 0.5      # seconds before the first retry, doubled per attempt
+DEFAULT_BACKOFF_MAX = 8.0
+RETRYABLE_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                         'TooManyRequestsException', 'RequestTimeout', 'InternalError', 'ServiceUnavailable')
+
+
+def is_retryable_error(error):
+    """Throttling, 5xx and connection errors, also when wrapped (e.g. in boto3's S3UploadFailedError)"""
+    from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+    while error is not None:
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+            return code in RETRYABLE_ERROR_CODES or status >= 500
+        if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class ConcurrentS3Uploader(object):
+    """
+    Uploads local files to one bucket from a bounded thread pool. Use as a
+    context manager; leaving the block waits for every pending upload.
+
+    :param s3_client: boto3 S3 client (clients are thread safe), or any object with upload_file
+    :param bucket: destination bucket
+    :param max_concurrency: upload threads
+    :param max_attempts: tries per file before a retryable error is raised
+    :param backoff_base: delay before the first retry in seconds, doubled on each further retry
+    """
+
+    def __init__(self, s3_client, bucket: str, max_concurrency: int=DEFAULT_UPLOAD_CONCURRENCY,
+                 max_attempts: int=DEFAULT_MAX_ATTEMPTS, backoff_base: float=DEFAULT_BACKOFF_BASE,
+                 backoff_max: float=DEFAULT_BACKOFF_MAX):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._pool.shutdown(wait=True)
+
+    def submit(self, filename: str, key: str):
+        """Queue one upload"""
+        self._futures[key] = self._pool.submit(self._upload, filename, key)
+
+    def _upload(self, filename, key):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.s3_client.upload_file(filename, self.bucket, key)
+                return key
+            except Exception as e:
+                if attempt == self.max_attempts or not is_retryable_error(e):
+                    raise
+                with self._retries_lock:
+                    self.retries += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def wait(self, keys=None):
+        """
+        Wait for the uploads of `keys` (default: all submitted, in submission
+        order) and return those keys; the first failed upload's error is raised.
+        """
+        keys = list(self._futures) if keys is None else keys
+        return [self._futures[key].result() for key in keys]
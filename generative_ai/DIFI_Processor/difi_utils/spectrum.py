@@ -0,0 +1,377 @@
+import numpy as np
+from difi_utils.iq_ring_buffer import iq_to_complex
+
+##################
+# batched spectrum engine - collects per-packet sample blocks into a preallocated
+# matrix and computes the magnitude spectrum (dB) of a whole batch in one FFT call,
+# plus constant-memory streaming PSD / max-hold / waterfall accumulators per stream
+##################
+
+DEFAULT_FFT_SIZE = 512
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_WATERFALL_HEIGHT = 256
+
+SPECTRUM_WINDOWS = {
+    "rectangular": np.ones,
+    "hann": np.hanning,
+    "hamming": np.hamming,
+    "blackman": np.blackman,
+}
+
+
+def spectrum_window(window: str, fft_size: int):
+    """Window coefficients by name (see SPECTRUM_WINDOWS)"""
+    if window not in SPECTRUM_WINDOWS:
+        raise ValueError(f"Unsupported window '{window}'. Must be one of: {list(SPECTRUM_WINDOWS.keys())}")
+    return SPECTRUM_WINDOWS[window](fft_size).astype(np.float32)
+
+
+def power_spectrum(blocks, window=None):
+    """fftshift-ed |FFT|^2 of each row of a 2-D block"""
+    if window is not None:
+        blocks = blocks * window
+    spectra = np.fft.fftshift(np.fft.fft(blocks, axis=1), axes=1)
+    return spectra.real**2 + spectra.imag**2
+
+
+def to_db(power):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(power)
+
+
+def power_spectrum_db(blocks, window=None):
+    """fftshift-ed 10*log10(|FFT|^2) of each row of a 2-D block"""
+    return to_db(power_spectrum(blocks, window))
+
+
+class BatchSpectrum(object):
+    """
+    Batched replacement for per-packet
+    10*np.log10(np.abs(np.fft.fftshift(np.fft.fft(samples[0:512])))**2).
+
+    Each add() copies the first `fft_size` samples of a packet into the next row of
+    a preallocated (batch_size, fft_size) matrix (zero padded if the packet is
+    shorter). Full batches are transformed with one FFT and written into a single
+    growable (N, fft_size) result array.
+
+    :param fft_size: samples per spectrum
+    :param window: window name (see SPECTRUM_WINDOWS), 'rectangular' matches the original output
+    :param batch_size: rows transformed per FFT call
+    """
+
+    def __init__(self, fft_size: int=DEFAULT_FFT_SIZE, window: str="rectangular", batch_size: int=DEFAULT_BATCH_SIZE):
+        self.fft_size = fft_size
+        self.window = None if window == "rectangular" else spectrum_window(window, fft_size)
+        self._block = np.zeros((batch_size, fft_size), dtype=np.float32)
+        self._block_rows = 0
+        self._result = np.empty((0, fft_size), dtype=np.float32)
+        self._result_rows = 0
+
+    def __len__(self):
+        return self._result_rows + self._block_rows
+
+    def add(self, samples):
+        """Queue one packet's samples"""
+        row = self._block[self._block_rows]
+        n = min(len(samples), self.fft_size)
+        row[:n] = samples[:n]
+        row[n:] = 0
+        self._block_rows += 1
+        if self._block_rows == len(self._block):
+            self.flush()
+
+    def flush(self):
+        """Transform any queued rows into the result array"""
+        if self._block_rows == 0:
+            return
+        needed = self._result_rows + self._block_rows
+        if needed > len(self._result):
+            grown = np.empty((max(needed, 2 * len(self._result)), self.fft_size), dtype=np.float32)
+            grown[:self._result_rows] = self._result[:self._result_rows]
+            self._result = grown
+        self._result[self._result_rows:needed] = power_spectrum_db(self._block[:self._block_rows], self.window)
+        self._result_rows = needed
+        self._block_rows = 0
+
+    def result(self):
+        """All spectra so far as one (N, fft_size) array in dB"""
+        self.flush()
+        return self._result[:self._result_rows]
+
+
+class StreamingSpectrum(object):
+    """
+    Constant-memory spectral summary of one stream.
+
+    Packets are taken as complex baseband I+jQ (interleaved I/Q items, as in
+    DifiDataPacket.samples, are paired up first), so the spectrum is two-sided
+    and the bins span -fs/2..fs/2. Every packet is split into `fft_size`
+    segments with 50% overlap. The windowed periodograms of those segments
+    feed three accumulators:
+      - a running Welch PSD: the mean of all segment periodograms
+      - max-hold: the per-bin maximum over all segments
+      - a waterfall with a fixed `waterfall_height` rows, one packet per row at
+        first. When the rows run out, adjacent rows are merged pairwise and each
+        row then covers twice as many packets, so time is binned adaptively.
+    Segments are queued in a preallocated block and transformed `batch_size` at
+    a time.
+
+    :param fft_size: complex samples per segment
+    :param window: window name (see SPECTRUM_WINDOWS)
+    :param waterfall_height: number of waterfall rows (even)
+    :param sample_rate: samples per second, scales the PSD to power per Hz when known
+    """
+
+    def __init__(self, fft_size: int=DEFAULT_FFT_SIZE, window: str="hann", waterfall_height: int=DEFAULT_WATERFALL_HEIGHT,
+                 batch_size: int=DEFAULT_BATCH_SIZE, sample_rate: float=None):
+        if waterfall_height < 2 or waterfall_height % 2:
+            raise ValueError("waterfall_height must be an even number >= 2")
+        self.fft_size = fft_size
+        self.hop = max(1, fft_size // 2)
+        self.window = spectrum_window(window, fft_size)
+        self.window_power = float(np.sum(self.window.astype(np.float64)**2))
+        self.sample_rate = sample_rate
+
+        self._block = np.zeros((batch_size, fft_size), dtype=np.complex64)
+        self._block_packet = np.zeros(batch_size, dtype=np.int64)  # packet number of each queued segment
+        self._block_rows = 0
+
+        self.packet_count = 0
+        self.segment_count = 0
+        self._psd_sum = np.zeros(fft_size, dtype=np.float64)
+        self._max_hold = np.zeros(fft_size, dtype=np.float64)
+
+        self._waterfall = np.zeros((waterfall_height, fft_size), dtype=np.float64)
+        self._waterfall_segments = np.zeros(waterfall_height, dtype=np.int64)
+        self._waterfall_packets = np.zeros(waterfall_height, dtype=np.int64)
+        self.packets_per_row = 1
+        self._row = 0
+        self._last_row_packet = None
+
+    def add(self, samples):
+        """Queue one packet's samples: interleaved I/Q items, an (N, 2) array or complex samples"""
+        samples = np.asarray(samples)
+        if not np.iscomplexobj(samples):
+            if samples.ndim == 1:
+                samples = samples[:len(samples) - (len(samples) % 2)].reshape(-1, 2)
+            samples = iq_to_complex(samples)
+        if len(samples) < self.fft_size:
+            starts = [0]
+        else:
+            starts = range(0, len(samples) - self.fft_size + 1, self.hop)
+        for start in starts:
+            row = self._block[self._block_rows]
+            segment = samples[start:start + self.fft_size]
+            row[:len(segment)] = segment
+            row[len(segment):] = 0
+            self._block_packet[self._block_rows] = self.packet_count
+            self._block_rows += 1
+            if self._block_rows == len(self._block):
+                self.flush()
+        self.packet_count += 1
+
+    def flush(self):
+        """Fold any queued segments into the accumulators"""
+        if self._block_rows == 0:
+            return
+        power = power_spectrum(self._block[:self._block_rows], self.window)
+        self._psd_sum += power.sum(axis=0)
+        np.maximum(self._max_hold, power.max(axis=0), out=self._max_hold)
+        self.segment_count += self._block_rows
+        for power_row, packet in zip(power, self._block_packet[:self._block_rows]):
+            self._add_waterfall(power_row, packet)
+        self._block_rows = 0
+
+    def _add_waterfall(self, power_row, packet):
+        if packet != self._last_row_packet:
+            if self._waterfall_packets[self._row] == self.packets_per_row:
+                self._row += 1
+                if self._row == len(self._waterfall):
+                    self._merge_waterfall_rows()
+            self._waterfall_packets[self._row] += 1
+            self._last_row_packet = packet
+        self._waterfall[self._row] += power_row
+        self._waterfall_segments[self._row] += 1
+
+    def _merge_waterfall_rows(self):
+        half = len(self._waterfall) // 2
+        for arr in (self._waterfall, self._waterfall_segments, self._waterfall_packets):
+            arr[:half] = arr[0::2] + arr[1::2]
+            arr[half:] = 0
+        self.packets_per_row *= 2
+        self._row = half
+
+    def _scale(self):
+        if self.sample_rate:
+            return 1.0 / (self.sample_rate * self.window_power)
+        return 1.0 / self.window_power
+
+    def psd(self):
+        """Welch PSD averaged over all segments (linear)"""
+        self.flush()
+        if self.segment_count == 0:
+            return np.zeros(self.fft_size)
+        return self._psd_sum / self.segment_count * self._scale()
+
+    def psd_db(self):
+        return to_db(self.psd())
+
+    def max_hold_db(self):
+        """Per-bin maximum periodogram over all segments, same scaling as psd_db()"""
+        self.flush()
+        return to_db(self._max_hold * self._scale())
+
+    def spectrogram_db(self):
+        """
+        Waterfall rows filled so far as a (rows, fft_size) array in dB, oldest first.
+        Row i averages waterfall_packets()[i] packets.
+        """
+        self.flush()
+        rows = np.count_nonzero(self._waterfall_segments)
+        with np.errstate(invalid='ignore'):
+            averaged = self._waterfall[:rows] / self._waterfall_segments[:rows, np.newaxis]
+        return to_db(averaged * self._scale())
+
+    def waterfall_packets(self):
+        """Number of packets binned into each filled waterfall row"""
+        self.flush()
+        return self._waterfall_packets[:np.count_nonzero(self._waterfall_segments)].copy()
+
+    def state(self):
+        """Accumulators and counters as a dict of arrays, see from_state()"""
+        self.flush()
+        counters = (self.packet_count, self.segment_count, self.packets_per_row, self._row,
+                    -1 if self._last_row_packet is None else self._last_row_packet, len(self._block))
+        return {
+            "window": self.window,
+            "sample_rate": np.array(self.sample_rate or 0.0),
+            "counters": np.array(counters, dtype=np.int64),
+            "psd_sum": self._psd_sum,
+            "max_hold": self._max_hold,
+            "waterfall": self._waterfall,
+            "waterfall_segments": self._waterfall_segments,
+            "waterfall_packets": self._waterfall_packets,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a StreamingSpectrum saved with state()"""
+        window = np.asarray(state["window"], dtype=np.float32)
+        packet_count, segment_count, packets_per_row, row, last_row_packet, batch_size = (int(v) for v in state["counters"])
+        spectrum = cls(fft_size=len(window), waterfall_height=len(state["waterfall"]), batch_size=batch_size,
+                       sample_rate=float(state["sample_rate"]) or None)
+        spectrum.window = window
+        spectrum.window_power = float(np.sum(window.astype(np.float64)**2))
+        spectrum.packet_count = packet_count
+        spectrum.segment_count = segment_count
+        spectrum.packets_per_row = packets_per_row
+        spectrum._row = row
+        spectrum._last_row_packet = None if last_row_packet < 0 else last_row_packet
+        spectrum._psd_sum[:] = state["psd_sum"]
+        spectrum._max_hold[:] = state["max_hold"]
+        spectrum._waterfall[:] = state["waterfall"]
+        spectrum._waterfall_segments[:] = state["waterfall_segments"]
+        spectrum._waterfall_packets[:] = state["waterfall_packets"]
+        return spectrum
+
+    def frequencies(self):
+        """Bin centres in Hz (or cycles/sample if the sample rate is unknown), fftshift order"""
+        return np.fft.fftshift(np.fft.fftfreq(self.fft_size, d=1.0 / self.sample_rate if self.sample_rate else 1.0))
+
+    def render(self, filename: str, title: str=None, dpi=150):
+        """Save PSD/max-hold and waterfall plots to an image file"""
+        import matplotlib.pyplot as plt
+
+        freqs = self.frequencies()
+        fig, (ax_psd, ax_wf) = plt.subplots(2, 1, figsize=(8, 8), sharex=True)
+        ax_psd.plot(freqs, self.psd_db(), label="Welch PSD", linewidth=0.8)
+        ax_psd.plot(freqs, self.max_hold_db(), label="Max hold", linewidth=0.8, alpha=0.7)
+        ax_psd.set_ylabel("Power (dB)")
+        ax_psd.grid(True, alpha=0.3)
+        ax_psd.legend(loc="upper right", fontsize=8)
+
+        spectrogram = self.spectrogram_db()
+        ax_wf.imshow(spectrogram, aspect="auto", origin="lower", interpolation="nearest",
+                     extent=(freqs[0], freqs[-1], 0, max(1, len(spectrogram))))
+        ax_wf.set_xlabel("Frequency (Hz)" if self.sample_rate else "Frequency (cycles/sample)")
+        ax_wf.set_ylabel(f"Row ({self.packets_per_row} packets/row)")
+        if title:
+            fig.suptitle(title)
+        fig.savefig(filename, dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+        return filename
+
+
+class StreamSpectralAccumulators(object):
+    """
+    StreamingSpectrum per DIFI stream ID, created on the first data packet of each
+    stream. Sample rates are picked up from standard context packets.
+    Keyword arguments are passed to each StreamingSpectrum.
+    """
+
+    def __init__(self, **spectrum_kwargs):
+        self.spectrum_kwargs = spectrum_kwargs
+        self.streams = {}
+        self.sample_rates = {}
+
+    def __getitem__(self, stream_id):
+        return self.streams[stream_id]
+
+    def __contains__(self, stream_id):
+        return stream_id in self.streams
+
+    def __iter__(self):
+        return iter(self.streams)
+
+    def items(self):
+        return self.streams.items()
+
+    def update_context(self, pkt):
+        """Record the sample rate from a standard context packet"""
+        sample_rate = getattr(pkt, "sample_rate", None)
+        if sample_rate:
+            self.sample_rates[pkt.stream_id] = sample_rate
+            if pkt.stream_id in self.streams:
+                self.streams[pkt.stream_id].sample_rate = sample_rate
+
+    def add_packet(self, pkt):
+        """Add a data packet's samples to its stream's accumulators"""
+        spectrum = self.streams.get(pkt.stream_id)
+        if spectrum is None:
+            spectrum = StreamingSpectrum(sample_rate=self.sample_rates.get(pkt.stream_id), **self.spectrum_kwargs)
+            self.streams[pkt.stream_id] = spectrum
+        spectrum.add(pkt.samples)
+
+    def state(self):
+        """
+        Every stream's StreamingSpectrum.state() as one flat dict of arrays
+        ("<stream id>/<name>"), plus the known sample rates. See from_state().
+        """
+        state = {
+            "sample_rate_streams": np.array(list(self.sample_rates.keys()), dtype=np.uint64),
+            "sample_rates": np.array(list(self.sample_rates.values()), dtype=np.float64),
+        }
+        for stream_id, spectrum in self.streams.items():
+            for name, value in spectrum.state().items():
+                state[f"{stream_id}/{name}"] = value
+        return state
+
+    @classmethod
+    def from_state(cls, state, **spectrum_kwargs):
+        """Rebuild accumulators saved with state(); spectrum_kwargs are used for new streams"""
+        accumulators = cls(**spectrum_kwargs)
+        accumulators.sample_rates = {int(stream_id): float(rate) for stream_id, rate
+                                     in zip(state["sample_rate_streams"], state["sample_rates"])}
+        stream_states = {}
+        for key in state:
+            if "/" in key:
+                stream_id, name = key.split("/", 1)
+                stream_states.setdefault(int(stream_id), {})[name] = state[key]
+        for stream_id, stream_state in stream_states.items():
+            accumulators.streams[stream_id] = StreamingSpectrum.from_state(stream_state)
+        return accumulators
+
+    def render(self, filename_prefix: str):
+        """Render every stream to <filename_prefix>_<stream id>.png, return the filenames"""
+        return [spectrum.render(f"{filename_prefix}_{stream_id:08x}.png", title=f"Stream 0x{stream_id:08x}")
+                for stream_id, spectrum in self.streams.items()]
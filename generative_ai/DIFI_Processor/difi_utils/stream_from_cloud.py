@@ -1,12 +1,10 @@
-import dpkt
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobClient, StorageStreamDownloader
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
 import io
 import struct
 import time
-from azure.storage.blob import BlobClient
 import dpkt
-import pandas as pd
 from difi_utils.noncompliant_class import DifiInfo
 from difi_utils.difi_data_packet_class import DifiDataPacket
 from difi_utils.difi_context_packet_class import DifiStandardContextPacket
@@ -14,7 +12,19 @@ from difi_utils.legacy_difi_context_packet_class import DifiStandardContextPacke
 from difi_utils.difi_version_packet_class import DifiVersionContextPacket
 from difi_utils.custom_error_types import NoncompliantDifiPacket
 from difi_utils.difi_constants import *
-import numpy as np
+from difi_utils.iq_ring_buffer import StreamRingBuffers
+from difi_utils.columnar_results import ColumnarResultBuilder
+from difi_utils.packet_filter import PacketFilter, locate_udp, decode_ip, capture_linktype, check_linktype, UDP_HEADER_LEN
+from difi_utils.spectrum import BatchSpectrum, StreamSpectralAccumulators, DEFAULT_FFT_SIZE
+from difi_utils.capture_stream import iter_capture_file
+from difi_utils.pcap_chunk_stream import PcapChunkPacketStreamer, RangePrefetcher, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_BUFFER_BYTES
+
+# azure is only needed by callers that hand in a BlobClient; the S3 and local
+# file paths import this module without it
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobClient
+
+TIME_CHECK_PACKETS = 64
 
 def process_packet(data: bytes, difi_format: str=None):
     if data is None:
@@ -43,7 +53,19 @@ def process_packet(data: bytes, difi_format: str=None):
 
     return pkt
 
-def process_pcap(pcap_stream, packet_offset_bytes=0, max_time_spent=None):
+def process_pcap(pcap_stream, packet_offset_bytes=0, max_time_spent=None, ring_buffers: StreamRingBuffers=None,
+                 fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular",
+                 spectral_accumulators: StreamSpectralAccumulators=None, keep_ffts=True, columnar=False,
+                 packet_filter: PacketFilter=None, frame_paths: dict=None, first_index: int=0, linktype: int=None):
+    """
+    Decode the DIFI packets in a stream of (ts, buf) pcap records.
+    frame_paths, if given, receives the number of frames parsed on the
+    'fixed_offset' fast path and on the 'dpkt_fallback' path.
+    columnar may also be an existing ColumnarResultBuilder to append to, and
+    first_index is the pcap_index of the first record, for resumed streams.
+    linktype is the pcap link type of the frames; by default it is read from
+    pcap_stream (see packet_filter.capture_linktype), Ethernet if it has none.
+    """
     compliance_logs = []
     compliance_logs_keys = ["pcap_timestamp", "pcap_index", "pkt_type"]
 
@@ -51,22 +73,59 @@ def process_pcap(pcap_stream, packet_offset_bytes=0, max_time_spent=None):
     common_field_logs_keys = ["pcap_timestamp", "pcap_index", "pkt_type", "class_id", "tsm", "tsi", "tsf", "seq_num", "pkt_size"]
 
     packet_logs = {}
-    ffts = []
+    # columnar=True appends fields into typed column arrays instead of keeping per-packet dicts
+    if isinstance(columnar, ColumnarResultBuilder):
+        columnar_results = columnar
+    else:
+        columnar_results = ColumnarResultBuilder() if columnar else None
+    spectrum = BatchSpectrum(fft_size=fft_size, window=fft_window)
+    frame_paths = frame_paths if frame_paths is not None else {}
+    frame_paths.setdefault("fixed_offset", 0)
+    frame_paths.setdefault("dpkt_fallback", 0)
+    linktype = None if linktype is None else check_linktype(linktype)
     start_t = time.time()
-    for pkt_count, (ts, buf) in enumerate(pcap_stream):
+    for pkt_count, (ts, buf) in enumerate(pcap_stream, start=first_index):
+        if linktype is None:
+            linktype = capture_linktype(pcap_stream)
         #print(f"ts {ts}, buflen {len(buf)}")
         if pkt_count % 100 == 0:
             print(f"processed {pkt_count} packets so far")
-        if max_time_spent and (time.time() - start_t) > max_time_spent:
-            return compliance_logs, common_field_logs, packet_logs, ffts
+        # the clock is only read every TIME_CHECK_PACKETS packets
+        if max_time_spent and pkt_count % TIME_CHECK_PACKETS == 0 and (time.time() - start_t) > max_time_spent:
+            break
+        # rejected records are dropped from the raw bytes, pcap_index keeps counting them
+        if packet_filter is not None and not packet_filter.match(ts, buf, linktype):
+            continue
         try:
-            eth = dpkt.ethernet.Ethernet(buf)
-            ip_payload = eth.data.data
-            if type(ip_payload) is dpkt.udp.UDP: # and len(ip_payload.data) > 100:
+            # plain IPv4/UDP frames are sliced at fixed offsets, anything else goes through dpkt
+            located = locate_udp(buf, linktype)
+            if located is not None:
+                frame_paths["fixed_offset"] += 1
+                udp_offset, ip_end = located
+                udp_data = buf[udp_offset + UDP_HEADER_LEN + packet_offset_bytes:ip_end]
+            else:
+                frame_paths["dpkt_fallback"] += 1
+                ip_payload = decode_ip(buf, linktype).data
+                udp_data = ip_payload.data[packet_offset_bytes:] if type(ip_payload) is dpkt.udp.UDP else None
+            if udp_data is not None: # and len(udp_data) > 100:
                 try:
-                    difi_pkt = process_packet(data=ip_payload.data[packet_offset_bytes:])
+                    difi_pkt = process_packet(data=udp_data)
                     if hasattr(difi_pkt, "samples"):
-                        ffts.append(10*np.log10(np.abs(np.fft.fftshift(np.fft.fft(difi_pkt.samples[0:512])))**2))
+                        if keep_ffts:
+                            spectrum.add(difi_pkt.samples)
+                        if ring_buffers is not None:
+                            ring_buffers.write_packet(difi_pkt)
+                        if spectral_accumulators is not None:
+                            spectral_accumulators.add_packet(difi_pkt)
+                    elif hasattr(difi_pkt, "sample_rate"):
+                        if ring_buffers is not None:
+                            ring_buffers.update_context(difi_pkt)
+                        if spectral_accumulators is not None:
+                            spectral_accumulators.update_context(difi_pkt)
+                    if columnar_results is not None:
+                        columnar_results.add_packet(difi_pkt, ts, pkt_count)
+                        continue
+
                     difi_pkt_dict = vars(difi_pkt)
                     difi_pkt_dict.update({
                         "pcap_timestamp": ts,
@@ -90,6 +149,9 @@ def process_pcap(pcap_stream, packet_offset_bytes=0, max_time_spent=None):
 
                 except NoncompliantDifiPacket as err:
                     #print(f"NoncompliantDifiPacket: {err}")
+                    if columnar_results is not None:
+                        columnar_results.add_noncompliant(ts, pkt_count)
+                        continue
                     compliance_logs.append({
                         "pcap_timestamp": ts,
                         "pcap_index": pkt_count,
@@ -100,132 +162,78 @@ def process_pcap(pcap_stream, packet_offset_bytes=0, max_time_spent=None):
             print(f"error at pkt_count {pkt_count}, ts: {ts}, buf len {len(buf)}")
             raise err
 
-    return compliance_logs, common_field_logs, packet_logs, ffts
+    if frame_paths["dpkt_fallback"]:
+        print(f"frames parsed: {frame_paths['fixed_offset']} fixed-offset, {frame_paths['dpkt_fallback']} dpkt fallback")
+    if columnar_results is not None:
+        compliance_logs, common_field_logs, packet_logs = columnar_results.results()
+    return compliance_logs, common_field_logs, packet_logs, spectrum.result()
 
 
-def process_pcap_from_blob(blob_client: BlobClient, packet_offset_bytes=0, max_time_spent=None):
-    streamer = BlobPcapPacketStreamer(blob_client=blob_client)
+def process_pcap_from_blob(blob_client: BlobClient, packet_offset_bytes=0, max_time_spent=None, ring_buffers: StreamRingBuffers=None,
+                           chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, columnar=False,
+                           packet_filter: PacketFilter=None, ns_timestamps: bool=False,
+                           fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular",
+                           spectral_accumulators: StreamSpectralAccumulators=None, keep_ffts=True):
+    streamer = BlobPcapPacketStreamer(blob_client=blob_client, chunk_size=chunk_size, max_concurrency=max_concurrency,
+                                      ns_timestamps=ns_timestamps)
     compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=streamer,
                                                                    packet_offset_bytes=packet_offset_bytes,
-                                                                   max_time_spent=max_time_spent)
+                                                                   max_time_spent=max_time_spent,
+                                                                   ring_buffers=ring_buffers,
+                                                                   fft_size=fft_size,
+                                                                   fft_window=fft_window,
+                                                                   spectral_accumulators=spectral_accumulators,
+                                                                   keep_ffts=keep_ffts,
+                                                                   columnar=columnar,
+                                                                   packet_filter=packet_filter)
     return compliance_logs, common_field_logs, packet_logs, ffts
 
 
-def process_pcap_from_file(filename: str, packet_offset_bytes=0, max_time_spent=None):
-    with open(filename, 'rb') as f:
-        pcap_stream = dpkt.pcap.Reader(f)
-        compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=pcap_stream,
-                                                                       packet_offset_bytes=packet_offset_bytes,
-                                                                       max_time_spent=max_time_spent)
+def process_pcap_from_file(filename: str, packet_offset_bytes=0, max_time_spent=None, ring_buffers: StreamRingBuffers=None, columnar=False,
+                           packet_filter: PacketFilter=None, ns_timestamps: bool=False,
+                           fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular",
+                           spectral_accumulators: StreamSpectralAccumulators=None, keep_ffts=True):
+    """process_pcap over a local pcap or pcapng file; ns_timestamps gives integer nanosecond pcap_timestamp values"""
+    pcap_stream = iter_capture_file(filename, ns_timestamps=ns_timestamps)
+    compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=pcap_stream,
+                                                                   packet_offset_bytes=packet_offset_bytes,
+                                                                   max_time_spent=max_time_spent,
+                                                                   ring_buffers=ring_buffers,
+                                                                   fft_size=fft_size,
+                                                                   fft_window=fft_window,
+                                                                   spectral_accumulators=spectral_accumulators,
+                                                                   keep_ffts=keep_ffts,
+                                                                   columnar=columnar,
+                                                                   packet_filter=packet_filter)
     return compliance_logs, common_field_logs, packet_logs, ffts
 
 
-class BlobPcapPacketStreamer(object):
-    def __init__(self, blob_client: BlobClient):
-        self.blob_client = blob_client
-        self.max_buf_size = 2**32
-        self.blob_stream = self.blob_client.download_blob()
-        self.__iter = iter(self)
-
-    def __next__(self):
-        return next(self.__iter)
-
-    def __iter__(self):
-        chunks = self.blob_stream.chunks()
-        partial_packet_buf = bytes()
-
-        handle_partial_packet = False
-        packet_residue_len = 0
-        hdr = None
-        old_ts = None
-
-        pcap_stream = None
-        pkt_count = 0
-
-        for chunk_num, chunk in enumerate(chunks):
-            #print(f"chunk num {chunk_num} size {len(chunk)}")
-            chunk_buf = io.BytesIO(initial_bytes=chunk)
-            if handle_partial_packet:
-                if hdr is None:
-                    missing_bytes = pcap_stream.pcap_header_len() - len(partial_packet_buf)
-                    #print(f"{missing_bytes} missing bytes from header, {len(chunk)-chunk_buf.tell()} bytes left in buffer")
-                    residue_buf = chunk_buf.read(missing_bytes)
-                    #print(f"read {len(residue_buf)} bytes to complete buffer")
-                    hdr = pcap_stream.parse_pcap_header(partial_packet_buf + residue_buf)
-                    ts = pcap_stream.get_ts(hdr)
-                    buf = chunk_buf.read(hdr.caplen)
-                else:
-                    packet_residue = chunk_buf.read(packet_residue_len)
-                    buf = partial_packet_buf + packet_residue
-                    ts = old_ts
-
-                handle_partial_packet = False
-                if len(buf) == 0:
-                    print(f"hdr caplen: {hdr.caplen}, packet_residue_len {packet_residue_len}, chunk len {len(chunk)}")
-                yield ts, buf
-
-                #print(f"buf position after reading packet residue of {packet_residue_len} bytes: {chunk_buf.tell()}")
-                #print(f"chunk: {chunk_num} pkt_count {pkt_count} stitching packets together at ts {ts}")
-                pkt_count = pkt_count + 1
-
-            if pcap_stream is None:
-                pcap_stream = ReaderWithHeader(chunk_buf)
-            else:
-                pcap_stream.update_file(chunk_buf)
-
-            # how far in the buffer to try to read
-            read_limit = len(chunk) - pcap_stream.pcap_header_len()
-            while pcap_stream.tell() < read_limit:
-                ts, hdr, buf = next(pcap_stream)
-                #print(f"ts {ts}, hdr caplen: {hdr.caplen}, len buf {len(buf)}")
-                pcap_packet_len = hdr.caplen
-                pcap_buf_len = len(buf)
-                # do we have the full packet?
-                if pcap_packet_len == pcap_buf_len:
-                    #print(f"chunk: {chunk_num} pkt_count {pkt_count} ts {ts} pkt_len {pcap_packet_len} buf_len {pcap_buf_len}")
-                    yield ts, buf
-                    pkt_count = pkt_count + 1
-                # do we have a partial packet buffer at a chunk boundary?
-                elif pcap_packet_len > pcap_buf_len and pcap_stream.tell() == len(chunk):
-                    #print(f"partial packet at chunk boundary, {len(buf)} bytes in buffer")
-                    #print(f"chunk: {chunk_num} pkt_count {pkt_count} ts {ts} pkt_len {pcap_packet_len} buf_len {pcap_buf_len}")
-                    partial_packet_buf = buf
-                    old_ts = ts
-                    packet_residue_len = min(self.max_buf_size, pcap_packet_len-pcap_buf_len)
-                    handle_partial_packet = True
-                    break
-            else:
-                # check if we ended in the middle of a pcap header
-                if pcap_stream.tell() < len(chunk):
-                    #print(f"header not decoded, {len(chunk)-pcap_stream.tell()} bytes left")
-                    partial_packet_buf = chunk_buf.read()
-                    handle_partial_packet = True
-                    hdr = None
-        return
-
-
-class ReaderWithHeader(dpkt.pcap.Reader):
-    def get_ts(self, hdr):
-        return hdr.tv_sec + (hdr.tv_usec / self._divisor)
+class BlobPcapPacketStreamer(PcapChunkPacketStreamer):
+    """
+    Streams pcap/pcapng records from an azure blob. With max_concurrency > 1 the blob is
+    read as concurrent ranged downloads prefetched ahead of the parser, holding at
+    most max_buffer_bytes; otherwise download_blob().chunks() is walked in order.
+    """
 
-    def __iter__(self):
-        while 1:
-            __buf = self._Reader__f.read(self._Reader__ph.__hdr_len__)
-            if not __buf:
-                break
-            __hdr = self._Reader__ph(__buf)
-            __buf = self._Reader__f.read(__hdr.caplen)
-            yield (self.get_ts(__hdr), __hdr, __buf)
-
-    def update_file(self, fileobj):
-        self._Reader__f = fileobj
-
-    def pcap_header_len(self):
-        return self._Reader__ph.__hdr_len__
-
-    def parse_pcap_header(self, buf):
-        hdr = self._Reader__ph(buf[:self.pcap_header_len()])
-        return hdr
-
-    def tell(self):
-        return self._Reader__f.tell()
+    def __init__(self, blob_client: BlobClient, chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES,
+                 ns_timestamps: bool=False):
+        self.blob_client = blob_client
+        self.blob_stream = None
+        self.prefetcher = None
+        if max_concurrency > 1:
+            size = self.blob_client.get_blob_properties().size
+            self.prefetcher = RangePrefetcher(self.read_range, size,
+                                              chunk_size=chunk_size,
+                                              max_concurrency=max_concurrency,
+                                              max_buffer_bytes=max_buffer_bytes)
+        else:
+            self.blob_stream = self.blob_client.download_blob()
+        super().__init__(ns_timestamps=ns_timestamps)
+
+    def read_range(self, offset, length):
+        return self.blob_client.download_blob(offset=offset, length=length).readall()
+
+    def iter_chunks(self):
+        if self.prefetcher is not None:
+            return iter(self.prefetcher)
+        return self.blob_stream.chunks()
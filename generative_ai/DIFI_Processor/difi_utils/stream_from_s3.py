@@ -0,0 +1,79 @@
+from difi_utils.iq_ring_buffer import StreamRingBuffers
+from difi_utils.spectrum import StreamSpectralAccumulators, DEFAULT_FFT_SIZE
+from difi_utils.packet_filter import PacketFilter
+from difi_utils.pcap_checkpoint import S3CheckpointStore, process_pcap_resumable
+from difi_utils.pcap_chunk_stream import RangePcapPacketStreamer, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_BUFFER_BYTES
+from difi_utils.stream_from_cloud import process_pcap
+
+##################
+# S3 streaming - reads a pcap object through concurrent ranged GETs instead of
+# downloading the whole capture to local storage first
+##################
+
+
+def s3_range_reader(s3_client, bucket: str, key: str):
+    """Ranged-read callable over an S3 object"""
+    def read_range(offset, length):
+        response = s3_client.get_object(Bucket=bucket,
+                                        Key=key,
+                                        Range="bytes=%d-%d" % (offset, offset + length - 1))
+        return response['Body'].read()
+    return read_range
+
+
+class S3PcapPacketStreamer(RangePcapPacketStreamer):
+    """
+    Streams (ts, buf) pcap/pcapng records from an S3 object.
+
+    :param s3_client: boto3 S3 client (or any object with head_object/get_object)
+    :param bucket: bucket name
+    :param key: pcap object key
+    :param size: object size in bytes if already known (e.g. ContentLength of a
+        head_object the caller made), saves a head_object request
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, max_buffer_bytes: int=DEFAULT_MAX_BUFFER_BYTES,
+                 ns_timestamps: bool=False, size: int=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            size = self.s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.read_range = s3_range_reader(s3_client, bucket, key)
+        super().__init__(self.read_range, size,
+                         chunk_size=chunk_size,
+                         max_concurrency=max_concurrency,
+                         max_buffer_bytes=max_buffer_bytes,
+                         ns_timestamps=ns_timestamps)
+
+
+def process_pcap_from_s3(s3_client, bucket: str, key: str, packet_offset_bytes=0, max_time_spent=None, ring_buffers: StreamRingBuffers=None,
+                         chunk_size: int=DEFAULT_CHUNK_SIZE, max_concurrency: int=DEFAULT_MAX_CONCURRENCY, columnar=False,
+                         packet_filter: PacketFilter=None, ns_timestamps: bool=False,
+                         fft_size: int=DEFAULT_FFT_SIZE, fft_window: str="rectangular",
+                         spectral_accumulators: StreamSpectralAccumulators=None, keep_ffts=True):
+    streamer = S3PcapPacketStreamer(s3_client, bucket, key, chunk_size=chunk_size, max_concurrency=max_concurrency,
+                                    ns_timestamps=ns_timestamps)
+    compliance_logs, common_field_logs, packet_logs, ffts = process_pcap(pcap_stream=streamer,
+                                                                   packet_offset_bytes=packet_offset_bytes,
+                                                                   max_time_spent=max_time_spent,
+                                                                   ring_buffers=ring_buffers,
+                                                                   fft_size=fft_size,
+                                                                   fft_window=fft_window,
+                                                                   spectral_accumulators=spectral_accumulators,
+                                                                   keep_ffts=keep_ffts,
+                                                                   columnar=columnar,
+                                                                   packet_filter=packet_filter)
+    return compliance_logs, common_field_logs, packet_logs, ffts
+
+
+def process_pcap_resumable_from_s3(s3_client, bucket: str, key: str, checkpoint_key: str=None, **kwargs):
+    """
+    process_pcap_resumable over an S3 pcap, checkpointing under s3://<bucket>/<checkpoint_key>/
+    (default <key>.ckpt/). The object's ETag is part of the checkpoint identity, so a
+    replaced capture is not resumed from a stale checkpoint.
+    """
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    store = S3CheckpointStore(s3_client, bucket, checkpoint_key or key + ".ckpt")
+    return process_pcap_resumable(s3_range_reader(s3_client, bucket, key), head['ContentLength'], store,
+                                  source_id=f"s3://{bucket}/{key}#{head.get('ETag', '')}", **kwargs)
@@ -40,11 +40,10 @@ import socket
 import getopt
 import os
 import threading
-import dpkt
 import time
-import yaml
 import csv
-from scapy.all import *
+# scapy, dpkt and yaml are only needed by pcap mode and are imported there:
+# loading scapy alone takes seconds, and importers of process_data never need them
 
 from difi_utils.difi_constants import *
 from difi_utils.custom_error_types import *
@@ -52,8 +51,6 @@ from difi_utils.file_writing import *
 from difi_utils.noncompliant_class import DifiInfo
 from difi_utils.difi_data_packet_class import DifiDataPacket
 if os.getenv("LEGACY_MODE"):
-    print("Running in Legacy Mode!")
-    time.sleep(1)
     from difi_utils.legacy_difi_context_packet_class import DifiStandardContextPacket
 else:
     from difi_utils.difi_context_packet_class import DifiStandardContextPacket
@@ -88,6 +85,19 @@ PCAP_FILE = "example.pcap" # also include dir if its not in the dir you are curr
 if os.getenv("PCAP_FILE"):
     PCAP_FILE = os.getenv("PCAP_FILE")
 
+# pcap mode: decode only one DIFI stream and/or time window, seeking through the
+# pcap's sidecar index (built on first use) instead of reading every packet
+PCAP_STREAM_ID = None # int stream ID
+if os.getenv("PCAP_STREAM_ID"):
+    PCAP_STREAM_ID = int(os.getenv("PCAP_STREAM_ID"), 0)
+PCAP_TIME_RANGE = None # (start, end) pcap timestamps in seconds, either may be None
+if os.getenv("PCAP_TIME_RANGE"):
+    # kept as decimal strings, the index converts them to nanoseconds exactly
+    PCAP_TIME_RANGE = tuple(t.strip() or None for t in os.getenv("PCAP_TIME_RANGE").split(","))
+PCAP_INDEX_FILE = None # index path, <PCAP_FILE>.idx by default (e.g. when the capture's directory is read-only)
+if os.getenv("PCAP_INDEX_FILE"):
+    PCAP_INDEX_FILE = os.getenv("PCAP_INDEX_FILE")
+
 ################
 # Process packet received
 ################
@@ -240,6 +250,10 @@ def main():
     global MODE
     global PCAP_FILE
 
+    if os.getenv("LEGACY_MODE"):
+        print("Running in Legacy Mode!")
+        time.sleep(1)
+
     #debug - print command-line args
     #print("arguments: ", len(sys.argv))
     #print("argument list: ", str(sys.argv))
@@ -346,18 +360,34 @@ def main():
     # PCAP file mode
     ################
     elif MODE == MODE_PCAP:
-        print("Reading in all packets, may take some time")
         count = 0
-        for packet in PcapReader(PCAP_FILE):
-            ts = float(packet.time)
-            if UDP in packet:
-                #print(packet[UDP].dport)
-                #print(packet[UDP].sport)
-                payload = bytes(packet[UDP].payload)
-                process_data(payload, timestamp=ts, count=count)
-                count += 1
-            elif TCP in packet:
-                pass # TODO
+        if PCAP_STREAM_ID is not None or PCAP_TIME_RANGE is not None:
+            from difi_utils.packet_filter import udp_view, capture_linktype
+            from difi_utils.pcap_index import IndexedPcapReader
+            t0, t1 = PCAP_TIME_RANGE if PCAP_TIME_RANGE is not None else (None, None)
+            reader = IndexedPcapReader(PCAP_FILE, index_file=PCAP_INDEX_FILE)
+            packets = reader.select(stream_id=PCAP_STREAM_ID, t0=t0, t1=t1)
+            print("Reading %d indexed packets" % len(reader.positions))
+            linktype = capture_linktype(reader)
+            for ts, buf in packets:
+                view = udp_view(buf, linktype)
+                if view is not None:
+                    dport, data, start, end = view
+                    process_data(bytes(data[start:end]), timestamp=ts, count=count)
+                    count += 1
+        else:
+            from scapy.all import PcapReader, UDP, TCP
+            print("Reading in all packets, may take some time")
+            for packet in PcapReader(PCAP_FILE):
+                ts = float(packet.time)
+                if UDP in packet:
+                    #print(packet[UDP].dport)
+                    #print(packet[UDP].sport)
+                    payload = bytes(packet[UDP].payload)
+                    process_data(payload, timestamp=ts, count=count)
+                    count += 1
+                elif TCP in packet:
+                    pass # TODO
 
         # Pull results from files
         report = {} # gets dumped to yaml at the end as a form of report
@@ -456,6 +486,7 @@ def main():
         report["pass"] = (report["noncompliant-count"] == 0)
 
         print(report)
+        import yaml
         with open('report.yaml', 'w+') as f:
             yaml.dump(report, f, allow_unicode=True)
 
@@ -4,11 +4,15 @@ Extract signal payload from DIFI packets
 """
 
 import sys
+import struct
 import numpy as np
 from difi_utils.difi_data_packet_class import DifiDataPacket
-from drx import process_data
+from difi_utils.custom_error_types import NoncompliantDifiPacket
 import io
 
+# malformed DIFI packets are skipped, anything else (e.g. output I/O errors) is raised
+PACKET_DECODE_ERRORS = (NoncompliantDifiPacket, struct.error, ValueError, KeyError, IndexError)
+
 def extract_payload_from_bytes(data_bytes, context_packet=None):
     """Extract complex IQ samples from DIFI data packet bytes"""
     stream = io.BytesIO(data_bytes)
@@ -49,52 +53,109 @@ def extract_payload_from_bytes(data_bytes, context_packet=None):
     
     return samples
 
-def extract_payload_from_pcap(pcap_file, output_prefix="packet", max_packets=None):
-    """Extract IQ samples from each UDP packet to separate files"""
-    from scapy.all import PcapReader, UDP
-    import os
+def extract_payload_from_pcap(pcap_file, output_prefix="packet", max_packets=None, context_packet=None, packet_filter=None,
+                              output_format="csv"):
+    """Extract IQ samples from each UDP packet to separate files
+
+    pcap_file is a pcap/pcapng path or an iterable of (ts, buf) records, e.g. an S3PcapPacketStreamer.
+    context_packet is the standard context in effect before the first packet, if known.
+    packet_filter (difi_utils.packet_filter.PacketFilter) drops records from their raw
+    bytes before they are decoded; use keep_context=True so the sample format is kept.
+    output_format "binary" appends complex64 samples to one <prefix>_<stream id>.iq file
+    per stream with a packet offset/timestamp index (difi_utils.iq_store) instead of
+    writing one CSV per packet.
+    """
+    from difi_utils.packet_filter import udp_view, capture_linktype
     
-    context_packet = None
     data_packet_count = 0
+    iq_writer = None
+    if output_format == "binary":
+        from difi_utils.iq_store import IqStoreWriter
+        iq_writer = IqStoreWriter(output_prefix)
+    elif output_format != "csv":
+        raise ValueError(f"Unsupported output_format '{output_format}'. Must be 'csv' or 'binary'")
     
-    for packet in PcapReader(pcap_file):
-        if UDP in packet:
-            try:
-                payload_data = bytes(packet[UDP].payload)
-                if len(payload_data) >= 8:
-                    pkt_type = (int.from_bytes(payload_data[:4], 'big') >> 28) & 0x0f
-                    
-                    if pkt_type == 4:  # DIFI_STANDARD_FLOW_SIGNAL_CONTEXT
-                        from difi_utils.difi_context_packet_class import DifiStandardContextPacket
-                        context_packet = DifiStandardContextPacket(io.BytesIO(payload_data))
-                    
-                    elif pkt_type == 1:  # DIFI_STANDARD_FLOW_SIGNAL_DATA_WITH_STREAMID
-                        if max_packets and data_packet_count >= max_packets:
-                            break
-                            
-                        samples = extract_payload_from_bytes(payload_data, context_packet)
-                        if samples is not None:
-                            output_file = f"{output_prefix}_{data_packet_count:03d}.csv"
-                            np.savetxt(output_file, np.column_stack([samples.real, samples.imag]), 
-                                     delimiter=',', fmt='%.6f')
-                            print(f"Saved {len(samples)} samples to {output_file}")
-                            data_packet_count += 1
-            except:
-                continue
+    # UDP payloads are sliced straight from the frame bytes (dpkt only for unusual
+    # frames), so extraction never loads scapy
+    if isinstance(pcap_file, str):
+        from difi_utils.capture_stream import iter_capture_file
+        pcap_file = iter_capture_file(pcap_file)
+    records = pcap_file
+    if packet_filter is not None:
+        records = packet_filter.filter(pcap_file)
     
+    # frames are Ethernet unless the capture says otherwise (e.g. Linux cooked from tcpdump -i any)
+    linktype = None
+    try:
+        for ts, buf in records:
+            if linktype is None:
+                linktype = capture_linktype(pcap_file)
+            view = udp_view(buf, linktype)
+            if view is None:
+                continue
+            dport, data, start, end = view
+            payload_data = bytes(data[start:end])
+            if len(payload_data) < 8:
+                continue
+            pkt_type = (int.from_bytes(payload_data[:4], 'big') >> 28) & 0x0f
+            
+            if pkt_type == 4:  # DIFI_STANDARD_FLOW_SIGNAL_CONTEXT
+                from difi_utils.difi_context_packet_class import DifiStandardContextPacket
+                try:
+                    context_packet = DifiStandardContextPacket(io.BytesIO(payload_data))
+                except PACKET_DECODE_ERRORS:
+                    continue
+            
+            elif pkt_type == 1:  # DIFI_STANDARD_FLOW_SIGNAL_DATA_WITH_STREAMID
+                if max_packets and data_packet_count >= max_packets:
+                    break
+                try:
+                    samples = extract_payload_from_bytes(payload_data, context_packet)
+                    stream_id, tsi, tsf = struct.unpack(">I8xIQ", payload_data[4:28])
+                except PACKET_DECODE_ERRORS:
+                    continue
+                if samples is None:
+                    continue
+                # output errors (disk full, unwritable prefix) are not skipped like bad packets
+                if iq_writer is not None:
+                    iq_writer.add(stream_id, data_packet_count, samples, ts, tsi, tsf)
+                else:
+                    output_file = f"{output_prefix}_{data_packet_count:03d}.csv"
+                    np.savetxt(output_file, np.column_stack([samples.real, samples.imag]), 
+                             delimiter=',', fmt='%.6f')
+                    print(f"Saved {len(samples)} samples to {output_file}")
+                data_packet_count += 1
+    finally:
+        # the packets written so far keep their index even if reading the capture fails
+        if iq_writer is not None:
+            for path in iq_writer.close():
+                print(f"Saved stream samples to {path}")
     print(f"Processed {data_packet_count} data packets")
     return data_packet_count
 
 if __name__ == "__main__":
     import argparse
+    from difi_utils.capture_stream import seconds_to_ns
     
     parser = argparse.ArgumentParser(description='Extract DIFI payload to separate files per UDP packet')
     parser.add_argument('pcap_file', help='Input PCAP file')
     parser.add_argument('--prefix', default='packet', help='Output file prefix (default: packet)')
     parser.add_argument('--max-packets', type=int, help='Maximum number of data packets to process')
+    parser.add_argument('--stream-id', type=lambda x: int(x, 0), action='append', help='Only this DIFI stream ID (repeatable, hex ok)')
+    parser.add_argument('--udp-port', type=int, action='append', help='Only this UDP destination port (repeatable)')
+    parser.add_argument('--start-time', type=seconds_to_ns, help='Skip packets before this pcap timestamp (seconds)')
+    parser.add_argument('--end-time', type=seconds_to_ns, help='Skip packets at or after this pcap timestamp (seconds)')
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv', help='One CSV per packet, or one indexed complex64 .iq file per stream')
     
     args = parser.parse_args()
     
-    count = extract_payload_from_pcap(args.pcap_file, args.prefix, args.max_packets)
+    packet_filter = None
+    if args.stream_id or args.udp_port or args.start_time is not None or args.end_time is not None:
+        from difi_utils.packet_filter import PacketFilter
+        packet_filter = PacketFilter(t0_ns=args.start_time, t1_ns=args.end_time, udp_port=args.udp_port,
+                                     stream_id=args.stream_id, keep_context=True)
+    
+    count = extract_payload_from_pcap(args.pcap_file, args.prefix, args.max_packets, packet_filter=packet_filter,
+                                      output_format=args.format)
     if count == 0:
         print("No DIFI data packets found")
\ No newline at end of file
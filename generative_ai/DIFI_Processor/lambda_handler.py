@@ -1,12 +1,31 @@
 import json
 import os
-import boto3
+import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from difi_utils.resources import get_config, get_s3_client, ensure_matplotlib, InvocationTimer
+
+# Directory of the pipeline scripts, so no step depends on the process-wide cwd
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TIMER = InvocationTimer("difi_processor")
+
+# Per-record status in the handler response
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+# Cold start: load the in-process pipeline once per execution environment
+if get_config().pipeline_mode == 'fused':
+    ensure_matplotlib()
+    import pcap_to_constellations
 
 def handler(event, context):
     """Lambda handler for processing PCAP files from S3 events"""
-    
+    with TIMER:
+        return _handle(event)
+
+def _handle(event):
     # Check if this is a test invocation
     if 'test' in event:
         return {
@@ -21,63 +40,73 @@ def handler(event, context):
             'body': json.dumps('No S3 records found in event')
         }
     
-    results = []
+    # Process records concurrently; each one works in its own temp directory
+    records = [(record['s3']['bucket']['name'], record['s3']['object']['key']) for record in event['Records']]
+    max_workers = max(1, min(get_config().record_concurrency, len(records)))
+    if max_workers > 1 and get_config().plot_workers != 1:
+        print(f"Warning: PLOT_WORKERS={get_config().plot_workers} with {max_workers} concurrent records forks "
+              f"render processes from threads; PLOT_WORKERS=1 avoids that")
     
-    for record in event['Records']:
-        # Extract S3 event details
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        
-        print(f"Processing S3 event: {bucket}/{key}")
-        
-        result = process_pcap_file(bucket, key)
-        results.append(result)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda record: process_record(*record), records))
     
+    failed = sum(1 for result in results if result['status'] == STATUS_ERROR)
     return {
         'statusCode': 200,
-        'body': json.dumps(f'Processed {len(results)} files')
+        'body': json.dumps({
+            'message': f'Processed {len(results)} files',
+            'succeeded': len(results) - failed,
+            'failed': failed,
+            'results': results
+        })
     }
 
+def process_record(bucket, key):
+    """Process one S3 event record, returning a summary for the response"""
+    print(f"Processing S3 event: {bucket}/{key}")
+    try:
+        status, result = process_pcap_file(bucket, key)
+    except Exception as e:
+        status, result = STATUS_ERROR, f'Error processing {key}: {str(e)}'
+    return {'bucket': bucket, 'key': key, 'status': status, 'result': result}
+
 def process_pcap_file(bucket, key):
-    """Process a single PCAP file"""
+    """Process a single PCAP file, returning (status, message) with status STATUS_OK or STATUS_ERROR"""
+    
+    config = get_config()
+    
+    # PIPELINE_MODE=fused runs decode, render and upload in process instead of the script run
+    if config.pipeline_mode == 'fused':
+        return process_pcap_file_fused(bucket, key)
     
-    s3_client = boto3.client('s3')
-    results_bucket = os.environ['RESULTS_BUCKET']
+    results_bucket = config.results_bucket
     
     print(f"Processing {key} from bucket {bucket}")
     
+    # Per-record working directory, removed whatever the outcome
+    output_dir = tempfile.mkdtemp(prefix='difi_')
     try:
-        # Download PCAP file to temp location
-        with tempfile.NamedTemporaryFile(suffix='.pcap', delete=False) as tmp_file:
-            s3_client.download_file(bucket, key, tmp_file.name)
-            pcap_path = tmp_file.name
-        
-        # Process the PCAP file
-        output_dir = tempfile.mkdtemp()
-        
-        # Step 1: Extract payload using local file
-        max_packets = os.environ.get('MAX_PACKETS', '100')
-        prefix = os.environ.get('OUTPUT_PREFIX', 'packet')
+        # Step 1: Extract payload, streaming the PCAP from S3 with ranged GETs
+        max_packets = str(config.max_packets)
+        prefix = config.output_prefix
         
         extract_cmd = [
-            'python', os.path.join(os.getcwd(), 'extract_payload.py'),
-            pcap_path,
+            'python', os.path.join(CODE_DIR, 's3_extract_payload.py'),
+            bucket,
+            key,
             '--prefix', prefix,
             '--max-packets', max_packets
         ]
         
-        # Change to output directory and run extraction
-        original_cwd = os.getcwd()
-        os.chdir(output_dir)
-        result = subprocess.run(extract_cmd, capture_output=True, text=True)
-        os.chdir(original_cwd)
+        # Run extraction in the output directory (cwd of the child only, safe to run concurrently)
+        result = subprocess.run(extract_cmd, capture_output=True, text=True, cwd=output_dir)
         
         print(f"Extract stdout: {result.stdout}")
         print(f"Extract stderr: {result.stderr}")
         
         if result.returncode != 0:
             print(f"Error extracting {key}: {result.stderr}")
-            return f'Error extracting {key}: {result.stderr}'
+            return STATUS_ERROR, f'Error extracting {key}: {result.stderr}'
         
         print(f"Successfully extracted payload from {key}")
         
@@ -88,24 +117,30 @@ def process_pcap_file(bucket, key):
         if not csv_files:
             # Check if extraction found no DIFI packets
             if "No DIFI data packets found" in result.stdout:
-                return f'No DIFI packets found in {key} - processing complete'
+                return STATUS_OK, f'No DIFI packets found in {key} - processing complete'
             else:
-                return 'No CSV files generated from extraction'
+                return STATUS_ERROR, 'No CSV files generated from extraction'
         
         # Step 2: Generate constellation plots
-        num_plots = os.environ.get('NUM_PLOTS', '20')
-        every_nth = os.environ.get('EVERY_NTH', '1')
-        aggregate = os.environ.get('AGGREGATE', '1')
+        num_plots = str(config.num_plots)
+        every_nth = str(config.every_nth)
+        aggregate = str(config.aggregate)
+        plot_workers = str(config.plot_workers)
+        plot_renderer = config.plot_renderer
         
         plot_cmd = [
-            'python', 's3_plot_csv.py',
+            'python', os.path.join(CODE_DIR, 's3_plot_csv.py'),
             results_bucket,
             f"results/{key.replace('.pcap', '')}/constellation.png",
             '--directory', output_dir,
             '--num-plots', num_plots,
             '--every-nth', every_nth,
-            '--aggregate', aggregate
+            '--aggregate', aggregate,
+            '--workers', plot_workers,
+            '--renderer', plot_renderer
         ]
+        if config.plot_limit is not None:
+            plot_cmd += ['--limit', str(config.plot_limit)]
         
         result = subprocess.run(plot_cmd, capture_output=True, text=True)
         
@@ -114,17 +149,47 @@ def process_pcap_file(bucket, key):
         
         if result.returncode != 0:
             print(f"Error plotting {key}: {result.stderr}")
-            return f'Error plotting {key}: {result.stderr}'
+            return STATUS_ERROR, f'Error plotting {key}: {result.stderr}'
         
         print(f"Successfully generated plots for {key}")
         
+        return STATUS_OK, f'Successfully processed {key}'
+        
+    except Exception as e:
+        print(f"Exception processing {key}: {str(e)}")
+        return STATUS_ERROR, f'Error processing {key}: {str(e)}'
+    finally:
         # Clean up temp files
-        os.unlink(pcap_path)
-        import shutil
-        shutil.rmtree(output_dir)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def process_pcap_file_fused(bucket, key):
+    """Process a single PCAP file in this process: stream, decode, render and upload without intermediate CSVs.
+    Returns (status, message) like process_pcap_file"""
+    from pcap_to_constellations import process_pcap_to_s3
+    
+    config = get_config()
+    
+    print(f"Processing {key} from bucket {bucket} (fused pipeline)")
+    
+    try:
+        count, uploaded_keys = process_pcap_to_s3(
+            bucket, key, config.results_bucket,
+            f"results/{key.replace('.pcap', '')}/constellation.png",
+            max_packets=config.max_packets,
+            every_nth=config.every_nth,
+            num_plots=config.num_plots,
+            aggregate=config.aggregate,
+            workers=config.plot_workers or None,
+            renderer=config.plot_renderer,
+            s3_client=get_s3_client(),
+            limit=config.plot_limit)
+        
+        if count == 0:
+            return STATUS_OK, f'No DIFI packets found in {key} - processing complete'
         
-        return f'Successfully processed {key}'
+        print(f"Successfully generated plots for {key}")
+        return STATUS_OK, f'Successfully processed {key}'
         
     except Exception as e:
         print(f"Exception processing {key}: {str(e)}")
-        return f'Error processing {key}: {str(e)}'
\ No newline at end of file
+        return STATUS_ERROR, f'Error processing {key}: {str(e)}'
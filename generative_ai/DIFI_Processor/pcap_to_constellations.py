@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Fused pcap -> constellation pipeline: stream a PCAP (local or S3), decode DIFI
+data packets, render random constellation plots and upload them, all in one
+process and without intermediate per-packet CSV files
+"""
+
+import os
+import io
+import tempfile
+from functools import partial
+
+from plot_random_csv import plot_packet_constellations, RENDERERS
+
+def _samples_loader(samples):
+    return samples.real, samples.imag
+
+def decode_data_packets(records, max_packets=None, every_nth=1, context_packet=None):
+    """
+    Iterate (packet number, samples[::every_nth]) for the DIFI data packets of
+    (ts, buf) pcap records, numbered and decoded exactly as extract_payload.py does
+    """
+    from difi_utils.packet_filter import udp_view, capture_linktype
+    from extract_payload import extract_payload_from_bytes
+
+    data_packet_count = 0
+    linktype = None
+    for ts, buf in records:
+        if linktype is None:
+            linktype = capture_linktype(records)
+        try:
+            view = udp_view(buf, linktype)
+            if view is None:
+                continue
+            dport, data, start, end = view
+            payload_data = bytes(data[start:end])
+            if len(payload_data) < 8:
+                continue
+            pkt_type = payload_data[0] >> 4
+
+            if pkt_type == 4:  # DIFI_STANDARD_FLOW_SIGNAL_CONTEXT
+                from difi_utils.difi_context_packet_class import DifiStandardContextPacket
+                context_packet = DifiStandardContextPacket(io.BytesIO(payload_data))
+
+            elif pkt_type == 1:  # DIFI_STANDARD_FLOW_SIGNAL_DATA_WITH_STREAMID
+                if max_packets and data_packet_count >= max_packets:
+                    break
+                samples = extract_payload_from_bytes(payload_data, context_packet)
+                if samples is not None:
+                    yield data_packet_count, samples[::every_nth]
+                    data_packet_count += 1
+        except Exception:
+            continue
+
+def render_pcap_constellations(records, output_file="random_constellations.png", max_packets=None, every_nth=1, num_plots=20,
+                               aggregate=1, workers=1, renderer="scatter", on_output=None, limit=None):
+    """
+    Decode up to max_packets data packets from (ts, buf) records and plot num_plots
+    random groups of `aggregate` consecutive packets, with the same selection and
+    file names as extract_payload.py followed by plot_random_csv.py.
+    Returns (data packet count, output files).
+    """
+    packet_sources = [(f"{packet:03d}", partial(_samples_loader, samples))
+                      for packet, samples in decode_data_packets(records, max_packets, every_nth)]
+    print(f"Decoded {len(packet_sources)} data packets")
+    if not packet_sources:
+        return 0, []
+    # samples are already decimated, so every_nth is not applied a second time
+    output_files = plot_packet_constellations(packet_sources, output_file, 1, num_plots, aggregate, workers, renderer, on_output, limit)
+    return len(packet_sources), output_files or []
+
+def process_pcap_to_s3(bucket, pcap_key, results_bucket, output_key, max_packets=None, every_nth=1, num_plots=20, aggregate=1,
+                       workers=1, renderer="scatter", s3_client=None, limit=None):
+    """
+    Stream s3://bucket/pcap_key, render its constellations and upload each plot to
+    results_bucket as <output_key without extension>_<plot file name>, the keys
+    s3_plot_csv.py produces. Returns (data packet count, uploaded keys).
+    """
+    from difi_utils.resources import get_s3_client
+    from difi_utils.stream_from_s3 import S3PcapPacketStreamer
+    from difi_utils.s3_upload import ConcurrentS3Uploader
+
+    s3 = s3_client or get_s3_client()
+    base_key = os.path.splitext(output_key)[0]
+    streamer = S3PcapPacketStreamer(s3, bucket, pcap_key)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with ConcurrentS3Uploader(s3, results_bucket) as uploader:
+            def upload(output_file):
+                uploader.submit(output_file, f"{base_key}_{os.path.basename(output_file)}")
+
+            count, output_files = render_pcap_constellations(streamer, os.path.join(tmp_dir, "constellation.png"), max_packets,
+                                                             every_nth, num_plots, aggregate, workers, renderer, on_output=upload,
+                                                             limit=limit)
+            uploaded_keys = uploader.wait([f"{base_key}_{os.path.basename(f)}" for f in output_files])
+
+    print(f"Uploaded {len(uploaded_keys)} constellation plots to s3://{results_bucket}/")
+    return count, uploaded_keys
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Render random constellation plots straight from a PCAP file')
+    parser.add_argument('pcap_file', help='Input PCAP file')
+    parser.add_argument('--output', default='random_constellations.png', help='Output file name')
+    parser.add_argument('--max-packets', type=int, help='Maximum number of data packets to decode')
+    parser.add_argument('--every-nth', type=int, default=1, help='Plot every nth sample (e.g., 2 for every other)')
+    parser.add_argument('--num-plots', type=int, default=20, help='Number of plots to create')
+    parser.add_argument('--aggregate', type=int, default=1, help='Number of packets to aggregate per plot')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for rendering (0 = one per core)')
+    parser.add_argument('--renderer', choices=RENDERERS, default='scatter', help='scatter plot or 2-D density raster')
+    parser.add_argument('--limit', type=float, help='Fixed I/Q axis limit for every plot (default: 128 for raster, autoscale for scatter)')
+
+    args = parser.parse_args()
+
+    from difi_utils.capture_stream import iter_capture_file
+    render_pcap_constellations(iter_capture_file(args.pcap_file), args.output, args.max_packets, args.every_nth,
+                               args.num_plots, args.aggregate, args.workers or None, args.renderer, limit=args.limit)
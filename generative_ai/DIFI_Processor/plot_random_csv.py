@@ -1,31 +1,181 @@
 #!/usr/bin/env python3
 """
-Plot 20 random constellation diagrams from packet_*.csv files in directory
+Plot 20 random constellation diagrams from packet_*.csv files (or packet_*.iq
+binary stores written by extract_payload.py --format binary) in directory
 """
 
 import sys
 import os
 import glob
 import random
+from functools import partial
 import numpy as np
-import matplotlib.pyplot as plt
 
-def plot_random_csv_constellations(directory=".", output_file="random_constellations.png", every_nth=1, num_plots=20, aggregate=1):
-    """Create individual constellation diagram files from CSV files"""
+from difi_utils.iq_reservoir import IqReservoir
+
+RENDERERS = ("scatter", "raster")
+MAX_SCATTER_SAMPLES = 1000
+
+def _load_csv_packet(csv_file):
+    data = np.loadtxt(csv_file, delimiter=',')
+    return data[:, 0], data[:, 1]
+
+_iq_maps = {}
+
+def _load_iq_store_packet(iq_path, offset, count):
+    # loaders only carry the path so they stay cheap to pickle for render workers
+    samples = _iq_maps.get(iq_path)
+    if samples is None:
+        from difi_utils.iq_store import IQ_DTYPE
+        samples = _iq_maps[iq_path] = np.memmap(iq_path, dtype=IQ_DTYPE, mode='r')
+    samples = samples[offset:offset + count]
+    return samples.real, samples.imag
+
+def _release_iq_maps(packet_sources):
+    # drop the memory maps opened for these packets, so a warm process does not keep deleted temp files mapped
+    for packet_num, load_packet in packet_sources:
+        if getattr(load_packet, 'func', None) is _load_iq_store_packet:
+            _iq_maps.pop(load_packet.args[0], None)
+
+def find_packet_sources(directory="."):
+    """(packet number, loader) per packet, sorted by packet number; CSV files first, else memory-mapped .iq stores"""
+    csv_files = glob.glob(os.path.join(directory, "packet_*.csv"))
+    if csv_files:
+        # Sort files by packet number for sequential aggregation
+        csv_files.sort(key=lambda x: int(os.path.basename(x).replace('packet_', '').replace('.csv', '')))
+        return [(os.path.basename(f).replace('packet_', '').replace('.csv', ''), partial(_load_csv_packet, f))
+                for f in csv_files]
     
-    # Find all packet_*.csv files
-    csv_pattern = os.path.join(directory, "packet_*.csv")
-    csv_files = glob.glob(csv_pattern)
+    from difi_utils.iq_store import find_iq_streams, iq_packet_table
+    streams = find_iq_streams(directory)
+    packets, stream_positions, index_positions = iq_packet_table(streams)
+    return [(f"{packet:03d}", partial(_load_iq_store_packet, streams[s].path,
+                                      int(streams[s].index["offset"][i]), int(streams[s].index["count"][i])))
+            for packet, s, i in zip(packets, stream_positions, index_positions)]
+
+def _group_filename(file_group, base_name, extension):
+    packet_nums = [packet_num for packet_num, _ in file_group]
+    if len(packet_nums) == 1:
+        return f"{base_name}_packet_{packet_nums[0]}{extension}"
+    return f"{base_name}_packets_{packet_nums[0]}-{packet_nums[-1]}{extension}"
+
+def _new_figure():
+    # pyplot-free figure: not registered with any global figure manager, so
+    # groups can be rendered from several threads (e.g. concurrent Lambda records)
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(6, 6))
+    return fig, fig.subplots()
+
+def _render_group(fig, ax, file_group, plot_filename, every_nth, rng=np.random, renderer="scatter", limit=None):
+    """
+    Draw one (aggregated) constellation on a reused figure (or rasterize it) and save it.
+    limit=None autoscales scatter plots and uses the fixed DEFAULT_LIMIT for raster images.
+    """
+    if renderer == "raster":
+        # density image of every sample, no subsampling needed
+        from difi_utils.constellation_raster import render_constellation, DEFAULT_LIMIT
+        i_parts, q_parts = zip(*(load_packet() for packet_num, load_packet in file_group))
+        render_constellation(np.concatenate([i[::every_nth] for i in i_parts]),
+                             np.concatenate([q[::every_nth] for q in q_parts]), plot_filename,
+                             limit=DEFAULT_LIMIT if limit is None else limit)
+        return
+    
+    # Limit samples for performance: stream every packet of the group through a
+    # fixed-size reservoir instead of concatenating all of them first
+    reservoir = IqReservoir(MAX_SCATTER_SAMPLES, rng)
+    for packet_num, load_packet in file_group:
+        i_data, q_data = load_packet()
+        reservoir.add(i_data[::every_nth], q_data[::every_nth])
+    all_i_samples, all_q_samples = reservoir.result()
     
-    if len(csv_files) == 0:
-        print(f"No packet_*.csv files found in {directory}")
+    ax.clear()
+    ax.scatter(all_i_samples, all_q_samples, alpha=0.6, s=0.5)
+    ax.grid(True, alpha=0.3)
+    ax.set_aspect('equal')
+    if limit is not None:
+        ax.set_xlim(-limit, limit)
+        ax.set_ylim(-limit, limit)
+    ax.tick_params(axis='both', which='major', labelsize=8)
+    ax.locator_params(nbins=5)
+    fig.savefig(plot_filename, dpi=150, bbox_inches='tight')
+
+##################
+# parallel rendering - groups are dealt round-robin to worker processes, each with
+# the Agg backend and one figure reused for all of its plots. Plain processes and
+# pipes are used instead of multiprocessing.Pool, which needs /dev/shm semaphores
+# that AWS Lambda does not provide
+##################
+
+def _render_worker(tasks, every_nth, renderer, limit, conn):
+    import matplotlib
+    matplotlib.use("Agg")
+    fig, ax = _new_figure() if renderer == "scatter" else (None, None)
+    for i, file_group, plot_filename, seed in tasks:
+        try:
+            _render_group(fig, ax, file_group, plot_filename, every_nth, np.random.RandomState(seed), renderer, limit)
+            conn.send((i, plot_filename, None))
+        except Exception as e:
+            conn.send((i, None, str(e)))
+    conn.close()
+
+def _render_parallel(tasks, every_nth, workers, renderer="scatter", limit=None):
+    """Render (i, file_group, plot_filename, seed) tasks in `workers` processes; yields (i, filename, error) as each one finishes"""
+    import multiprocessing
+    from multiprocessing.connection import wait
+    running = {}
+    for w in range(workers):
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_render_worker, args=(tasks[w::workers], every_nth, renderer, limit, send_conn))
+        process.start()
+        send_conn.close()
+        running[recv_conn] = (process, {task[0] for task in tasks[w::workers]})
+    
+    while running:
+        for recv_conn in wait(list(running)):
+            process, pending = running[recv_conn]
+            try:
+                i, plot_filename, error = recv_conn.recv()
+                pending.discard(i)
+                yield i, plot_filename, error
+            except EOFError:
+                # worker finished (or died): report whatever it did not render
+                del running[recv_conn]
+                process.join()
+                for i in sorted(pending):
+                    yield i, None, f"render worker exited with code {process.exitcode}"
+
+def plot_random_csv_constellations(directory=".", output_file="random_constellations.png", every_nth=1, num_plots=20, aggregate=1, workers=1,
+                                   renderer="scatter", on_output=None, limit=None):
+    """
+    Create individual constellation diagram files from CSV files (or .iq stores); workers=None uses every core.
+    renderer="raster" writes 2-D density images of all samples instead of scatter plots of MAX_SCATTER_SAMPLES of them.
+    on_output(filename) is called as soon as each file is written, e.g. to start uploading it.
+    limit sets the same +/-limit I/Q axes on every plot; None scales each scatter plot to its own
+    samples, raster images always use fixed axes (constellation_raster.DEFAULT_LIMIT by default).
+    """
+    # Find all packet_*.csv files, or packets in packet_*.iq stores
+    packet_sources = find_packet_sources(directory)
+    
+    if len(packet_sources) == 0:
+        print(f"No packet_*.csv or packet_*.iq files found in {directory}")
         return
     
-    # Sort files by packet number for sequential aggregation
-    csv_files.sort(key=lambda x: int(os.path.basename(x).replace('packet_', '').replace('.csv', '')))
+    try:
+        return plot_packet_constellations(packet_sources, output_file, every_nth, num_plots, aggregate, workers, renderer, on_output, limit)
+    finally:
+        _release_iq_maps(packet_sources)
+
+def plot_packet_constellations(packet_sources, output_file="random_constellations.png", every_nth=1, num_plots=20, aggregate=1, workers=1,
+                               renderer="scatter", on_output=None, limit=None):
+    """
+    plot_random_csv_constellations over a list of (packet number string, loader) pairs
+    sorted by packet number, where loader() returns the packet's (i, q) arrays
+    """
+    if renderer not in RENDERERS:
+        raise ValueError(f"renderer must be one of {RENDERERS}, not {renderer!r}")
     
     # Select random starting points for aggregation
-    max_start = len(csv_files) - aggregate + 1
+    max_start = len(packet_sources) - aggregate + 1
     if max_start <= 0:
         print(f"Not enough files for aggregation of {aggregate}")
         return
@@ -35,68 +185,45 @@ def plot_random_csv_constellations(directory=".", output_file="random_constellat
     # Create file groups with sequential aggregation
     file_groups = []
     for start_idx in start_indices:
-        group = csv_files[start_idx:start_idx + aggregate]
+        group = packet_sources[start_idx:start_idx + aggregate]
         file_groups.append(group)
     
     num_plots = len(file_groups)
     
-    print(f"Found {len(csv_files)} CSV files, plotting {num_plots} random ones")
+    print(f"Found {len(packet_sources)} packets, plotting {num_plots} random ones")
     
     # Generate base filename without extension
     base_name = os.path.splitext(output_file)[0]
     extension = os.path.splitext(output_file)[1] or '.png'
     
+    plot_filenames = [_group_filename(file_group, base_name, extension) for file_group in file_groups]
+    workers = min(workers or os.cpu_count() or 1, num_plots)
+    
     output_files = []
     
-    for i, file_group in enumerate(file_groups):
-        try:
-            # Aggregate samples from multiple CSV files
-            all_i_samples = []
-            all_q_samples = []
-            packet_nums = []
-            
-            for csv_file in file_group:
-                data = np.loadtxt(csv_file, delimiter=',')
-                i_samples = data[:, 0][::every_nth]
-                q_samples = data[:, 1][::every_nth]
-                all_i_samples.extend(i_samples)
-                all_q_samples.extend(q_samples)
-                
-                # Extract packet number
-                filename = os.path.basename(csv_file)
-                packet_num = filename.replace('packet_', '').replace('.csv', '')
-                packet_nums.append(packet_num)
-            
-            # Convert to numpy arrays
-            all_i_samples = np.array(all_i_samples)
-            all_q_samples = np.array(all_q_samples)
-            
-            # Limit samples for performance
-            if len(all_i_samples) > 1000:
-                indices = np.random.choice(len(all_i_samples), 1000, replace=False)
-                all_i_samples = all_i_samples[indices]
-                all_q_samples = all_q_samples[indices]
-            
-            # Create individual plot
-            fig, ax = plt.subplots(figsize=(6, 6))
-            ax.scatter(all_i_samples, all_q_samples, alpha=0.6, s=0.5)
-            ax.grid(True, alpha=0.3)
-            ax.set_aspect('equal')
-            ax.tick_params(axis='both', which='major', labelsize=8)
-            ax.locator_params(nbins=5)
-            
-            # Generate output filename
-            if len(packet_nums) == 1:
-                plot_filename = f"{base_name}_packet_{packet_nums[0]}{extension}"
+    if workers > 1:
+        print(f"Rendering with {workers} worker processes")
+        seeds = np.random.randint(2**31, size=num_plots)
+        tasks = list(zip(range(num_plots), file_groups, plot_filenames, seeds))
+        rendered = {}
+        for i, plot_filename, error in _render_parallel(tasks, every_nth, workers, renderer, limit):
+            if error is not None:
+                print(f"Error processing file group {i}: {error}")
             else:
-                plot_filename = f"{base_name}_packets_{packet_nums[0]}-{packet_nums[-1]}{extension}"
-            
-            plt.savefig(plot_filename, dpi=150, bbox_inches='tight')
-            plt.close()
-            output_files.append(plot_filename)
-            
-        except Exception as e:
-            print(f"Error processing file group {i}: {e}")
+                rendered[i] = plot_filename
+                if on_output is not None:
+                    on_output(plot_filename)
+        output_files = [rendered[i] for i in sorted(rendered)]
+    else:
+        fig, ax = _new_figure() if renderer == "scatter" else (None, None)
+        for i, (file_group, plot_filename) in enumerate(zip(file_groups, plot_filenames)):
+            try:
+                _render_group(fig, ax, file_group, plot_filename, every_nth, renderer=renderer, limit=limit)
+                output_files.append(plot_filename)
+                if on_output is not None:
+                    on_output(plot_filename)
+            except Exception as e:
+                print(f"Error processing file group {i}: {e}")
     
     print(f"Generated {len(output_files)} constellation plots")
     return output_files
@@ -105,12 +232,17 @@ if __name__ == "__main__":
     import argparse
     
     parser = argparse.ArgumentParser(description='Plot random constellation diagrams from CSV files')
-    parser.add_argument('directory', nargs='?', default='.', help='Directory containing packet_*.csv files')
+    parser.add_argument('directory', nargs='?', default='.', help='Directory containing packet_*.csv files (or packet_*.iq stores)')
     parser.add_argument('--output', default='random_constellations.png', help='Output file name')
     parser.add_argument('--every-nth', type=int, default=1, help='Plot every nth sample (e.g., 2 for every other)')
     parser.add_argument('--num-plots', type=int, default=20, help='Number of plots to create')
     parser.add_argument('--aggregate', type=int, default=1, help='Number of CSV files to aggregate per plot')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for rendering (0 = one per core)')
+    parser.add_argument('--renderer', choices=RENDERERS, default='scatter',
+                        help='scatter: matplotlib scatter of up to 1000 samples; raster: 2-D density image of all samples')
+    parser.add_argument('--limit', type=float, help='Fixed I/Q axis limit for every plot, so plots are comparable (default: 128 for raster, autoscale for scatter)')
     
     args = parser.parse_args()
     
-    plot_random_csv_constellations(args.directory, args.output, args.every_nth, args.num_plots, args.aggregate)
\ No newline at end of file
+    plot_random_csv_constellations(args.directory, args.output, args.every_nth, args.num_plots, args.aggregate,
+                                   workers=args.workers or None, renderer=args.renderer, limit=args.limit)
\ No newline at end of file
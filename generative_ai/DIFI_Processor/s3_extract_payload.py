@@ -3,27 +3,27 @@
 Extract signal payload from DIFI packets with S3 support
 """
 
-import boto3
-import tempfile
-import os
 from extract_payload import extract_payload_from_pcap
+from difi_utils.pcap_chunk_stream import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY
+from difi_utils.stream_from_s3 import S3PcapPacketStreamer
+from difi_utils.resources import get_s3_client
 
-def extract_from_s3(bucket, pcap_key, output_prefix="packet", max_packets=None):
-    """Download PCAP from S3, extract payload, return count"""
-    s3 = boto3.client('s3')
+def extract_from_s3(bucket, pcap_key, output_prefix="packet", max_packets=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY, output_format="csv"):
+    """Stream PCAP from S3 with ranged GETs, extract payload, return count"""
+    s3 = get_s3_client()
     
     try:
         print(f"Checking if s3://{bucket}/{pcap_key} exists...")
-        s3.head_object(Bucket=bucket, Key=pcap_key)
-        print("File found, downloading...")
+        size = s3.head_object(Bucket=bucket, Key=pcap_key)['ContentLength']
+        print("File found, streaming...")
     except Exception as e:
+        # a failed read is an error, not an empty capture
         print(f"Error accessing s3://{bucket}/{pcap_key}: {e}")
-        return 0
+        raise
     
-    with tempfile.NamedTemporaryFile(suffix='.pcap', delete=False) as tmp_file:
-        s3.download_file(bucket, pcap_key, tmp_file.name)
-        count = extract_payload_from_pcap(tmp_file.name, output_prefix, max_packets)
-        os.unlink(tmp_file.name)
+    streamer = S3PcapPacketStreamer(s3, bucket, pcap_key, chunk_size=chunk_size, max_concurrency=max_concurrency, size=size)
+    count = extract_payload_from_pcap(streamer, output_prefix, max_packets, output_format=output_format)
     
     return count
 
@@ -35,8 +35,14 @@ if __name__ == "__main__":
     parser.add_argument('pcap_key', help='S3 key for PCAP file')
     parser.add_argument('--prefix', default='packet', help='Output file prefix')
     parser.add_argument('--max-packets', type=int, help='Maximum packets to process')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Bytes per ranged GET')
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_CONCURRENCY, help='Ranged GETs in flight')
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv', help='One CSV per packet, or one indexed complex64 .iq file per stream')
     
     args = parser.parse_args()
     
-    count = extract_from_s3(args.bucket, args.pcap_key, args.prefix, args.max_packets)
-    print(f"Extracted {count} packets from s3://{args.bucket}/{args.pcap_key}")
\ No newline at end of file
+    count = extract_from_s3(args.bucket, args.pcap_key, args.prefix, args.max_packets,
+                            args.chunk_size, args.max_concurrency, args.format)
+    print(f"Extracted {count} packets from s3://{args.bucket}/{args.pcap_key}")
+    if count == 0:
+        print("No DIFI data packets found")
\ No newline at end of file
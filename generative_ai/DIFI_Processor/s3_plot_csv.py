@@ -3,27 +3,30 @@
 Plot constellation diagrams and upload to S3
 """
 
-import boto3
 import tempfile
 import os
-from plot_random_csv import plot_random_csv_constellations
+from plot_random_csv import plot_random_csv_constellations, RENDERERS
+from difi_utils.s3_upload import ConcurrentS3Uploader, DEFAULT_UPLOAD_CONCURRENCY
+from difi_utils.resources import get_s3_client
 
-def plot_and_upload_s3(bucket, output_key, directory=".", every_nth=1, num_plots=20, aggregate=1):
-    """Create constellation plots and upload to S3"""
+def plot_and_upload_s3(bucket, output_key, directory=".", every_nth=1, num_plots=20, aggregate=1, workers=1, renderer="scatter",
+                       s3_client=None, upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY, limit=None):
+    """Create constellation plots and upload to S3, each plot as soon as it is rendered"""
+    
+    s3 = s3_client or get_s3_client()
+    base_key = os.path.splitext(output_key)[0]
     
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_base = os.path.join(tmp_dir, "constellation")
-        output_files = plot_random_csv_constellations(directory, tmp_base + ".png", every_nth, num_plots, aggregate)
-        
-        s3 = boto3.client('s3')
-        base_key = os.path.splitext(output_key)[0]
-        
-        uploaded_keys = []
-        for output_file in output_files:
-            filename = os.path.basename(output_file)
-            s3_key = f"{base_key}_{filename}"
-            s3.upload_file(output_file, bucket, s3_key)
-            uploaded_keys.append(s3_key)
+        with ConcurrentS3Uploader(s3, bucket, max_concurrency=upload_concurrency) as uploader:
+            def upload(output_file):
+                filename = os.path.basename(output_file)
+                uploader.submit(output_file, f"{base_key}_{filename}")
+            
+            output_files = plot_random_csv_constellations(directory, tmp_base + ".png", every_nth, num_plots, aggregate, workers,
+                                                          renderer, on_output=upload, limit=limit)
+            # keys in plot order, whatever order the uploads finished in
+            uploaded_keys = uploader.wait([f"{base_key}_{os.path.basename(f)}" for f in output_files or []])
     
     print(f"Uploaded {len(uploaded_keys)} constellation plots to s3://{bucket}/")
     for key in uploaded_keys:
@@ -40,8 +43,13 @@ if __name__ == "__main__":
     parser.add_argument('--every-nth', type=int, default=1, help='Plot every nth sample')
     parser.add_argument('--num-plots', type=int, default=20, help='Number of plots')
     parser.add_argument('--aggregate', type=int, default=1, help='Files to aggregate per plot')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for rendering (0 = one per core)')
+    parser.add_argument('--renderer', choices=RENDERERS, default='scatter', help='scatter plot or 2-D density raster')
+    parser.add_argument('--limit', type=float, help='Fixed I/Q axis limit for every plot (default: 128 for raster, autoscale for scatter)')
+    parser.add_argument('--upload-concurrency', type=int, default=DEFAULT_UPLOAD_CONCURRENCY, help='Parallel S3 uploads')
     
     args = parser.parse_args()
     
     plot_and_upload_s3(args.bucket, args.output_key, args.directory, 
-                      args.every_nth, args.num_plots, args.aggregate)
\ No newline at end of file
+                      args.every_nth, args.num_plots, args.aggregate, args.workers or None,
+                      args.renderer, upload_concurrency=args.upload_concurrency, limit=args.limit)
\ No newline at end of file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure the import (startup) cost of each pipeline entry point in fresh
+interpreters, and list the slowest modules each one pulls in
+"""
+
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+ENTRY_POINTS = [
+    "drx",
+    "extract_payload",
+    "s3_extract_payload",
+    "plot_random_csv",
+    "s3_plot_csv",
+    "pcap_to_constellations",
+    "lambda_handler",
+]
+
+def interpreter_baseline(repeat=5):
+    """Median wall time in seconds of starting an interpreter that imports nothing"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def import_wall_time(module, repeat=5):
+    """Median wall time in seconds of a fresh interpreter importing `module`"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def slowest_imports(module, top=5):
+    """(cumulative microseconds, package) of the slowest top-level packages imported by `module`, from -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    # importtime prints each module after its imports; nesting is shown by indentation,
+    # top-level imports with one space and their direct imports with three
+    children = {}
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # header line
+        name = fields[2].rstrip()
+        depth = len(name) - len(name.lstrip())
+        if depth == 3:
+            children[name.strip()] = cumulative
+        elif depth == 1:
+            if name.strip() == module:
+                packages = children
+            children = {}
+    return sorted(((us, name) for name, us in packages.items()), reverse=True)[:top]
+
+def run_benchmark(entry_points=ENTRY_POINTS, repeat=5, top=5):
+    baseline = interpreter_baseline(repeat)
+    print(f"Interpreter startup (no imports): {baseline * 1000:.0f} ms\n")
+    print(f"{'entry point':<26}{'wall ms':>10}{'import ms':>12}   slowest direct imports")
+    results = {}
+    for module in entry_points:
+        try:
+            wall = import_wall_time(module, repeat)
+            slowest = slowest_imports(module, top)
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<26}{'failed':>10}   {e}")
+            continue
+        results[module] = wall - baseline
+        detail = ", ".join(f"{name} {us / 1000:.0f}" for us, name in slowest)
+        print(f"{module:<26}{wall * 1000:>10.0f}{(wall - baseline) * 1000:>12.0f}   {detail}")
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the pipeline entry points')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='Modules to measure (default: all entry points)')
+    parser.add_argument('--repeat', type=int, default=5, help='Interpreter starts per module (median is reported)')
+    parser.add_argument('--top', type=int, default=5, help='Slowest direct imports to list per module')
+
+    args = parser.parse_args()
+
+    run_benchmark(args.modules, args.repeat, args.top)
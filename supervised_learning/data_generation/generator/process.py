@@ -2,13 +2,36 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import glob
+import sys
 
-def convert_complex_data(npy_path: str):
+# The raster renderer is shared with generative_ai/DIFI_Processor and imported from
+# the same checkout, so generated images match the ones the Bedrock pipeline analyzes
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'generative_ai', 'DIFI_Processor')))
+from difi_utils.constellation_raster import constellation_limit, render_constellation
+
+RASTER_IMAGE_SIZE = 2400  # pixels, the 8 in x 300 dpi of the scatter plots
+RASTER_LIMIT = 2.0        # fixed axis limit of raster images, the generated samples stay within +/-1.5
+
+def rasterize_constellation(i_data, q_data, image_path: str, limit: float = RASTER_LIMIT, size: int = RASTER_IMAGE_SIZE):
+    """
+    Write a constellation image by binning the samples into a size x size 2-D
+    density grid (log intensity) instead of drawing one scatter marker per sample.
+    
+    Args:
+        i_data, q_data: IQ samples
+        image_path: Output image path (.jpeg/.png)
+        limit: Axis limit, the image covers [-limit, limit] in I and Q
+        size: Image width and height in pixels
+    """
+    render_constellation(i_data, q_data, image_path, size=size, limit=limit)
+
+def convert_complex_data(npy_path: str, renderer: str = 'scatter'):
     """
     Convert a complex NPY file to both CSV and JPG files.
     
     Args:
         npy_path: Path to input NPY file
+        renderer: 'scatter' (matplotlib scatter plot) or 'raster' (2-D density image)
     """
     try:
         # Create output paths
@@ -27,28 +50,32 @@ def convert_complex_data(npy_path: str):
         xy_coords = np.column_stack((i_data, q_data))
         np.savetxt(csv_path, xy_coords, delimiter=',', header='I,Q', comments='')
         
-        # Create constellation plot
-        plt.ioff()
-        fig = plt.figure(figsize=(8, 8))
-        ax = fig.add_subplot(111)
-        
-        # Create scatter plot
-        ax.scatter(i_data, q_data, alpha=0.5, s=1)
-        
-        # Basic plot styling
-        ax.grid(True, alpha=0.3)
-        ax.set_aspect('equal')
-        ax.axhline(y=0, color='k', linestyle='-', alpha=0.3)
-        ax.axvline(x=0, color='k', linestyle='-', alpha=0.3)
-        
-        # Set axis limits
-        limit = max(abs(i_data).max(), abs(q_data).max()) * 1.1
-        ax.set_xlim(-limit, limit)
-        ax.set_ylim(-limit, limit)
-        
-        # Save and clean up plot
-        plt.savefig(jpg_path, bbox_inches='tight', dpi=300, pad_inches=0)
-        plt.close(fig)
+        if renderer == 'raster':
+            rasterize_constellation(i_data, q_data, jpg_path)
+        else:
+            # Set axis limits
+            limit = constellation_limit(i_data, q_data)
+            
+            # Create constellation plot
+            plt.ioff()
+            fig = plt.figure(figsize=(8, 8))
+            ax = fig.add_subplot(111)
+            
+            # Create scatter plot
+            ax.scatter(i_data, q_data, alpha=0.5, s=1)
+            
+            # Basic plot styling
+            ax.grid(True, alpha=0.3)
+            ax.set_aspect('equal')
+            ax.axhline(y=0, color='k', linestyle='-', alpha=0.3)
+            ax.axvline(x=0, color='k', linestyle='-', alpha=0.3)
+            
+            ax.set_xlim(-limit, limit)
+            ax.set_ylim(-limit, limit)
+            
+            # Save and clean up plot
+            plt.savefig(jpg_path, bbox_inches='tight', dpi=300, pad_inches=0)
+            plt.close(fig)
         
         # Remove the original NPY file
         os.remove(npy_path)
@@ -58,12 +85,13 @@ def convert_complex_data(npy_path: str):
     except Exception as e:
         print(f"Error processing {npy_path}: {e}")
 
-def process_directory(root_dir: str):
+def process_directory(root_dir: str, renderer: str = 'scatter'):
     """
     Recursively process all NPY files in the directory and convert to both CSV and JPG files.
     
     Args:
         root_dir: Root directory to start the search
+        renderer: 'scatter' or 'raster', see convert_complex_data
     """
     # Find all .npy files in directory and subdirectories
     npy_files = glob.glob(os.path.join(root_dir, '**/*.npy'), recursive=True)
@@ -73,10 +101,17 @@ def process_directory(root_dir: str):
     
     for idx, npy_file in enumerate(npy_files, 1):
         # print(f"Processing file {idx}/{total_files}: {npy_file}")
-        convert_complex_data(npy_file)
+        convert_complex_data(npy_file, renderer)
     
     print("\nProcessing complete!")
 
 if __name__ == "__main__":
-    root_directory = './data'
-    process_directory(root_directory)
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Convert generated NPY files to CSV and constellation JPEG files')
+    parser.add_argument('root_directory', nargs='?', default='./data', help='Root directory to search for NPY files')
+    parser.add_argument('--renderer', choices=['scatter', 'raster'], default='scatter',
+                        help='scatter: matplotlib scatter plot; raster: 2-D density image, much faster for large files')
+    args = parser.parse_args()
+    
+    process_directory(args.root_directory, args.renderer)
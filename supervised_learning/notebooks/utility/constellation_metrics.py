@@ -5,7 +5,7 @@ import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import OneHotEncoder
 
-from utility import confidence_ellipse
+from utility import confidence_ellipse, constellation_limit, constellation_density, CONSTELLATION_LIMIT
 
 class ConstellationProcessor:
     # Mapping of modulation types to number of clusters
@@ -49,6 +49,31 @@ class ConstellationProcessor:
         q_values = df['Q'].values
 
         return i_values, q_values
+
+    def load_iq_data(self, file_path, packets=None):
+        """
+        Memory-map IQ samples from a binary .iq stream file (complex64, written by
+        DIFI_Processor extract_payload.py --format binary) and its .index.npy
+        packet index
+        
+        Args:
+            file_path (str): Path to the .iq file
+            packets (list): Data packet numbers to load, all packets if None
+            
+        Returns:
+            tuple: (i_values, q_values)
+        """
+        samples = np.memmap(file_path, dtype='<c8', mode='r')
+        if packets is None:
+            return samples.real, samples.imag
+
+        index = np.load(file_path[:-len('.iq')] + '.index.npy')
+        positions = np.searchsorted(index['packet'], packets)
+        found = (positions < len(index)) & (index['packet'][np.minimum(positions, len(index) - 1)] == packets)
+        if not np.all(found):
+            raise ValueError(f"Packets not in {file_path}: {np.asarray(packets)[~found].tolist()}")
+        selected = np.concatenate([samples[e['offset']:e['offset'] + e['count']] for e in index[positions]])
+        return selected.real, selected.imag
     
     def encode_blobs(self, n_blobs):
         """
@@ -215,7 +240,7 @@ class ConstellationProcessor:
         
         return results, clusters, cluster_labels, ellipse_metrics
     
-    def plot_constellation(self, i_data, q_data, clusters, cluster_labels, ellipse_metrics, data_type):
+    def plot_constellation(self, i_data, q_data, clusters, cluster_labels, ellipse_metrics, data_type, raster=False):
         """
         Generate constellation plots
         
@@ -225,12 +250,19 @@ class ConstellationProcessor:
             cluster_labels: Cluster assignments
             ellipse_metrics: Ellipse metrics
             data_type: Type of data
+            raster (bool): Draw the original constellation as a 2-D density image
+                instead of a scatter plot (fast for large captures)
         """
         plt.figure(figsize=(15, 5))
         
         # Original constellation plot
         plt.subplot(1, 3, 1)
-        plt.scatter(i_data, q_data, alpha=0.5)
+        if raster:
+            limit = CONSTELLATION_LIMIT
+            counts = constellation_density(i_data, q_data, 512, limit)
+            plt.imshow(np.log1p(counts), cmap='Blues', extent=(-limit, limit, -limit, limit))
+        else:
+            plt.scatter(i_data, q_data, alpha=0.5)
         plt.grid(True)
         plt.title(f'Original Constellation - {data_type}')
         plt.xlabel('I')
@@ -265,24 +297,53 @@ class ConstellationProcessor:
         plt.tight_layout()
         plt.show()
     
-    def process_file(self, file_path, data_type, plot=False):
+    def render_constellation(self, i_data, q_data, output_file, size=512, limit=CONSTELLATION_LIMIT, log_scale=True):
+        """
+        Save a constellation image binned into a size x size 2-D density grid.
+        Cost is linear in the number of samples, and a fixed `limit` gives
+        images of different captures the same axes.
+        
+        Args:
+            i_data, q_data: IQ data
+            output_file (str): Image path (.png/.jpeg)
+            size (int): Image width and height in pixels
+            limit (float): Axis limit, the image covers [-limit, limit]; fitted to the data if None
+            log_scale (bool): Log (True) or linear (False) intensity
+            
+        Returns:
+            float: Axis limit used
+        """
+        if limit is None:
+            limit = constellation_limit(i_data, q_data)
+        counts = constellation_density(i_data, q_data, size, limit)
+        intensity = np.log1p(counts) if log_scale else counts.astype(np.float32)
+        plt.imsave(output_file, intensity, cmap='Blues', vmin=0, vmax=max(intensity.max(), 1e-9))
+        return limit
+    
+    def process_file(self, file_path, data_type, plot=False, packets=None):
         """
         Process a single constellation file
         
         Args:
-            file_path (str): Path to the CSV file
+            file_path (str): Path to the CSV file, or a binary .iq stream file
             data_type (str): Type of data being processed
-            plot (bool): Whether to generate plots
+            plot (bool): Whether to generate plots, 'raster' to draw the original
+                constellation as a density image
+            packets (list): Data packet numbers to use from a .iq file, all if None
             
         Returns:
             dict: Processed results
         """
         try:
-            i_data, q_data = self.load_csv_data(file_path)
+            if file_path.endswith('.iq'):
+                i_data, q_data = self.load_iq_data(file_path, packets)
+            else:
+                i_data, q_data = self.load_csv_data(file_path)
             results, clusters, cluster_labels, ellipse_metrics = self.process_constellation(i_data, q_data, data_type)
             
             if plot:
-                self.plot_constellation(i_data, q_data, clusters, cluster_labels, ellipse_metrics, data_type)
+                self.plot_constellation(i_data, q_data, clusters, cluster_labels, ellipse_metrics, data_type,
+                                        raster=(plot == 'raster'))
                 
             return results
         except Exception as e:
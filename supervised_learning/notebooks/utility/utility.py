@@ -1,3 +1,5 @@
+import os
+import sys
 import numpy as np
 from matplotlib.patches import Ellipse
 from matplotlib.path import Path
@@ -47,4 +49,11 @@ def confidence_ellipse(x, y, n_std=3.0):
     area = np.pi * major_length * minor_length
     density = num_inside / area
     
-    return {"ellipse": ellipse, "major_axis": major_axis, "minor_axis": minor_axis, "center": center, "density": density, "ratio": (major_length/minor_length), "axis": (distance_major < distance_minor), "angle": angle}
\ No newline at end of file
+    return {"ellipse": ellipse, "major_axis": major_axis, "minor_axis": minor_axis, "center": center, "density": density, "ratio": (major_length/minor_length), "axis": (distance_major < distance_minor), "angle": angle}
+
+# The constellation binning is shared with generative_ai/DIFI_Processor and imported
+# from the same checkout, so the notebooks and the Bedrock pipeline draw identical images
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'generative_ai', 'DIFI_Processor')))
+from difi_utils.constellation_raster import constellation_limit, constellation_density
+
+CONSTELLATION_LIMIT = 2.0  # fixed axis limit, the generated samples stay within +/-1.5